@@ -4,39 +4,75 @@
 from __future__ import with_statement
 
 import atexit
+import collections
 import functools
 import hashlib
+import heapq
+import io
 import json
 import logging as log
+import mmap
 import os
 import platform
+import queue
 import re
 import smtplib
 import socket
+import sqlite3
+import stat
+import struct
 import subprocess
 import sys
+import tarfile
+import threading
 import time
 import traceback
+import zlib
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 from email.mime.text import MIMEText
 from typing import Tuple, Dict, Optional, List, Set, AnyStr, Match, Callable, BinaryIO, Pattern, Iterable, Any, IO, \
-    Sequence
+    Sequence, Deque, Iterator
 
 
-def through_dirs(path: str, dir_filter: Callable[[str], bool], func: Callable[[str], Any] = None) -> None:
-    """ Рекурсивно сканирует директории.
-    Вызывает для каждой директории фильтр. """
+def through_dirs(path: str,
+                 dir_filter: Callable[[str], bool],
+                 func: Callable[[str, os.DirEntry], Any] = None) -> None:
+    """ Сканирует директории без рекурсии через os.scandir, в глубину.
+    Вызывает для каждой директории фильтр, директория пропускается, если фильтр вернул True.
+    Вызывает func для каждого файла, передавая DirEntry с закэшированными типом и stat файла.
+    Не заходит в директорию, если она уже открыта выше по пути через символическую ссылку. """
     if dir_filter(path):
         return
-    if path == '.':
-        prefix = ''
-    else:
-        prefix = path + '/'
-    for i in os.listdir(path):
-        s = prefix + i
-        if os.path.isdir(os.path.realpath(s)):
-            through_dirs(s, dir_filter, func)
+
+    def scan(directory: str) -> Iterator[os.DirEntry]:
+        with os.scandir(directory) as it:
+            return iter(list(it))
+
+    def dir_id(st: os.stat_result) -> Tuple[int, int]:
+        return st.st_dev, st.st_ino
+
+    root = os.stat(path)
+    stack = [('' if path == '.' else path + '/', scan(path), dir_id(root))]
+    opened = {dir_id(root)}  # type: Set[Tuple[int, int]] # директории в стеке, защита от циклов
+    while len(stack) > 0:
+        prefix, entries, key = stack[-1]
+        entry = next(entries, None)
+        if entry is None:
+            stack.pop()
+            opened.discard(key)
+            continue
+        s = prefix + entry.name
+        if entry.is_dir():
+            if dir_filter(s):
+                continue
+            key = dir_id(entry.stat())
+            if key in opened:
+                log.warning('%s: directory loop ignored', s)
+                continue
+            opened.add(key)
+            stack.append((s + '/', scan(s), key))
         elif func is not None:
-            func(s)
+            func(s, entry)
 
 
 class StopWatch:
@@ -58,41 +94,536 @@ def stop_watch(msg, func: Callable[[], Any]) -> Any:
     return result
 
 
+# алгоритмы контрольных сумм. Суммы md5 пишутся без префикса, остальные - в виде 'алгоритм:сумма'
+CHECKSUM_ALGORITHMS = ('md5', 'sha1', 'sha256', 'sha512', 'blake2b', 'blake2s', 'sha3_256', 'sha3_512')
+# двоичный журнал '.checksum.bin': заголовок, затем записи:
+# метка, (время, индекс алгоритма, длина имени), сумма, имя, crc32 всего после метки.
+# По метке и crc32 чтение находит следующую целую запись после оборванной
+CHECKSUM_LOG_MAGIC = b'checksum-log 2\n'
+CHECKSUM_LOG_MARK = b'\xa5\x5a'
+CHECKSUM_LOG_RECORD = struct.Struct('<dBH')
+CHECKSUM_LOG_CRC = struct.Struct('<I')
+CHECKSUM_LOG_INVALID = 255  # индекс алгоритма записи без суммы, например 'corrupted'
+
+
+def new_hash(algorithm: str = 'md5') -> Any:
+    """ Создаёт объект для подсчёта контрольной суммы """
+    return hashlib.new(algorithm)
+
+
+def format_checksum(checksum: Any) -> str:
+    """ Возвращает контрольную сумму в шестнадцатеричном виде с префиксом алгоритма, кроме md5 """
+    digest = checksum.hexdigest().lower()
+    return digest if checksum.name == 'md5' else '%s:%s' % (checksum.name, digest)
+
+
+def hash_algorithm(checksum: str) -> str:
+    """ Возвращает алгоритм контрольной суммы. Суммы без префикса - md5 """
+    i = checksum.find(':')
+    return checksum[:i] if i > 0 else 'md5'
+
+
+def is_checksum(checksum: str) -> bool:
+    """ Проверяет, что контрольная сумма известного алгоритма и правильной длины """
+    algorithm = hash_algorithm(checksum)
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        return False
+    digest = checksum[checksum.find(':') + 1:]
+    return len(digest) == new_hash(algorithm).digest_size * 2
+
+
 def md5sum(path: Optional[str],
            input_stream: IO = None, out: IO = None,
            is_stop_watch: bool = True,
-           multiplier: Callable[[], int] = None) -> Any:
+           multiplier: Callable[[], int] = None,
+           algorithm: str = 'md5') -> Any:
     """ Вычисляет контрольную сумму файла в шестнадцатеричном виде """
-    # TODO mmap для чтения из файла?
 
     def md5_by_path():
-        return with_open(path, 'rb', lambda f: md5sum(path, f, out=out, multiplier=multiplier))
+        return with_open(path, 'rb', lambda f: md5sum_mmap(f, out, multiplier, algorithm))
 
     if input_stream is None:
         if not os.path.isfile(path):
             return None
         return stop_watch('md5sum -b %s' % path, md5_by_path) if is_stop_watch else md5_by_path()
+    return md5sum_stream(input_stream, out, multiplier, algorithm)
 
-    checksum = hashlib.md5()
+
+def md5sum_mmap(fd: IO, out: IO = None, multiplier: Callable[[], int] = None, algorithm: str = 'md5') -> str:
+    """ Вычисляет контрольную сумму файла, отображённого в память, без копирования в буферы.
+    Для пустых файлов и файлов, которые нельзя отобразить, читает поток """
+    try:
+        size = os.fstat(fd.fileno()).st_size
+        mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else None
+    except (OSError, ValueError, io.UnsupportedOperation):
+        mapped = None
+    if mapped is None:
+        return md5sum_stream(fd, out, multiplier, algorithm)
+    checksum = new_hash(algorithm)
+    refund = getattr(multiplier, 'refund', None)  # возвращает ограничителю скорости непрочитанную часть блока
+    with mapped, memoryview(mapped) as view:
+        if hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        pos = 0
+        while pos < len(view):
+            n = multiplier() if multiplier is not None else 1024
+            with view[pos:pos + 1024 * n] as buf:
+                checksum.update(buf)
+                if out is not None:
+                    out.write(buf)
+                pos += len(buf)
+                if refund is not None and len(buf) < 1024 * n:
+                    refund(1024 * n - len(buf))
+    return format_checksum(checksum)
+
+
+def md5sum_stream(input_stream: IO, out: IO = None, multiplier: Callable[[], int] = None,
+                  algorithm: str = 'md5') -> str:
+    """ Вычисляет контрольную сумму потока, читая в один переиспользуемый буфер """
+    checksum = new_hash(algorithm)
+    readinto = getattr(input_stream, 'readinto', None)
+    refund = getattr(multiplier, 'refund', None)  # возвращает ограничителю скорости непрочитанную часть блока
+    buf = memoryview(bytearray())
     while True:
-        n = multiplier() if multiplier is not None else 1024
-        buf = input_stream.read(1024 * n)
-        if not buf or len(buf) == 0:
-            return checksum.hexdigest().lower()
-        checksum.update(buf)
+        size = 1024 * (multiplier() if multiplier is not None else 1024)
+        if readinto is None:
+            data = input_stream.read(size)
+            n = len(data) if data else 0
+        else:
+            if len(buf) < size:
+                buf = memoryview(bytearray(size))
+            data = buf[:size]
+            n = readinto(data) or 0
+        if refund is not None and n < size:
+            refund(size - n)
+        if n == 0:
+            return format_checksum(checksum)
+        chunk = data[:n]
+        checksum.update(chunk)
         if out is not None:
-            out.write(buf)
+            out.write(chunk)
+
+
+class PipelineStats:
+    """ Накапливает объём данных и время стадий конвейера. Выводит пропускную способность стадий """
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages = collections.OrderedDict()  # type: Dict[str, List[float]] # стадия: [байты, секунды]
+        self.lock = threading.Lock()
+
+    def add(self, stage: str, size: int, seconds: float) -> None:
+        """ Добавляет к стадии обработанный объём и затраченное время """
+        with self.lock:
+            total = self.stages.setdefault(stage, [0, 0.0])
+            total[0] += size
+            total[1] += seconds
+
+    def log(self, msg: Any) -> None:
+        """ Выводит пропускную способность каждой стадии """
+        mb = 1024.0 * 1024.0
+
+        def stage_info(stage: str, size: float, seconds: float) -> str:
+            if size == 0:
+                return '%s %1.3f sec' % (stage, seconds)
+            return '%s %1.1f MB %1.3f sec %1.1f MB/s' % (stage, size / mb, seconds,
+                                                         size / mb / seconds if seconds > 0 else 0)
+
+        log.info("[%s]: %1.3f sec; %s", msg, time.time() - self.start,
+                 '; '.join(stage_info(stage, size, seconds) for stage, (size, seconds) in self.stages.items()))
+
+
+class ParallelGzip:
+    """ Сжимает поток блоками на нескольких ядрах, zlib освобождает GIL.
+    Каждый блок пишется отдельным членом gzip, результат читается обычным gzip/zcat.
+    Считает контрольную сумму сжатого потока """
+
+    def __init__(self, out: IO, workers: int, algorithm: str = 'md5',
+                 block_size: int = 1024 * 1024, level: int = 6, stats: PipelineStats = None):
+        self.out = out
+        self.stats = stats  # type: Optional[PipelineStats] # время сжатия, ожидания сжатия и записи
+        self.checksum = new_hash(algorithm)
+        self.block_size = block_size
+        self.level = level
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = collections.deque()  # type: Deque[Future] # сжимаемые блоки в порядке записи
+        self.max_pending = 2 * workers  # type: int # ограничивает память под несжатые блоки
+        self.chunks = []  # type: List[bytes] # данные для следующего блока
+        self.size = 0  # type: int
+        self.members = 0  # type: int # число записанных членов gzip
+
+    def write(self, data: Any) -> int:
+        """ Добавляет данные в поток. Полные блоки отдаются на сжатие """
+        n = len(data)
+        self.chunks.append(bytes(data))
+        self.size += n
+        if self.size >= self.block_size:
+            buf = b''.join(self.chunks)
+            end = len(buf) - len(buf) % self.block_size
+            for pos in range(0, end, self.block_size):
+                self.submit(buf[pos:pos + self.block_size])
+            self.chunks = [buf[end:]]
+            self.size = len(buf) - end
+        return n
+
+    def submit(self, block: bytes) -> None:
+        """ Отдаёт блок на сжатие, дожидаясь записи старых блоков при переполнении очереди """
+        while len(self.pending) >= self.max_pending:
+            self.write_member()
+        self.pending.append(self.executor.submit(self.timed_compress, block))
+
+    def write_member(self) -> None:
+        """ Пишет в файл самый старый сжатый блок """
+        start = time.perf_counter()
+        member = self.pending.popleft().result()
+        wait = time.perf_counter()
+        self.checksum.update(member)
+        self.out.write(member)
+        self.members += 1
+        if self.stats is not None:
+            self.stats.add('compress wait', 0, wait - start)
+            self.stats.add('hash+write', len(member), time.perf_counter() - wait)
+
+    def timed_compress(self, block: bytes) -> bytes:
+        """ Сжимает блок, учитывает время сжатия """
+        start = time.perf_counter()
+        member = self.compress(block, self.level)
+        if self.stats is not None:
+            self.stats.add('compress', len(block), time.perf_counter() - start)
+        return member
+
+    @staticmethod
+    def compress(block: bytes, level: int) -> bytes:
+        """ Сжимает блок в отдельный член gzip """
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush()
+
+    def close(self) -> str:
+        """ Дописывает остаток потока. Возвращает контрольную сумму сжатого потока """
+        try:
+            if self.size > 0 or (self.members == 0 and len(self.pending) == 0):
+                self.submit(b''.join(self.chunks))
+            self.chunks, self.size = [], 0
+            while len(self.pending) > 0:
+                self.write_member()
+            return format_checksum(self.checksum)
+        finally:
+            self.executor.shutdown()
 
 
 class GzipMd5sum:
-    """ Сжимает поток, считает контрольную сумму сжатого потока, и пишет в файл """
+    """ Сжимает поток, считает контрольную сумму сжатого потока, и пишет в файл.
+    Сжимает в workers потоков, или внешним gzip, если workers == 0 """
 
-    def __init__(self, path: str):
+    def __init__(self, path: str, algorithm: str = 'md5', workers: int = 0, level: int = 6):
         self.path = path
+        self.algorithm = algorithm
+        self.workers = workers
+        self.level = level
 
     def __call__(self, input_stream: IO):
         with open(self.path, "wb") as out:
-            return system_hidden(["gzip"], lambda stdout: md5sum(None, stdout, out), input_stream)
+            if self.workers <= 0:
+                return system_hidden(["gzip"],
+                                     lambda stdout: md5sum(None, stdout, out, algorithm=self.algorithm),
+                                     input_stream)
+            gzip = ParallelGzip(out, self.workers, self.algorithm, level=self.level)
+            try:
+                while True:
+                    buf = input_stream.read(gzip.block_size)
+                    if not buf:
+                        break
+                    gzip.write(buf)
+            finally:
+                checksum = gzip.close()
+            return checksum
+
+
+class TimedReader:
+    """ Читает файл известного размера и учитывает время чтения.
+    Если файл укоротился во время чтения, дополняет его нулями, как GNU tar """
+
+    def __init__(self, fd: IO, size: int, stats: PipelineStats, name: str):
+        self.fd = fd
+        self.remaining = size
+        self.stats = stats
+        self.name = name
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        start = time.perf_counter()
+        data = self.fd.read(size)
+        self.stats.add('read', len(data), time.perf_counter() - start)
+        if len(data) < size:
+            log.warning('%s: file changed as we read it', self.name)
+            data += bytes(size - len(data))
+        self.remaining -= len(data)
+        return data
+
+
+class TarGzipMd5sum:
+    """ Архивирует директорию в tar.gz в одном процессе: обход дерева, tar, сжатие и подсчёт
+    контрольной суммы идут одним конвейером с ограниченными буферами """
+
+    MANIFEST = '.backup-manifest.json'  # член разностного архива: полный архив и удалённые файлы
+
+    def __init__(self, path: str, algorithm: str = 'md5', workers: int = 1, level: int = 6,
+                 base: Optional[Dict[str, List[int]]] = None, full: Optional[str] = None,
+                 chunks: Optional[str] = None):
+        self.path = path
+        self.algorithm = algorithm
+        self.workers = workers
+        self.level = level
+        self.base = base  # type: Optional[Dict[str, List[int]]] # индекс полного архива, None - полный архив
+        self.full = full  # type: Optional[str] # имя полного архива, от которого строится разностный
+        self.chunks = chunks  # type: Optional[str] # директория ChunkStore, None - обычный tar.gz
+        self.index = {}  # type: Dict[str, List[int]] # [размер, mtime_ns] файлов по именам в архиве
+        self.checksums = {}  # type: Dict[str, str] # контрольные суммы новых блоков ChunkStore по путям
+
+    def __call__(self, src: str) -> str:
+        """ Архивирует директорию src, возвращает контрольную сумму архива.
+        Если задан индекс полного архива, пишет только новые и изменённые файлы и манифест с удалёнными.
+        Если задано хранилище блоков, пишет блоки в хранилище, а в self.path - рецепт архива """
+        stats = PipelineStats()
+        self.index = {}
+        if self.chunks is None:
+            try:
+                with open(self.path, 'wb') as out:
+                    gzip = ParallelGzip(out, self.workers, self.algorithm, level=self.level, stats=stats)
+                    try:
+                        self.write_tar(tarfile.open(fileobj=gzip, mode='w|', format=tarfile.GNU_FORMAT), src, stats)
+                    finally:
+                        checksum = gzip.close()
+            except BaseException:
+                # недописанный архив не должен остаться на месте резервной копии
+                remove_file(self.path)
+                raise
+        else:
+            store = ChunkStore(self.chunks, self.algorithm, self.workers, self.level, stats)
+            try:
+                writer = ChunkWriter(store)
+                self.write_tar(tarfile.open(fileobj=writer, mode='w', format=tarfile.GNU_FORMAT), src, stats, writer)
+                writer.close()
+            finally:
+                recipe = store.close()
+            self.checksums = store.checksums
+            checksum = self.write_recipe(recipe)
+        stats.log('tar czf %s %s' % (self.path, src))
+        return checksum
+
+    def write_tar(self, tar: tarfile.TarFile, src: str, stats: PipelineStats,
+                  writer: Optional['ChunkWriter'] = None) -> None:
+        """ Пишет директорию в архив, отмечая для ChunkWriter границы членов архива """
+        with tar:
+            for path, arcname in self.walk(src):
+                if self.changed(path, arcname):
+                    if writer is not None:
+                        writer.start_member(self.index.get(arcname, [0])[0])
+                    if not self.add(tar, path, arcname, stats):
+                        # пропущенный файл не должен попасть в индекс, иначе разностный архив его не добавит
+                        self.index.pop(arcname, None)
+                    if writer is not None:
+                        writer.end_member()
+            if self.base is not None:
+                self.add_manifest(tar)
+
+    def write_recipe(self, recipe: List[str]) -> str:
+        """ Пишет рецепт: пути блоков относительно директории хранилища, по порядку.
+        Возвращает контрольную сумму рецепта """
+        data = ''.join(name + '\n' for name in recipe).encode('UTF-8')
+        with open(self.path, 'wb') as fd:
+            fd.write(data)
+        checksum = new_hash(self.algorithm)
+        checksum.update(data)
+        return format_checksum(checksum)
+
+    def changed(self, path: str, arcname: str) -> bool:
+        """ Запоминает файл в индексе. Возвращает True, если его нужно добавить в архив """
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return True
+        if stat.S_ISDIR(st.st_mode):
+            return True
+        self.index[arcname] = [st.st_size, st.st_mtime_ns]
+        return self.base is None or self.base.get(arcname) != self.index[arcname]
+
+    def add_manifest(self, tar: tarfile.TarFile) -> None:
+        """ Добавляет в разностный архив манифест: полный архив и файлы, удалённые после него """
+        data = json.dumps({'version': 1, 'full': self.full,
+                           'deleted': sorted(set(self.base) - set(self.index))}).encode('UTF-8')
+        info = tarfile.TarInfo(self.MANIFEST)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(data))
+
+    @staticmethod
+    def walk(src: str) -> Iterable[Tuple[str, str]]:
+        """ Обходит дерево в глубину, не переходя по символическим ссылкам.
+        Возвращает пути и имена в архиве, родительская директория идёт раньше дочерних """
+        stack = [(src, os.path.basename(src))]
+        while len(stack) > 0:
+            path, arcname = stack.pop()
+            yield path, arcname
+            if os.path.isdir(path) and not os.path.islink(path):
+                try:
+                    with os.scandir(path) as it:
+                        names = sorted(entry.name for entry in it)
+                except OSError as e:
+                    log.warning('%s: %s', path, e)
+                    continue
+                stack.extend((path + '/' + name, arcname + '/' + name) for name in reversed(names))
+
+    @staticmethod
+    def add(tar: tarfile.TarFile, path: str, arcname: str, stats: PipelineStats) -> bool:
+        """ Добавляет файл в архив. Пропускает исчезнувшие и нечитаемые файлы, как GNU tar.
+        Ошибки после начала записи члена прерывают архив: поток tar уже испорчен.
+        Возвращает False, если файл пропущен """
+        try:
+            info = tar.gettarinfo(path, arcname)
+            fd = open(path, 'rb') if info is not None and info.isreg() else None
+        except OSError as e:
+            log.warning('%s: %s', path, e)
+            return False
+        if info is None:
+            log.warning('%s: socket ignored', path)
+            return False
+        if fd is not None:
+            with fd:
+                tar.addfile(info, TimedReader(fd, info.size, stats, path))
+        else:
+            tar.addfile(info)
+        return True
+
+
+class ChunkStore:
+    """ Хранилище блоков по содержимому: <директория>/.chunks/<ab>/<sha256>.gz.
+    Каждый блок - отдельный член gzip, поэтому блоки рецепта, склеенные по порядку, дают архив tar.gz.
+    Блоки, которые уже есть в хранилище, не сжимаются и не пишутся повторно """
+
+    DIR = '.chunks'
+
+    def __init__(self, root: str, algorithm: str = 'md5', workers: int = 1, level: int = 6,
+                 stats: PipelineStats = None):
+        self.root = root
+        self.algorithm = algorithm
+        self.level = level
+        self.stats = stats  # type: Optional[PipelineStats]
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+        self.pending = collections.deque()  # type: Deque[Future] # блоки в порядке рецепта
+        self.max_pending = 2 * max(workers, 1)  # type: int # ограничивает память под несжатые блоки
+        self.recipe = []  # type: List[str] # пути блоков относительно root, по порядку
+        self.checksums = {}  # type: Dict[str, str] # контрольные суммы новых файлов блоков по путям
+
+    @classmethod
+    def name(cls, chunk_id: str) -> str:
+        """ Возвращает путь блока относительно директории хранилища """
+        return '%s/%s/%s.gz' % (cls.DIR, chunk_id[:2], chunk_id)
+
+    def put(self, block: bytes) -> None:
+        """ Отдаёт блок на сохранение, дожидаясь старых блоков при переполнении очереди """
+        while len(self.pending) >= self.max_pending:
+            self.collect()
+        self.pending.append(self.executor.submit(self.store, block))
+
+    def store(self, block: bytes) -> Tuple[str, Optional[str]]:
+        """ Сохраняет блок, если его нет в хранилище. Возвращает путь блока и контрольную сумму нового файла """
+        start = time.perf_counter()
+        name = self.name(hashlib.sha256(block).hexdigest())
+        path = self.root + '/' + name
+        if os.path.isfile(path):
+            if self.stats is not None:
+                self.stats.add('dedup', len(block), time.perf_counter() - start)
+            return name, None
+        member = ParallelGzip.compress(block, self.level)
+        checksum = new_hash(self.algorithm)
+        checksum.update(member)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.tmp%d' % (path, threading.get_ident())
+        with open(tmp, 'wb') as fd:
+            fd.write(member)
+        os.replace(tmp, path)
+        if self.stats is not None:
+            self.stats.add('chunk', len(block), time.perf_counter() - start)
+        return name, format_checksum(checksum)
+
+    def collect(self) -> None:
+        """ Дожидается самого старого блока и дописывает его в рецепт """
+        name, checksum = self.pending.popleft().result()
+        self.recipe.append(name)
+        if checksum is not None:
+            self.checksums[self.root + '/' + name] = checksum
+
+    def close(self) -> List[str]:
+        """ Дожидается сохранения всех блоков. Возвращает рецепт """
+        try:
+            while len(self.pending) > 0:
+                self.collect()
+        finally:
+            self.executor.shutdown()
+        return self.recipe
+
+
+class ChunkWriter:
+    """ Поток tar для ChunkStore. Режет поток по границам членов tar, выбранным по содержимому членов,
+    а большие члены - на блоки фиксированного размера от начала члена.
+    Решение резать после члена зависит только от самого члена, поэтому изменение малого файла меняет блок
+    с этим файлом (он может слиться со следующим или разделиться на два) и последний блок с концом архива tar.
+    Остальные блоки совпадают с блоками прошлых архивов """
+
+    def __init__(self, store: ChunkStore, block_size: int = 4 * 1024 * 1024, large: int = 1024 * 1024,
+                 members: int = 16):
+        self.store = store
+        self.block_size = block_size  # type: int # наибольший размер блока
+        self.large = large  # type: int # члены не меньше этого размера занимают отдельные блоки
+        self.members = members  # type: int # среднее число малых членов в блоке
+        self.chunks = []  # type: List[bytes] # данные текущего блока
+        self.size = 0  # type: int # размер текущего блока
+        self.offset = 0  # type: int # позиция в потоке tar
+        self.digest = hashlib.blake2b(digest_size=8)  # хэш текущего члена, выбирает границы блоков
+        self.member_large = False  # type: bool
+
+    def write(self, data: Any) -> int:
+        """ Добавляет данные в текущий блок, полные блоки отдаёт в хранилище """
+        n = len(data)
+        self.chunks.append(bytes(data))
+        self.size += n
+        self.offset += n
+        self.digest.update(data)
+        if self.size >= self.block_size:
+            buf = b''.join(self.chunks)
+            end = len(buf) - len(buf) % self.block_size
+            for pos in range(0, end, self.block_size):
+                self.store.put(buf[pos:pos + self.block_size])
+            self.chunks = [buf[end:]]
+            self.size = len(buf) - end
+        return n
+
+    def tell(self) -> int:
+        return self.offset
+
+    def start_member(self, size: int) -> None:
+        """ Начинает член архива. Большой член начинается с нового блока """
+        self.digest = hashlib.blake2b(digest_size=8)
+        self.member_large = size >= self.large
+        if self.member_large:
+            self.cut()
+
+    def end_member(self) -> None:
+        """ Заканчивает член архива. Режет поток после большого члена, или если так выпал хэш члена """
+        if self.member_large or int.from_bytes(self.digest.digest(), 'big') % self.members == 0:
+            self.cut()
+
+    def cut(self) -> None:
+        """ Отдаёт текущий блок в хранилище """
+        if self.size > 0:
+            self.store.put(b''.join(self.chunks))
+        self.chunks, self.size = [], 0
+
+    def close(self) -> None:
+        """ Отдаёт остаток потока в хранилище """
+        self.cut()
 
 
 def write_md5(file: IO, checksum: str, name: str) -> None:
@@ -105,7 +636,7 @@ def write_md5(file: IO, checksum: str, name: str) -> None:
 
 
 def load_md5(path: str) -> Dict[str, str]:
-    """ Возвращает множество контрольных сумм из файла """
+    """ Возвращает множество контрольных сумм из файла. Суммы неизвестных алгоритмов пропускаются """
     pattern = re.compile(r"^(\S+)\s+\*(.+)$")
     lines = dict()
     if os.path.isfile(path):
@@ -113,7 +644,11 @@ def load_md5(path: str) -> Dict[str, str]:
             for line in fd:
                 m = pattern.match(line)
                 if m is not None:
-                    lines[m.group(2)] = m.group(1).lower()
+                    checksum = m.group(1).lower()
+                    if hash_algorithm(checksum) in CHECKSUM_ALGORITHMS:
+                        lines[m.group(2)] = checksum
+                    else:
+                        log.warning('%s: unknown checksum algorithm of %s', path, m.group(2))
     return lines
 
 
@@ -131,8 +666,8 @@ def load_md5_with_times(path: str) -> Dict[str, Tuple[str, float]]:
                 try:
                     t = time_from_string(m.group(2))
                     checksum = str(m.group(1).lower())
-                    if len(checksum) == 32:
-                      result[m.group(3)] = (checksum, t)
+                    if is_checksum(checksum):
+                        result[m.group(3)] = (checksum, t)
                 except ValueError:
                     pass
         return result
@@ -140,15 +675,282 @@ def load_md5_with_times(path: str) -> Dict[str, Tuple[str, float]]:
     return with_open(path, 'r', read)
 
 
+def write_checksum_record(fd: IO, name: str, checksum: str, sum_time: float) -> None:
+    """ Пишет одну запись двоичного журнала контрольных сумм. Заголовок пишется в начало пустого файла """
+    if fd.tell() == 0:
+        fd.write(CHECKSUM_LOG_MAGIC)
+    index, digest = CHECKSUM_LOG_INVALID, b''
+    if is_checksum(checksum):
+        index = CHECKSUM_ALGORITHMS.index(hash_algorithm(checksum))
+        digest = bytes.fromhex(checksum[checksum.find(':') + 1:])
+    key = bytes(name, 'UTF-8')
+    record = CHECKSUM_LOG_RECORD.pack(sum_time, index, len(key)) + digest + key
+    fd.write(CHECKSUM_LOG_MARK + record + CHECKSUM_LOG_CRC.pack(zlib.crc32(record)))
+
+
+def load_checksum_log(path: str) -> Dict[str, Tuple[str, float]]:
+    """ Возвращает контрольные суммы и время их подсчёта из двоичного журнала.
+    Оборванные записи пропускаются, чтение продолжается со следующей метки """
+    if not os.path.isfile(path):
+        return {}
+    data = with_open(path, 'rb', lambda fd: fd.read())
+    if not data.startswith(CHECKSUM_LOG_MAGIC):
+        return {}
+    sizes = [new_hash(algorithm).digest_size for algorithm in CHECKSUM_ALGORITHMS]
+    result = {}
+    offset = data.find(CHECKSUM_LOG_MARK, len(CHECKSUM_LOG_MAGIC))
+    while 0 <= offset:
+        head = offset + len(CHECKSUM_LOG_MARK)
+        end = head + CHECKSUM_LOG_RECORD.size
+        if end <= len(data):
+            sum_time, index, length = CHECKSUM_LOG_RECORD.unpack_from(data, head)
+            size = sizes[index] if index < len(sizes) else 0
+            end += size + length
+            if (index < len(sizes) or index == CHECKSUM_LOG_INVALID) and end + CHECKSUM_LOG_CRC.size <= len(data) \
+                    and CHECKSUM_LOG_CRC.unpack_from(data, end)[0] == zlib.crc32(data[head:end]):
+                if index < len(sizes):
+                    digest = data[end - length - size:end - length].hex()
+                    name = data[end - length:end].decode('UTF-8', 'surrogateescape')
+                    result[name] = (digest if index == 0 else '%s:%s' % (CHECKSUM_ALGORITHMS[index], digest),
+                                    sum_time)
+                offset = end + CHECKSUM_LOG_CRC.size
+                if not data.startswith(CHECKSUM_LOG_MARK, offset):
+                    offset = data.find(CHECKSUM_LOG_MARK, offset)
+                continue
+        offset = data.find(CHECKSUM_LOG_MARK, offset + 1)
+    return result
+
+
+class ChecksumCatalog:
+    """ Каталог контрольных сумм в SQLite.
+    Для каждого файла хранит сумму, время её проверки, размер и время модификации файла.
+    Запись действительна, пока размер и время модификации файла не изменились """
+
+    def __init__(self, path: str):
+        mkdirs(os.path.dirname(path))
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS checksums ('
+                                    'directory TEXT NOT NULL, name TEXT NOT NULL, checksum TEXT NOT NULL, '
+                                    'verified REAL NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL, '
+                                    'PRIMARY KEY (directory, name))')
+
+    def load(self, directory: str) -> Dict[str, Tuple[str, float, int, float]]:
+        """ Возвращает записи директории: {имя: (сумма, время проверки, размер, время модификации)} """
+        with self.lock:
+            rows = self.connection.execute('SELECT name, checksum, verified, size, mtime FROM checksums '
+                                           'WHERE directory = ?', (directory,)).fetchall()
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def directories(self, prefix: str) -> List[str]:
+        """ Возвращает директории каталога внутри prefix """
+        with self.lock:
+            rows = self.connection.execute('SELECT DISTINCT directory FROM checksums '
+                                           'WHERE directory = ? OR substr(directory, 1, ?) = ?',
+                                           (prefix, len(prefix) + 1, prefix + '/')).fetchall()
+        return sorted(row[0] for row in rows)
+
+    def update(self, directory: str, rows: Iterable[Tuple[str, str, float, int, float]],
+               removed: Iterable[str] = ()) -> None:
+        """ Записывает строки (имя, сумма, время проверки, размер, время модификации), удаляет removed """
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM checksums WHERE directory = ? AND name = ?',
+                                        [(directory, name) for name in removed])
+            self.connection.executemany('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)',
+                                        [(directory,) + tuple(row) for row in rows])
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+class HashCache:
+    """ Кэш контрольных сумм по отпечатку файла (устройство, inode, размер, mtime_ns).
+    Неизменённые архивы не перечитываются, полная проверка остаётся за командой checks.
+    Отпечатки, не использованные max_days дней, удаляются при сохранении """
+
+    def __init__(self):
+        self.path = None  # type: Optional[str] # файл кэша, None - кэш только в памяти
+        self.entries = {}  # type: Dict[str, str] # контрольные суммы по отпечаткам
+        self.times = {}  # type: Dict[str, float] # время последнего использования отпечатков
+        self.max_days = 30  # type: float # сколько дней хранить неиспользуемые отпечатки
+        self.lock = threading.Lock()
+
+    def load(self, path: str) -> None:
+        """ Читает кэш из файла. Отпечаткам кэша версии 1 без времени назначает текущее время """
+        self.path = path
+        try:
+            with open(path, encoding='UTF-8') as fd:
+                data = json.load(fd)
+            self.entries = data.get('entries', {})
+            times = data.get('times', {})
+        except (IOError, ValueError, AttributeError):
+            self.entries, times = {}, {}
+        now = time.time()
+        self.times = {fingerprint: times.get(fingerprint, now) for fingerprint in self.entries}
+
+    def save(self) -> None:
+        """ Сохраняет в файл отпечатки, использованные за последние max_days дней """
+        if self.path is None:
+            return
+        oldest = time.time() - self.max_days * 24 * 3600
+        with self.lock:
+            times = {fingerprint: used for fingerprint, used in self.times.items() if used >= oldest}
+            entries = {fingerprint: self.entries[fingerprint] for fingerprint in times}
+        mkdirs(os.path.dirname(self.path))
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='UTF-8') as fd:
+            json.dump({'version': 2, 'entries': entries, 'times': times}, fd)
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def fingerprint(path: str) -> Optional[str]:
+        """ Возвращает отпечаток файла, или None, если файла нет """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return '%d:%d:%d:%d' % (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def md5sum(self, path: str, algorithm: str = 'md5') -> Optional[str]:
+        """ Возвращает контрольную сумму из кэша, или вычисляет её, если файл изменился """
+        fingerprint = self.fingerprint(path)
+        if fingerprint is None:
+            return None
+        with self.lock:
+            checksum = self.entries.get(fingerprint)
+        if checksum is None or hash_algorithm(checksum) != algorithm:
+            checksum = md5sum(path, algorithm=algorithm)
+            if checksum is None:
+                return None
+        with self.lock:
+            self.entries[fingerprint] = checksum
+            self.times[fingerprint] = time.time()
+        return checksum
+
+    def put(self, path: str, checksum: str) -> None:
+        """ Запоминает контрольную сумму только что записанного файла """
+        fingerprint = self.fingerprint(path)
+        if fingerprint is not None and checksum is not None:
+            with self.lock:
+                self.entries[fingerprint] = checksum
+                self.times[fingerprint] = time.time()
+
+
+class SourceManifest:
+    """ Снимок исходной директории: mtime каталогов, размер и mtime файлов, найденные способы копирования.
+    Каталоги с прежним mtime не перечитываются, их файлы только проверяются через stat:
+    правка файла на месте не меняет mtime каталога. Удаления и переименования видны по отличию снимков """
+
+    def __init__(self):
+        self.path = None  # type: Optional[str] # файл снимка, None - снимок только в памяти
+        self.dirs = {}  # type: Dict[str, Dict[str, Any]] # снимок прошлого запуска по относительным путям
+        self.snapshot = {}  # type: Dict[str, Dict[str, Any]] # снимок этого запуска
+        self.loaded = False  # type: bool # прошлый снимок прочитан
+        self.last_modified = -1  # type: float # последнее время модификации файлов
+
+    def load(self, path: str) -> None:
+        """ Читает снимок прошлого запуска """
+        self.path = path
+        try:
+            with open(path, encoding='UTF-8') as fd:
+                data = json.load(fd)
+            self.dirs = data['dirs'] if data.get('version') == 1 else {}
+            self.loaded = data.get('version') == 1
+        except (IOError, ValueError, AttributeError, KeyError):
+            self.dirs = {}
+            self.loaded = False
+
+    def save(self) -> None:
+        """ Сохраняет снимок этого запуска """
+        if self.path is None:
+            return
+        mkdirs(os.path.dirname(self.path))
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='UTF-8') as fd:
+            json.dump({'version': 1, 'dirs': self.snapshot}, fd)
+        os.replace(tmp, self.path)
+
+    def changed(self) -> bool:
+        """ Возвращает True, если дерево отличается от прошлого снимка. Без прошлого снимка - False """
+        return self.loaded and self.snapshot != self.dirs
+
+    def walk(self, path: str, find_strategy: Callable[[str], Optional[str]]) -> List[Tuple[str, str]]:
+        """ Обходит дерево без рекурсии, в глубину, в порядке имён. Запоминает снимок и last_modified.
+        find_strategy вызывается только для новых и изменённых каталогов, в каталоги со способом не заходит.
+        Возвращает найденные каталоги со способами копирования: (каталог, имя способа) """
+        found = []  # type: List[Tuple[str, str]]
+        self.snapshot = {}
+        self.last_modified = -1
+        # относительный путь, stat каталога, (st_dev, st_ino) открытых выше каталогов - защита от циклов
+        stack = [('', os.stat(path), ())]  # type: List[Tuple[str, os.stat_result, Tuple[Tuple[int, int], ...]]]
+        while len(stack) > 0:
+            rel, st, opened = stack.pop()
+            directory = path + '/' + rel if rel != '' else path
+            key = (st.st_dev, st.st_ino)
+            if key in opened:
+                log.warning('%s: directory loop ignored', directory)
+                continue
+            old = self.dirs.get(rel)
+            if old is not None and old.get('mtime') == st.st_mtime_ns:
+                strategy, files, dirs = self.reuse(directory, old)
+            else:
+                strategy = find_strategy(directory)
+                files, dirs = self.scan(directory) if strategy is None else ({}, {})
+            self.snapshot[rel] = {'mtime': st.st_mtime_ns, 'strategy': strategy,
+                                  'files': files, 'dirs': sorted(dirs)}
+            if strategy is not None:
+                found.append((directory, strategy))
+                continue
+            for size, mtime in files.values():
+                if mtime / 1e9 > self.last_modified:
+                    self.last_modified = mtime / 1e9
+            for name in sorted(dirs, reverse=True):
+                stack.append((rel + '/' + name if rel != '' else name, dirs[name], opened + (key,)))
+        return found
+
+    @staticmethod
+    def scan(directory: str) -> Tuple[Dict[str, List[int]], Dict[str, os.stat_result]]:
+        """ Читает каталог: файлы {имя: [размер, mtime_ns]} и подкаталоги {имя: stat} """
+        files = {}  # type: Dict[str, List[int]]
+        dirs = {}  # type: Dict[str, os.stat_result]
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir():
+                    dirs[entry.name] = entry.stat()
+                elif entry.is_file():
+                    st = entry.stat()
+                    files[entry.name] = [st.st_size, st.st_mtime_ns]
+        return files, dirs
+
+    @staticmethod
+    def reuse(directory: str, old: Dict[str, Any]) \
+            -> Tuple[Optional[str], Dict[str, List[int]], Dict[str, os.stat_result]]:
+        """ Берёт состав неизменённого каталога из прошлого снимка, обновляя stat файлов и подкаталогов """
+        files = {}  # type: Dict[str, List[int]]
+        dirs = {}  # type: Dict[str, os.stat_result]
+        for name in old.get('files', {}):
+            try:
+                st = os.stat(directory + '/' + name)
+            except FileNotFoundError:
+                continue
+            files[name] = [st.st_size, st.st_mtime_ns]
+        for name in old.get('dirs', []):
+            try:
+                dirs[name] = os.stat(directory + '/' + name)
+            except FileNotFoundError:
+                continue
+        return old.get('strategy'), files, dirs
+
+
 def mkdirs(path):
     """  Создаёт вложенные директории.
-    Если директории уже существуют, ничего не делает """
+    Если директории уже существуют, ничего не делает. Безопасна при одновременном вызове из нескольких потоков """
     log.debug("mkdirs(%s)", path)
-    if os.path.exists(path):
-        return
-    mkdirs(os.path.dirname(path))
-    if not os.path.exists(path):
-        os.mkdir(path)
+    if path != '':
+        os.makedirs(path, exist_ok=True)
 
 
 def read_line(file):
@@ -219,6 +1021,300 @@ def system_hidden(command: Sequence[str],
     return res
 
 
+class WorkerPool:
+    """ Ограниченный пул потоков для каждой целевой директории.
+    hashlib и файловый ввод-вывод освобождают GIL, поэтому потоки загружают несколько ядер """
+
+    def __init__(self, default: int = 1):
+        self.default = default  # type: int # число потоков для директорий без явной настройки
+        self.workers = {}  # type: Dict[str, int] # число потоков по целевым директориям
+        self.executors = {}  # type: Dict[Optional[str], ThreadPoolExecutor]
+        self.lock = threading.Lock()
+
+    def configure(self, workers: Any) -> None:
+        """ Настраивает число потоков: число для всех директорий или словарь {директория: число} """
+        if isinstance(workers, dict):
+            self.workers = {d.rstrip('/'): int(n) for d, n in workers.items()}
+        elif workers is not None:
+            self.default = int(workers)
+
+    def root(self, path: str) -> Optional[str]:
+        """ Возвращает настроенную директорию, которой принадлежит путь """
+        result = None
+        for directory in self.workers:
+            if (path == directory or path.startswith(directory + '/')) \
+                    and (result is None or len(directory) > len(result)):
+                result = directory
+        return result
+
+    def count(self, path: str) -> int:
+        """ Возвращает число потоков директории """
+        return self.workers.get(self.root(path), self.default)
+
+    def executor(self, path: str) -> Optional[ThreadPoolExecutor]:
+        """ Возвращает пул потоков директории, или None, если вычислять нужно в текущем потоке """
+        root = self.root(path)
+        workers = self.count(path)
+        if workers <= 1:
+            return None
+        with self.lock:
+            executor = self.executors.get(root)
+            if executor is None:
+                executor = self.executors[root] = ThreadPoolExecutor(max_workers=workers)
+            return executor
+
+    def map(self, func: Callable[[Any], Any], items: Sequence[Any],
+            path: Callable[[Any], str] = lambda item: item) -> List[Any]:
+        """ Вызывает func для каждого элемента. Возвращает результаты в исходном порядке """
+        futures = []  # type: List[Optional[Future]]
+        for item in items:
+            executor = self.executor(path(item))
+            futures.append(executor.submit(func, item) if executor is not None else None)
+        results = [None] * len(items)  # type: List[Any]
+        errors = {}  # type: Dict[int, BaseException] # исключения по индексам элементов
+        for i, future in enumerate(futures):
+            if future is None and len(errors) == 0:
+                try:
+                    results[i] = func(items[i])
+                except BaseException as e:
+                    errors[i] = e
+        # исключение пробрасывается только после завершения всех потоков, чтоб они не писали в общие данные
+        wait([future for future in futures if future is not None])
+        for i, future in enumerate(futures):
+            if future is not None:
+                if future.exception() is not None:
+                    errors[i] = future.exception()
+                else:
+                    results[i] = future.result()
+        if len(errors) > 0:
+            raise errors[min(errors)]
+        return results
+
+    def shutdown(self) -> None:
+        """ Останавливает потоки """
+        with self.lock:
+            for executor in self.executors.values():
+                executor.shutdown()
+            self.executors = {}
+
+
+class RateLimiter:
+    """ Ограничивает скорость чтения token bucket'ом, скорость в МБайт/с задаётся по часам суток.
+    В часы с ограничением снижает скорость, если /proc/pressure/io показывает ожидание ввода-вывода,
+    или /proc/diskstats - чужой ввод-вывод на дисках целевых директорий.
+    Вызывается перед каждым блоком как multiplier для md5sum, возвращает размер блока в кБайтах.
+    Часы, не указанные в расписании, ограничиваются базовой скоростью self.rate """
+
+    DEFAULT_RATE = 0.4  # МБайт/с, как прежние 4 кБайт за 10 ms
+
+    def __init__(self, rate: Any = DEFAULT_RATE):
+        self.rate = self.DEFAULT_RATE  # type: float # базовая скорость в МБайт/с, 0 - без ограничения
+        self.schedule = []  # type: List[Tuple[int, int, float]] # (с часа, до часа, МБайт/с), 0 - без ограничения
+        self.pressure = 20.0  # type: float # доля ожидания ввода-вывода в %, выше которой скорость снижается
+        self.busy = 20.0  # type: float # чужой ввод-вывод в МБайт/с, выше которого скорость снижается
+        self.devices = set()  # type: Set[Tuple[int, int]] # (major, minor) дисков целевых директорий
+        self.tokens = 0.0  # type: float # байты, которые можно прочитать без ожидания
+        self.last = time.monotonic()  # type: float
+        self.used = 0  # type: int # прочитано байт
+        self.factor = 1.0  # type: float # снижение скорости по нагрузке
+        self.feedback = None  # type: Optional[Tuple[float, int, int]] # время, байты дисков, прочитано байт
+        self.lock = threading.Lock()
+        self.configure(rate)
+
+    def configure(self, rate: Any, pressure: Any = None, busy: Any = None, paths: Iterable[str] = ()) -> None:
+        """ Настраивает скорость: число МБайт/с, или словарь {"с-до": МБайт/с} по часам суток.
+        Ключ "default" словаря задаёт базовую скорость часов вне расписания """
+        if isinstance(rate, dict):
+            self.schedule = []
+            for hours, value in rate.items():
+                if hours == 'default':
+                    self.rate = float(value)
+                    continue
+                start, stop = hours.split('-')
+                self.schedule.append((int(start), int(stop), float(value)))
+        elif rate is not None:
+            self.rate = float(rate)
+            self.schedule = []
+        if pressure is not None:
+            self.pressure = float(pressure)
+        if busy is not None:
+            self.busy = float(busy)
+        for path in paths:
+            try:
+                st_dev = os.stat(path).st_dev
+                self.devices.add((os.major(st_dev), os.minor(st_dev)))
+            except OSError:
+                pass
+
+    def scheduled_rate(self) -> float:
+        """ Возвращает скорость в МБайт/с для текущего часа, 0 - без ограничения """
+        hour = time.localtime().tm_hour
+        for start, stop, rate in self.schedule:
+            if start <= hour < stop if start <= stop else hour >= start or hour < stop:
+                return rate
+        return self.rate
+
+    def __call__(self) -> int:
+        """ Ждёт, пока накопится блок, и возвращает его размер в кБайтах """
+        rate = self.scheduled_rate() * 1024 * 1024
+        if rate <= 0:
+            with self.lock:
+                self.used += 1024 * 1024
+            return 1024
+        rate *= self.load_factor()
+        block = int(min(1024 * 1024, max(64 * 1024, rate / 10))) // 1024 * 1024
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.last) * rate, block)
+            self.last = now
+            self.tokens -= block
+            self.used += block
+            wait = -self.tokens / rate
+        if wait > 0:
+            time.sleep(wait)
+        return block // 1024
+
+    def refund(self, size: int) -> None:
+        """ Возвращает непрочитанную часть блока: конец файла оказался ближе размера блока """
+        with self.lock:
+            self.used -= size
+            if self.scheduled_rate() > 0:
+                self.tokens += size
+
+    def load_factor(self) -> float:
+        """ Возвращает во сколько раз снизить скорость по нагрузке. Пересчитывает не чаще раза в секунду.
+        Ожидание ввода-вывода включает и собственное чтение, поэтому оно делится пропорционально чужому объёму
+        по /proc/diskstats. Снижение сразу, восстановление постепенно, а между pressure / 2 и pressure
+        скорость не меняется, чтоб не раскачиваться от собственной нагрузки """
+        now = time.monotonic()
+        with self.lock:
+            if self.feedback is not None and now - self.feedback[0] < 1:
+                return self.factor
+            used = self.used
+        pressure = self.read_pressure()
+        disk = self.read_disk_bytes()
+        with self.lock:
+            factor = min(1.0, self.factor * 1.25)
+            if disk is not None and self.feedback is not None and now > self.feedback[0]:
+                own = (used - self.feedback[2]) / (now - self.feedback[0])
+                other = max(0.0, (disk - self.feedback[1]) / (now - self.feedback[0]) - own)
+                if other > self.busy * 1024 * 1024:
+                    factor = min(factor, self.busy * 1024 * 1024 / other)
+                if pressure is not None and other + own > 0:
+                    pressure *= other / (other + own)
+            elif disk is not None:
+                pressure = None  # первый замер дисков: ожидание ещё не с чем разделить
+            if pressure is not None and pressure > self.pressure:
+                factor = min(factor, self.factor * self.pressure / pressure)
+            elif pressure is not None and pressure > self.pressure / 2:
+                factor = min(factor, self.factor)
+            self.feedback = (now, disk or 0, used)
+            self.factor = max(factor, 0.05)
+            return self.factor
+
+    @staticmethod
+    def read_pressure() -> Optional[float]:
+        """ Возвращает долю ожидания ввода-вывода за 10 секунд в %, или None, если PSI недоступен """
+        try:
+            with open('/proc/pressure/io', encoding='UTF-8') as fd:
+                for line in fd:
+                    if line.startswith('some '):
+                        return float(line.split()[1].split('=')[1])
+        except (IOError, ValueError, IndexError):
+            pass
+        return None
+
+    def read_disk_bytes(self) -> Optional[int]:
+        """ Возвращает число прочитанных и записанных байт дисков целевых директорий, или None """
+        if len(self.devices) == 0:
+            return None
+        try:
+            total = 0
+            with open('/proc/diskstats', encoding='UTF-8') as fd:
+                for line in fd:
+                    fields = line.split()
+                    if (int(fields[0]), int(fields[1])) in self.devices:
+                        total += (int(fields[5]) + int(fields[9])) * 512
+            return total
+        except (IOError, ValueError, IndexError):
+            return None
+
+
+class ScrubPlanner:
+    """ Очередь проверки checks: файлы всех целевых директорий в порядке давности последней проверки.
+    Отобранные по бюджету файлы раскладываются в кучи по дискам, чтоб зеркала на разных дисках проверялись
+    одновременно """
+
+    def __init__(self):
+        # (время проверки, размер, директория, имя, сумма, диск)
+        self.heap = []  # type: List[Tuple[float, int, str, str, str, int]]
+        self.heaps = {}  # type: Dict[int, List[Tuple[float, int, str, str, str, int]]] # отобранные файлы по дискам
+        self.count = 0  # type: int # проверено файлов
+        self.size = 0  # type: int # проверено байт
+        self.lock = threading.Lock()
+
+    def push(self, sum_time: float, size: int, directory: str, name: str, checksum: str, device: int) -> None:
+        """ Добавляет файл в общую кучу """
+        heapq.heappush(self.heap, (sum_time, size, directory, name, checksum, device))
+
+    def select(self, size_limit: int) -> None:
+        """ Отбирает из общей кучи давно проверенные файлы общим размером до size_limit байт, 0 - все """
+        size = 0
+        while len(self.heap) > 0 and not 0 < size_limit <= size:
+            item = heapq.heappop(self.heap)
+            heapq.heappush(self.heaps.setdefault(item[5], []), item)
+            size += item[1]
+
+    def pop(self, device: int) -> Optional[Tuple[float, int, str, str, str, int]]:
+        """ Возвращает самый давно проверенный отобранный файл диска, или None, если файлов не осталось """
+        with self.lock:
+            heap = self.heaps[device]
+            return heapq.heappop(heap) if len(heap) > 0 else None
+
+    def done(self, item: Tuple[float, int, str, str, str, int]) -> None:
+        """ Учитывает проверенный файл """
+        with self.lock:
+            self.count += 1
+            self.size += item[1]
+
+    def rest(self) -> List[Tuple[float, int, str, str, str, int]]:
+        """ Возвращает непроверенные файлы """
+        with self.lock:
+            return self.heap + [item for heap in self.heaps.values() for item in heap]
+
+
+class FanOut:
+    """ Пишет одни и те же данные в несколько файлов одновременно.
+    Файл, запись в который не удалась, исключается, ошибка запоминается в self.errors """
+
+    def __init__(self, outs: Dict[str, IO]):
+        self.outs = dict(outs)  # type: Dict[str, IO]
+        self.errors = {}  # type: Dict[str, BaseException]
+        self.executor = ThreadPoolExecutor(max_workers=len(outs)) if len(outs) > 1 else None
+
+    def write(self, data: Any) -> int:
+        """ Пишет данные во все исправные файлы """
+        if self.executor is None:
+            futures = {name: None for name in self.outs}  # type: Dict[str, Optional[Future]]
+        else:
+            futures = {name: self.executor.submit(out.write, data) for name, out in self.outs.items()}
+        for name, future in futures.items():
+            try:
+                if future is None:
+                    self.outs[name].write(data)
+                else:
+                    future.result()
+            except Exception as e:
+                self.errors[name] = e
+                del self.outs[name]
+        return len(data)
+
+    def close(self) -> None:
+        """ Останавливает потоки записи """
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
 class RecoveryEntry:
     """ Файл, подготовленный к восстановлению """
 
@@ -232,6 +1328,23 @@ class RecoveryEntry:
         return "Entry(name=%s, dir=%s, list=%s)" % (self.name, self.dir, self.list)
 
 
+class SharedCommand:
+    """ Команда в очередях нескольких целевых директорий. Выполняется первой дошедшей до неё очередью,
+    остальные ждут её завершения, чтоб их следующие команды, например запись '.md5', видели результат.
+    Очереди получают общие команды в одном порядке, поэтому не ждут друг друга по кругу """
+
+    def __init__(self, command: Callable[[], None]):
+        self.command = command
+        self.done = False  # type: bool
+        self.lock = threading.Lock()
+
+    def __call__(self) -> None:
+        with self.lock:
+            if not self.done:
+                self.done = True
+                self.command()
+
+
 class Separator:
     """ Отделяет нужные резервные копии от избыточных """
 
@@ -243,6 +1356,10 @@ class Separator:
         """ Инициализирует Entry """
         pass
 
+    def match(self, key: str, name: str) -> Optional[Match[str]]:
+        """ Проверяет, что файл относится к этому классификатору. key - путь файла от целевой директории """
+        return self.pattern.match(name)
+
     def separate(self, entry_list: List[RecoveryEntry]) -> Tuple[List[RecoveryEntry], List[RecoveryEntry]]:
         """ Отделяет нужные резервные копии от избыточных """
         pass
@@ -251,19 +1368,29 @@ class Separator:
 class TimeSeparator(Separator):
     """ Отделяет нужные копии от избыточных по дате создания """
 
+    # разностный архив: <полный архив без расширения>.inc<дата><расширение>
+    incremental = re.compile(r"^(.+\d\d\d\d-\d\d-\d\d)\.inc\d\d\d\d-\d\d-\d\d(\..+)$")
+
     def __init__(self, num: int):
         super().__init__(r"^.+(\d\d\d\d-\d\d-\d\d)\..+$")
         self.num = num
 
-    @staticmethod
-    def init(entry: RecoveryEntry, matcher: Optional[Match[str]]):
-        """ Инициализирует Entry """
+    @classmethod
+    def init(cls, entry: RecoveryEntry, matcher: Optional[Match[str]]):
+        """ Инициализирует Entry. Для разностного архива запоминает имя полного """
         entry.date = matcher.group(1)
+        incremental = cls.incremental.match(entry.name)
+        entry.full = incremental.group(1) + incremental.group(2) if incremental is not None else None
 
     def separate(self, entry_list: List[RecoveryEntry]):
-        """ Сортирует список по времени в обратном порядке, оставляет первые self.num элементов """
+        """ Сортирует список по времени в обратном порядке, оставляет первые self.num элементов
+        и полные архивы, от которых зависят оставленные разностные """
         entry_list.sort(key=functools.cmp_to_key(self.cmp))
-        return entry_list[:self.num], entry_list[self.num:]
+        recovery, remove = entry_list[:self.num], entry_list[self.num:]
+        # noinspection PyUnresolvedReferences
+        required = {e.full for e in recovery if getattr(e, 'full', None) is not None}
+        recovery += [e for e in remove if e.name in required]
+        return recovery, [e for e in remove if e.name not in required]
 
     @staticmethod
     def cmp(e1: RecoveryEntry, e2: RecoveryEntry) -> int:
@@ -319,6 +1446,41 @@ class SvnSeparator(Separator):
         return e2.stop - e1.stop
 
 
+class GitBundleSeparator(SvnSeparator):
+    """ Отделяет ненужные пакеты git bundle с перекрывающимися диапазонами номеров.
+    Полный пакет с номерами 0-k заменяет все пакеты до k включительно """
+
+    def __init__(self):
+        Separator.__init__(self, r"^(.+)\.(\d+)-(\d+)\.bundle$")
+
+
+class ChunkSeparator(Separator):
+    """ Отделяет блоки ChunkStore, на которые не ссылается ни один рецепт """
+
+    def __init__(self):
+        super().__init__(r"^([0-9a-f]{64}\.gz)(\.tmp\d*)?$")
+        self.referenced = None  # type: Optional[Set[str]] # имена нужных блоков, None - оставлять все
+
+    def match(self, key: str, name: str) -> Optional[Match[str]]:
+        """ Блоки лежат только в хранилище целевой директории: /.chunks/<ab>/<ab...>.gz """
+        if key != '/%s/%s/%s' % (ChunkStore.DIR, name[:2], name):
+            return None
+        return self.pattern.match(name)
+
+    @staticmethod
+    def init(entry: RecoveryEntry, matcher: Optional[Match[str]]):
+        """ Инициализирует Entry. Недописанный блок не нужен никакому рецепту """
+        entry.chunk = matcher.group(1) if matcher.group(2) is None else None
+
+    # noinspection PyUnresolvedReferences
+    def separate(self, entry_list: List[RecoveryEntry]):
+        """ Оставляет блоки, на которые ссылаются рецепты """
+        if self.referenced is None:
+            return entry_list, []
+        return [e for e in entry_list if e.chunk in self.referenced], \
+               [e for e in entry_list if e.chunk not in self.referenced]
+
+
 class BackupStrategy:
     """ Стратегия снятия резервной копии """
 
@@ -338,12 +1500,26 @@ class SvnBackup(BackupStrategy):
 
     def __init__(self, backup):
         self.md5sums = backup.new_checksum_by_path  # type: Dict[str, str]
+        self.gzip_md5sum = backup.gzip_md5sum  # type: Callable[[str, int], GzipMd5sum]
+        self.hash_cache = backup.hash_cache  # type: HashCache
+        self.dump_pool = backup.svn_dump_pool  # type: WorkerPool
+
+    FSFS_FORMATS = range(1, 9)  # известные форматы db/format, которые читаются без svn
 
     @staticmethod
     def found(directory):
-        """ Проверяет, что директория - репозиторий Subversion """
-        if not dir_contains(directory, ['conf', 'db', 'hooks', 'locks'], ['format', 'README.txt']):
+        """ Проверяет, что директория - репозиторий Subversion. Читает директорию одним scandir """
+        try:
+            with os.scandir(directory) as it:
+                entries = {entry.name: entry for entry in it}
+        except OSError:
             return False
+        for name in ('conf', 'db', 'hooks', 'locks'):
+            if name not in entries or not entries[name].is_dir():
+                return False
+        for name in ('format', 'README.txt'):
+            if name not in entries or not entries[name].is_file():
+                return False
         if not read_line(directory + "/README.txt").startswith("This is a Subversion repository;"):
             return False
         return True
@@ -357,25 +1533,50 @@ class SvnBackup(BackupStrategy):
         log.debug("backup(src=%s, dst=%s, prefix=%s)", src, dst, prefix)
         new_rev = self.svn_revision(src)
         md5 = load_md5(dst + "/.md5")  # TODO: использовать backup.checksum(path)
+        self.dump_pool.map(lambda revs: self.dump(src, dst, prefix, revs[0], revs[1], md5),
+                           self.revision_ranges(new_rev), lambda _: dst)
+        return True
+
+    @staticmethod
+    def revision_ranges(new_rev: int) -> List[Tuple[int, int]]:
+        """ Разбивает ревизии на независимые диапазоны по 10000, 1000 и 100 ревизий и остаток.
+        Возвращает пары (ревизия перед диапазоном, последняя ревизия диапазона) """
+        ranges = []
         step = min_rev = 100
         while new_rev >= step - 1 and step < 10000:
             step *= 10
         old_rev = -1
         while True:
             while old_rev + step > new_rev:
-                step /= 10
+                step //= 10
             if step < min_rev:
                 break
             rev = old_rev + step
-            self.dump(src, dst, prefix, old_rev, rev, md5)
+            ranges.append((old_rev, rev))
             old_rev = rev
-        self.dump(src, dst, prefix, old_rev, new_rev, md5)
-        return True
+        ranges.append((old_rev, new_rev))
+        return ranges
 
     def svn_revision(self, src):
-        """  Возвращает ревизию репозитория """
+        """  Возвращает ревизию репозитория: из файлов FSFS, или через svn info, если формат не распознан """
+        rev = self.fsfs_revision(src)
+        if rev is not None:
+            return rev
         return system(("svn", "info", "file://" + os.path.abspath(src)), self.read_revision)
 
+    @classmethod
+    def fsfs_revision(cls, src: str) -> Optional[int]:
+        """ Читает последнюю ревизию из db/current репозитория FSFS. Возвращает None, если формат не распознан """
+        try:
+            if read_line(src + '/db/fs-type').strip() != 'fsfs' or not read_line(src + '/format').strip().isdigit():
+                return None
+            if int(read_line(src + '/db/format').split()[0]) not in cls.FSFS_FORMATS:
+                return None
+            # формат 1-2: "ревизия узел копия", формат 3 и выше: "ревизия"
+            return int(read_line(src + '/db/current').split()[0])
+        except (IOError, ValueError, IndexError, UnicodeDecodeError):
+            return None
+
     def dump(self, src, dst, prefix, old_rev, new_rev, md5):
         """ Запускает svnadmin dump для одиночного репозитория """
         old_rev += 1
@@ -385,12 +1586,13 @@ class SvnBackup(BackupStrategy):
         dump_name = "%s.%06d-%06d.svndmp.gz" % (prefix, old_rev, new_rev)
         path = dst + '/' + dump_name
         checksum = md5.get(dump_name)  # TODO: использовать backup.checksum(path)
-        if checksum is not None and checksum == md5sum(path):
+        if checksum is not None and checksum == self.hash_cache.md5sum(path, hash_algorithm(checksum)):
             self.md5sums[path] = checksum
             return
         self.md5sums[path] = system(["svnadmin", "dump", "-r",
                                      "%d:%d" % (old_rev, new_rev), "--incremental", src],
-                                    GzipMd5sum(path))
+                                    self.gzip_md5sum(path, self.dump_pool.count(dst)))
+        self.hash_cache.put(path, self.md5sums[path])
 
     @staticmethod
     def read_revision(stdout):
@@ -406,10 +1608,19 @@ class GitBackup(BackupStrategy):
     """ Создаёт резервную копию репозитория Git """
 
     def __init__(self, backup):
-        self.last_modified = backup.last_modified  # type: Callable[[str], None]
+        self.last_modified = backup.last_modified  # type: Callable[[str, Optional[os.DirEntry]], None]
+        self.modified = backup.modified  # type: Callable[[str, float], None]
         self.up_to_date = backup.up_to_date  # type: Callable[[str, str], bool]
         self.generic_backup = backup.generic_backup  # type: Callable[[str, str, str], None]
+        self.error = backup.error  # type: Callable[..., None]
         self.excludes = set()  # type: Set[str]
+        self.remote_workers = 1  # type: int # число одновременных fetch/push одного репозитория
+        self.fast_check = True  # type: bool # не обходить объекты, а проверять время каталогов objects
+        self.new_checksum = backup.new_checksum  # type: Callable[[str], None]
+        self.bundle = False  # type: bool # хранить репозиторий пакетами git bundle вместо tar.gz
+        self.full_bundles = 7  # type: int # число разностных пакетов до следующего полного
+        self.fetched = {}  # type: Dict[str, Future] # предварительные fetch по репозиториям, результат - зеркала
+        self.executor = None  # type: Optional[ThreadPoolExecutor] # общий для всех источников пул prefetch
 
     @staticmethod
     def found(src):
@@ -436,30 +1647,191 @@ class GitBackup(BackupStrategy):
         else:
             git = src
         log.info("\nbackup git: %s", git)
+        fetched = self.fetched.pop(src, None)
+        mirrors = self.fetch(src) if fetched is None else fetched.result()
+        if self.bundle:
+            self.bundle_backup(src, dst, prefix, len(mirrors) == 0)
+            return
+        self.excludes = {git + '/svn', git + '/FETCH_HEAD', git + '/subgit', git + '/refs/svn/map'}
+        if self.fast_check and self.objects_modified(git + '/objects'):
+            self.excludes.add(git + '/objects')
+        through_dirs(src, self.last_modified_with_excludes, self.last_modified_with_excludes)
+        if self.up_to_date(src, dst):
+            return
+        system(['git', 'prune'], cwd=src)
+        if len(mirrors) == 0:
+            self.git_fsck(src)
+        self.generic_backup(src, dst, prefix)
+
+    def bundle_backup(self, src: str, dst: str, prefix: str, fsck: bool) -> None:
+        """ Пишет разностный пакет git bundle со ссылками, изменившимися после прошлых пакетов,
+        или полный пакет, если разностных накопилось много, ссылки удалены, или разностный не создаётся """
+        if dst is None:
+            log.debug('bundle backup: ignore dst=[%s]', dst)
+            return
+        mkdirs(dst)
+        refs = system_hidden(['git', 'for-each-ref', '--format=%(objectname) %(refname)'], cwd=src,
+                             reader=self.read_refs)
+        chain, stop = self.bundle_chain(dst, prefix)
+        heads = {}  # type: Dict[str, str] # ссылки, сохранённые в пакетах
+        for name in chain:
+            heads.update(self.read_bundle_heads(dst + '/' + name))
+        if len(chain) > 0 and heads == refs:
+            log.info('[%s] is up to date.', src)
+            return
+        if fsck:
+            self.git_fsck(src)
+        stop += 1
+        path = None
+        if 0 < len(chain) <= self.full_bundles and set(heads) <= set(refs):
+            path = dst + '/%s.%06d-%06d.bundle' % (prefix, stop, stop)
+            if not self.create_bundle(src, path, ['--all'] + ['^' + sha for sha in sorted(set(heads.values()))]):
+                path = None
+        if path is None:
+            path = dst + '/%s.%06d-%06d.bundle' % (prefix, 0, stop)
+            if not self.create_bundle(src, path, ['--all']):
+                raise IOError('git bundle create %s failed' % path)
+        self.new_checksum(path)
+
+    @staticmethod
+    def bundle_chain(dst: str, prefix: str) -> Tuple[List[str], int]:
+        """ Возвращает последний полный пакет с идущими за ним разностными и последний номер, или -1 """
+        pattern = GitBundleSeparator().pattern
+        bundles = []
+        for name in os.listdir(dst):
+            matcher = pattern.match(name)
+            if matcher is not None and matcher.group(1) == prefix:
+                bundles.append((int(matcher.group(2)), int(matcher.group(3)), name))
+        fulls = [bundle for bundle in bundles if bundle[0] == 0]
+        if len(fulls) == 0:
+            return [], -1
+        start, stop, name = max(fulls, key=lambda bundle: bundle[1])
+        chain = [name]
+        incremental = {bundle[0]: bundle for bundle in bundles if bundle[0] == bundle[1]}
+        while stop + 1 in incremental:
+            start, stop, name = incremental[stop + 1]
+            chain.append(name)
+        return chain, stop
+
+    @staticmethod
+    def create_bundle(src: str, path: str, revisions: List[str]) -> bool:
+        """ Создаёт и проверяет пакет. Возвращает False, если git не создал пакет """
+        remove_file(path)
+        if system(['git', 'bundle', 'create', os.path.abspath(path)] + revisions, cwd=src) != 0:
+            remove_file(path)
+            return False
+        if system(['git', 'bundle', 'verify', os.path.abspath(path)], cwd=src) != 0:
+            remove_file(path)
+            raise IOError('Invalid git bundle %s' % path)
+        return True
+
+    @staticmethod
+    def read_bundle_heads(path: str) -> Dict[str, str]:
+        """ Читает ссылки из заголовка пакета git bundle v2/v3, кроме HEAD """
+        heads = {}
+        with open(path, 'rb') as fd:
+            if fd.readline() not in (b'# v2 git bundle\n', b'# v3 git bundle\n'):
+                raise IOError('Invalid git bundle %s' % path)
+            for line in fd:
+                if line == b'\n':
+                    return heads
+                if line.startswith(b'-') or line.startswith(b'@'):
+                    continue
+                sha, ref = line.decode('utf-8').rstrip('\n').split(' ', 1)
+                if ref != 'HEAD':
+                    heads[ref] = sha
+        raise IOError('Invalid git bundle %s' % path)
+
+    @staticmethod
+    def read_refs(stdout: IO) -> Dict[str, str]:
+        """ Читает ссылки из вывода git for-each-ref """
+        refs = {}
+        for line in stdout:
+            sha, ref = line.decode('utf-8').rstrip('\n').split(' ', 1)
+            refs[ref] = sha
+        return refs
+
+    def objects_modified(self, objects: str) -> bool:
+        """ Запоминает время модификации объектов по отпечатку без обхода всех объектов:
+        время каталогов objects/xx меняется при добавлении и удалении неупакованных объектов,
+        время objects/pack - при добавлении и удалении пакетов, файлы objects/info и objects/pack мелкие.
+        Возвращает False, если каталог objects не похож на репозиторий Git: тогда нужен полный обход """
+        try:
+            with os.scandir(objects) as it:
+                entries = list(it)
+            if not any(entry.name == 'pack' and entry.is_dir() for entry in entries):
+                return False
+            for entry in entries:
+                path = objects + '/' + entry.name
+                if not entry.is_dir():
+                    self.last_modified(path, entry)
+                    continue
+                self.modified(path, entry.stat().st_mtime)
+                if entry.name in ('pack', 'info'):
+                    with os.scandir(path) as it:
+                        for child in it:
+                            self.last_modified(path + '/' + child.name, child)
+        except OSError as e:
+            log.warning('%s: %s', objects, e)
+            return False
+        return True
+
+    def fetch(self, src: str) -> List[str]:
+        """ Выполняет git svn fetch, git fetch и push в зеркала. Возвращает имена зеркал """
         remotes = system_hidden(['git', 'config', '--list'], cwd=src, reader=self.read_remotes)
         for name in remotes['svn-remote']:
-            system(['git', 'svn', 'fetch', name], cwd=src)
-        mirrors = []
+            self.run_git(src, ['git', 'svn', 'fetch', name])
+        mirrors, fetches = [], []
         for name in remotes['remote']:
             remote = remotes['remote'][name]
             mirror = remote.get('mirror')
             log.debug('remote.%s.mirror=%s', name, mirror)
             if mirror != 'true':
-                system(['git', 'fetch', '--prune', name], cwd=src)
+                fetches.append(name)
             else:
                 mirrors.append(name)
+        if self.remote_workers > 1 and len(fetches) > 1:
+            # один процесс git: отдельные fetch одного репозитория спорят за packed-refs.lock и FETCH_HEAD
+            self.run_git(src, ['git', 'fetch', '--multiple', '--prune', '--jobs=%d' % self.remote_workers] + fetches)
+        else:
+            for name in fetches:
+                self.run_git(src, ['git', 'fetch', '--prune', name])
         if len(mirrors) > 0:
             self.git_fsck(src)
-            for name in mirrors:
-                system(['git', 'push', name], cwd=src)
-        self.excludes = {git + '/svn', git + '/FETCH_HEAD', git + '/subgit', git + '/refs/svn/map'}
-        through_dirs(src, self.last_modified_with_excludes, self.last_modified_with_excludes)
-        if self.up_to_date(src, dst):
+            self.for_each_remote(mirrors, lambda name: self.run_git(src, ['git', 'push', name]))
+        return mirrors
+
+    def run_git(self, src: str, command: List[str]) -> None:
+        """ Запускает команду git в репозитории, сообщает об ошибке по коду возврата """
+        res = system(command, cwd=src)
+        if res != 0:
+            self.error('%s error: %s exit code %s', ' '.join(command), src, res)
+
+    def for_each_remote(self, names: List[str], command: Callable[[str], None]) -> None:
+        """ Выполняет команду для удалённых репозиториев, не больше self.remote_workers сразу.
+        Используется для push: каждый push пишет только в свой удалённый репозиторий """
+        if self.remote_workers <= 1 or len(names) <= 1:
+            for name in names:
+                command(name)
             return
-        system(['git', 'prune'], cwd=src)
-        if len(mirrors) == 0:
-            self.git_fsck(src)
-        self.generic_backup(src, dst, prefix)
+        with ThreadPoolExecutor(max_workers=self.remote_workers) as executor:
+            for _ in executor.map(command, names):
+                pass
+
+    def prefetch(self, repositories: List[str], workers: int) -> None:
+        """ Ставит fetch репозиториев в общий для всех источников пул, не больше workers сразу.
+        Не ждёт завершения: результат или ошибку забирает backup из self.fetched """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+        for src in repositories:
+            self.fetched[src] = self.executor.submit(self.fetch, src)
+
+    def shutdown(self) -> None:
+        """ Дожидается предварительных fetch и останавливает пул """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.fetched = {}
 
     @staticmethod
     def git_fsck(src):
@@ -468,11 +1840,12 @@ class GitBackup(BackupStrategy):
         if res != 0:
             raise IOError('Invalid git repository %s' % src)
 
-    def last_modified_with_excludes(self, path):
-        """ Запоминает время последней модификации файлов """
+    def last_modified_with_excludes(self, path, entry=None):
+        """ Запоминает время последней модификации файлов. Для директорий entry is None """
         if path in self.excludes:
             return True
-        self.last_modified(path)
+        if entry is not None:
+            self.last_modified(path, entry)
         return False
 
     @staticmethod
@@ -506,12 +1879,15 @@ class Backup:
         print("\tclone destDirs numberOfFiles -- checks md5 sums and clone archived files")
         print("\tgit srcDirs -- fetch srcDir Git repositories from remotes and push into remotes when --mirror=push")
         print("\tchecks destDirs -- checks md5 sums slow for low I/O load")
+        print("\tcatalog-import destDirs -- imports .md5 and .checksum files into the catalog")
+        print("\tcatalog-export destDirs -- exports the catalog into .md5 and .checksum files")
         print("\nExamples:")
         print("\tbackup.py full $HOME/src1,$HOME/src2 /local/backup,/remote/backup 3")
         print("\tbackup.py dump $HOME/src1,$HOME/src2 /var/backup")
         print("\tbackup.py clone /local/backup,/remote/backup2 5")
         print("\tbackup.py git $HOME/src1,$HOME/src2")
         print("\tbackup.py checks /local/backup1,/local/backup2")
+        print("\tbackup.py catalog-import /local/backup1,/local/backup2")
         print()
         print("Optional config file $HOME/.config/backup/backup.cfg:")
         print("{")
@@ -523,7 +1899,33 @@ class Backup:
         print('  "fromaddr": "backup@mail.ru",')
         print('  "toaddrs": "admin@mail.ru, admin2@mail.ru",')
         print('  "log_level": "DEBUG",')
-        print('  "log_format": "%(levelname)5s %(lineno)3d %(message)s"')
+        print('  "log_format": "%(levelname)5s %(lineno)3d %(message)s",')
+        print('  "checksum_workers": {"/local/backup": 4, "/remote/backup": 1},')
+        print('  "hash_algorithm": "blake2b",')
+        print('  "gzip_workers": 4,')
+        print('  "gzip_level": 6,')
+        print('  "archiver": "tar",')
+        print('  "copy_buffers": 4,')
+        print('  "clone_workers": 2,')
+        print('  "list_workers": 2,')
+        print('  "full_backup_days": 7,')
+        print('  "chunk_store": true,')
+        print('  "svn_dump_workers": 4,')
+        print('  "git_workers": 8,')
+        print('  "git_remote_workers": 2,')
+        print('  "git_fast_check": false,')
+        print('  "git_bundle": true,')
+        print('  "git_full_bundles": 7,')
+        print('  "check_rate": {"default": 0.4, "23-7": 10},')
+        print('  "check_pressure": 20,')
+        print('  "check_busy": 20,')
+        print('  "check_period": 30,')
+        print('  "check_time_limit": 3600,')
+        print('  "check_size_limit": 100000,')
+        print('  "checksum_format": "binary",')
+        print('  "checksum_compact_size": 1,')
+        print('  "catalog": "~/.cache/backup/checksums.sqlite",')
+        print('  "hash_cache": "~/.cache/backup/hash_cache.json"')
         print("}")
         sys.exit()
 
@@ -540,18 +1942,46 @@ class Backup:
         self.to_address = None
         # набор способов разделить нужные копии от избыточных
         self.time_separator = None  # type: Optional[TimeSeparator]
+        self.chunk_separator = ChunkSeparator()  # type: ChunkSeparator
         self.separators = []  # type: List[Separator]
         self.src_dirs = []  # type: List[str]
         self.dest_dirs = []  # type: List[str]
         self.dir_set = set()  # type: Set[str]
         self.new_checksum_by_path = {}  # type: Dict[str, str]
         self.checksums_by_dir = {}  # type: Dict[str, Dict[str, Tuple[Optional[str], Optional[float]]]]
-        self.checked = time.time() - 30 * 24 * 3600  # type: float
-        self.strategies = (SvnBackup(self), GitBackup(self))  # type: Tuple[BackupStrategy, BackupStrategy]
+        self.check_period = 30  # type: float # период повторной проверки архивов в днях
+        self.checked = time.time() - self.check_period * 24 * 3600  # type: float
+        self.checksum_format = 'text'  # type: str # 'binary' - журнал контрольных сумм '.checksum.bin'
+        self.checksum_compact_size = 1  # type: float # размер журнала в МБайт, выше которого он перезаписывается
+        self.compacted = {}  # type: Dict[str, int] # размер журнала директории после перезаписи
+        self.directory_locks = {}  # type: Dict[str, threading.Lock] # запись журналов контрольных сумм
+        self.check_time_limit = 0  # type: float # бюджет времени проверки checks в секундах, 0 - без ограничения
+        self.check_size_limit = 0  # type: float # бюджет объёма проверки checks в МБайт, 0 - без ограничения
         self.commands = {}  # type: Dict[str, List[Callable[[], None]]] # команды по директориям
+        self.catalog = None  # type: Optional[ChecksumCatalog] # каталог контрольных сумм вместо файлов .checksum
+        self.hash_cache = HashCache()  # type: HashCache # контрольные суммы неизменённых архивов
+        self.svn_dump_pool = WorkerPool(os.cpu_count() or 1)  # type: WorkerPool # потоки svnadmin dump
+        self.rate_limiter = RateLimiter()  # type: RateLimiter # скорость медленной проверки checks
+        self.bundle_separator = GitBundleSeparator()  # type: GitBundleSeparator
+        self.git_backup = GitBackup(self)  # type: GitBackup
+        self.strategies = (SvnBackup(self), self.git_backup)  # type: Tuple[BackupStrategy, BackupStrategy]
+        self.git_workers = 1  # type: int # число одновременно обновляемых репозиториев Git всех источников
         self.errors = []  # type: List[str]
+        self.error_count = 0  # type: int # число ошибок, в том числе без отправки email
         self.strategy_dir = []  # type: List[Tuple[BackupStrategy, str]]
         self.last_modified_time = -1  # type: float
+        self.source_changed = False  # type: bool # исходная директория изменилась с прошлого снимка
+        self.checksum_pool = WorkerPool()  # type: WorkerPool # потоки для подсчёта контрольных сумм
+        self.list_pool = WorkerPool()  # type: WorkerPool # потоки для чтения каталогов зеркал
+        self.hash_algorithm = 'md5'  # type: str # алгоритм контрольных сумм новых архивов
+        self.gzip_workers = os.cpu_count() or 1  # type: int # потоки сжатия, 0 - внешний gzip
+        self.gzip_level = 6  # type: int # степень сжатия gzip от 0 до 9
+        self.archiver = 'tarfile'  # type: str # 'tar' - внешний tar, 'tarfile' - архивация в процессе
+        self.copy_buffers = 4  # type: int # буферы конвейерного копирования, 0 - копирование в одном потоке
+        self.clone_workers = 0  # type: int # число одновременно клонируемых директорий, 0 - все
+        self.full_backup_days = 0  # type: int # период полных архивов в днях, 0 - разностные архивы не делаются
+        self.chunk_store = False  # type: bool # архивы хранятся блоками в ChunkStore целевой директории
+        self.lock = threading.RLock()
 
     def configure(self) -> Callable:
         """ Конфигурирует выполнение """
@@ -564,7 +1994,6 @@ class Backup:
             # log_format = "%(levelname)5s %(lineno)3d %(message)s"
             log_format = "%(message)s"
         log.basicConfig(level=level, stream=sys.stdout, format=log_format)
-        sys.setrecursionlimit(100)
         return self.command()
 
     @staticmethod
@@ -599,6 +2028,12 @@ class Backup:
         elif 'checks' == command:
             method = self.checks
             dest_dirs = self.arg()
+        elif 'catalog-import' == command:
+            method = self.catalog_import
+            dest_dirs = self.arg()
+        elif 'catalog-export' == command:
+            method = self.catalog_export
+            dest_dirs = self.arg()
         else:
             method = self.help
         self.hostname = self.config.get('hostname')
@@ -606,13 +2041,51 @@ class Backup:
             self.hostname = socket.gethostname()
         self.smtp_host = self.config.get('smtp_host')
         self.time_separator = TimeSeparator(num)
-        self.separators = [self.time_separator, SvnSeparator()]  # способы разделить нужные копии от избыточных
+        self.chunk_separator = ChunkSeparator()
+        # способы разделить нужные копии от избыточных
+        self.separators = [self.time_separator, SvnSeparator(), self.chunk_separator, self.bundle_separator]
         self.src_dirs = src_dirs.split(',')
         log.debug("src_dirs=%s", self.src_dirs)
         self.dest_dirs = dest_dirs.split(',') if dest_dirs is not None else []
         log.debug("dest_dirs=%s", self.dest_dirs)
         for directory in self.dest_dirs:
             self.commands[directory] = []
+        self.checksum_pool.configure(self.config.get('checksum_workers'))
+        self.list_pool.configure(self.config.get('list_workers', len(self.dest_dirs)))
+        self.svn_dump_pool.configure(self.config.get('svn_dump_workers'))
+        self.rate_limiter.configure(self.config.get('check_rate'), self.config.get('check_pressure'),
+                                    self.config.get('check_busy'), self.dest_dirs)
+        self.check_period = float(self.config.get('check_period', self.check_period))
+        self.checked = time.time() - self.check_period * 24 * 3600
+        self.check_time_limit = float(self.config.get('check_time_limit', self.check_time_limit))
+        self.checksum_format = self.config.get('checksum_format', self.checksum_format)
+        if self.checksum_format not in ('text', 'binary'):
+            raise ValueError('Unsupported checksum_format %s' % self.checksum_format)
+        self.checksum_compact_size = float(self.config.get('checksum_compact_size', self.checksum_compact_size))
+        self.check_size_limit = float(self.config.get('check_size_limit', self.check_size_limit))
+        self.git_workers = int(self.config.get('git_workers', self.git_workers))
+        self.git_backup.remote_workers = int(self.config.get('git_remote_workers', self.git_backup.remote_workers))
+        self.git_backup.fast_check = bool(self.config.get('git_fast_check', self.git_backup.fast_check))
+        self.git_backup.bundle = bool(self.config.get('git_bundle', self.git_backup.bundle))
+        self.git_backup.full_bundles = int(self.config.get('git_full_bundles', self.git_backup.full_bundles))
+        self.hash_algorithm = self.config.get('hash_algorithm', 'md5')
+        if self.hash_algorithm not in CHECKSUM_ALGORITHMS:
+            raise ValueError('Unsupported hash_algorithm %s' % self.hash_algorithm)
+        self.gzip_workers = int(self.config.get('gzip_workers', self.gzip_workers))
+        self.gzip_level = int(self.config.get('gzip_level', self.gzip_level))
+        if not 0 <= self.gzip_level <= 9:
+            raise ValueError('Unsupported gzip_level %s' % self.gzip_level)
+        self.archiver = self.config.get('archiver', self.archiver)
+        self.copy_buffers = int(self.config.get('copy_buffers', self.copy_buffers))
+        self.hash_cache.load(os.path.expanduser(self.config.get('hash_cache', '~/.cache/backup/hash_cache.json')))
+        catalog = self.config.get('catalog')
+        if catalog is not None:
+            self.catalog = ChecksumCatalog(os.path.expanduser(catalog))
+        self.clone_workers = int(self.config.get('clone_workers', self.clone_workers))
+        self.full_backup_days = int(self.config.get('full_backup_days', self.full_backup_days))
+        self.chunk_store = bool(self.config.get('chunk_store', self.chunk_store))
+        if self.chunk_store and (self.archiver == 'tar' or self.gzip_workers <= 0):
+            raise ValueError('chunk_store requires archiver tarfile and gzip_workers > 0')
         log.debug("self.commands=%s", self.commands)
         return method
 
@@ -627,6 +2100,12 @@ class Backup:
             self.configure()()
         except BaseException:
             self.error("%s", traceback.format_exc())
+        finally:
+            self.checksum_pool.shutdown()
+            self.list_pool.shutdown()
+            self.svn_dump_pool.shutdown()
+            if self.catalog is not None:
+                self.catalog.close()
         self.send_errors()
 
     def send_errors(self) -> None:
@@ -656,6 +2135,11 @@ class Backup:
         """ Архивирует исходные файлы """
         for src in self.src_dirs:
             self.backup(src)
+        self.git_backup.shutdown()
+        try:
+            self.hash_cache.save()
+        except Exception as e:
+            self.error("save hash cache %s error: %s", self.hash_cache.path, e)
         dirs = {}  # type: Dict[str, List[str]] # дочерние файлы по имени *.md5-файлов
         for path in self.new_checksum_by_path.keys():
             md5path = os.path.dirname(path) + '/.md5'
@@ -677,27 +2161,55 @@ class Backup:
 
     def clone(self) -> None:
         """ Клонирует копии в несколько источников """
+        self.chunk_separator.referenced = self.referenced_chunks()
         self.recovery_dirs("")
-        for dst in self.dest_dirs:
+        self.run_commands()
+
+    def run_commands(self) -> None:
+        """ Выполняет очереди команд целевых директорий параллельно, не больше self.clone_workers очередей сразу """
+        workers = min(self.clone_workers if self.clone_workers > 0 else len(self.dest_dirs), len(self.dest_dirs))
+        if workers <= 1:
+            for dst in self.dest_dirs:
+                self.run_dest_commands(dst)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(self.run_dest_commands, dst) for dst in self.dest_dirs]:
+                future.result()
+
+    def run_dest_commands(self, dst: str) -> None:
+        """ Выполняет очередь команд целевой директории. Ошибка останавливает только эту очередь """
+        try:
             for command in self.commands[dst]:
                 command()
+        except Exception as e:
+            self.error("clone %s error: %s\n%s", dst, e, traceback.format_exc())
 
     def git(self) -> None:
         """ Выполняет fetch Git-репозиториев, и push, если настроен mirror push """
         for src in self.src_dirs:
             self.backup(src)
+        self.git_backup.shutdown()
 
     def backup(self, src: str) -> None:
         """ Создаёт резервные копии директории """
         log.debug('backup(self, src=[%s]); self.destDirs=[%s]', src, self.dest_dirs)
         if '' == src:
             return
-        self.last_modified_time = -1
-        self.strategy_dir = []
-        through_dirs(src, self.find_strategy, self.last_modified)
         prefix = self.hostname + '-' + os.path.basename(src)
         dst = self.dest_dirs[0] + '/' + self.hostname + '/' + prefix if len(self.dest_dirs) > 0 else None
         log.debug('backup: dst=[%s]', dst)
+        manifest = SourceManifest()
+        if dst is not None:
+            manifest.load(dst + '/.manifest')
+        strategies = {type(strategy).__name__: strategy for strategy in self.strategies}
+        self.strategy_dir = [(strategies[name], directory)
+                             for directory, name in manifest.walk(src, self.find_strategy)]
+        self.last_modified_time = manifest.last_modified
+        self.source_changed = manifest.changed()
+        errors = self.error_count
+        if self.git_workers > 1:
+            self.git_backup.prefetch([d for strategy, d in self.strategy_dir if strategy is self.git_backup],
+                                     self.git_workers)
         if len(self.strategy_dir) == 0:
             self.safe_backup(None, src, dst, prefix)
         else:
@@ -711,22 +2223,24 @@ class Backup:
                     dst_prf = dst + '/' + prf if dst is not None else None
                     log.debug('backup: dst_prf=[%s]', dst_prf)
                     self.safe_backup(strategy, directory, dst_prf, prf)
-
-    def find_strategy(self, directory: str) -> bool:
-        """ Ищет способ резервного копирования.
-            Устанавливает self.time последнее время модификации директории. """
-        self.last_modified(directory)
+        if self.error_count == errors:
+            try:
+                manifest.save()
+            except IOError as e:
+                self.error("manifest %s error: %s", manifest.path, e)
+
+    def find_strategy(self, directory: str) -> Optional[str]:
+        """ Ищет способ резервного копирования. Возвращает имя класса способа """
         for strategy in self.strategies:
             if strategy.found(directory):
-                self.strategy_dir.append((strategy, directory))
-                return True
-        return False
+                return type(strategy).__name__
+        return None
 
     def safe_backup(self, strategy: Optional[BackupStrategy], src: str, dst: str, prefix: str) -> None:
         """ Создаёт одиночную резервную копию. Перехватывает ошибки. """
         try:
             if strategy is None:
-                if self.up_to_date(src, dst):
+                if not self.source_changed and self.up_to_date(src, dst):
                     return
                 self.generic_backup(src, dst, prefix)
             else:
@@ -744,21 +2258,93 @@ class Backup:
         date = time.strftime("%Y-%m-%d")
         basename = os.path.basename(src)
         mkdirs(dst)
-        path = dst + '/' + prefix + date + ".tar.gz"
-        self.remove(path)
-        self.new_checksum_by_path[path] = system(["tar", "cf", "-", basename],
-                                                 GzipMd5sum(path),
-                                                 cwd=os.path.dirname(src))
+        if self.archiver == 'tar' or self.gzip_workers <= 0:
+            path = dst + '/' + prefix + date + ".tar.gz"
+            self.remove(path)
+            self.new_checksum_by_path[path] = system(["tar", "cf", "-", basename],
+                                                     self.gzip_md5sum(path),
+                                                     cwd=os.path.dirname(src))
+        else:
+            suffix = '.tar.recipe' if self.chunk_store else '.tar.gz'
+            full, base = self.full_archive(dst, prefix, date, suffix)
+            if full is None:
+                path = dst + '/' + prefix + date + suffix
+            else:
+                path = dst + '/' + full[:-len(suffix)] + '.inc' + date + suffix
+            self.remove(path)
+            archiver = self.tar_gzip_md5sum(path, base, full)
+            self.new_checksum_by_path[path] = archiver(src)
+            self.new_checksum_by_path.update(archiver.checksums)
+            if self.full_backup_days <= 0:
+                remove_file(dst + '/.index')  # индекс нужен только разностным архивам
+            elif full is None:
+                self.write_full_index(dst, os.path.basename(path), archiver.index)
         key = path[len(self.dest_dirs[0]):]
         log.debug('key=%s', key)
         for dst in self.dest_dirs[1:]:
             self.remove(dst + key)
 
-    def last_modified(self, path: str) -> None:
-        """ Устанавливает self.last_modified_time последнее время модификации файла. """
-        if not os.path.isfile(path):
+    def new_checksum(self, path: str) -> None:
+        """ Запоминает контрольную сумму только что записанного файла """
+        self.new_checksum_by_path[path] = self.hash_cache.md5sum(path, self.hash_algorithm)
+
+    def gzip_md5sum(self, path: str, share: int = 1) -> GzipMd5sum:
+        """ Возвращает обработчик, который сжимает поток в файл и считает его контрольную сумму.
+        share - число одновременных обработчиков, между которыми делятся потоки сжатия """
+        workers = self.gzip_workers if self.gzip_workers <= 0 else max(1, self.gzip_workers // max(share, 1))
+        return GzipMd5sum(path, self.hash_algorithm, workers, self.gzip_level)
+
+    def tar_gzip_md5sum(self, path: str, base: Optional[Dict[str, List[int]]] = None,
+                        full: Optional[str] = None) -> TarGzipMd5sum:
+        """ Возвращает обработчик, который архивирует директорию в файл и считает его контрольную сумму """
+        return TarGzipMd5sum(path, self.hash_algorithm, self.gzip_workers, self.gzip_level,
+                             base, full, self.dest_dirs[0] if self.chunk_store else None)
+
+    def full_archive(self, dst: str, prefix: str, date: str, suffix: str = '.tar.gz') \
+            -> Tuple[Optional[str], Optional[Dict[str, List[int]]]]:
+        """ Возвращает имя и индекс полного архива, от которого можно построить разностный.
+        (None, None), если пора делать полный архив """
+        if self.full_backup_days <= 0:
+            return None, None
+        try:
+            with open(dst + '/.index', encoding='UTF-8') as fd:
+                index = json.load(fd)
+            full, files = index['full'], index['files']
+        except (IOError, ValueError, TypeError, KeyError):
+            return None, None
+        matcher = self.time_separator.pattern.match(full) if self.time_separator is not None else None
+        if matcher is None or not full.startswith(prefix) or not full.endswith(suffix) \
+                or TimeSeparator.incremental.match(full) is not None or not os.path.isfile(dst + '/' + full):
+            return None, None
+        days = (time.mktime(time.strptime(date, '%Y-%m-%d'))
+                - time.mktime(time.strptime(matcher.group(1), '%Y-%m-%d'))) / (24 * 3600)
+        if days < 0.5 or days >= self.full_backup_days - 0.5:
+            return None, None
+        return full, files
+
+    @staticmethod
+    def write_full_index(dst: str, full: str, files: Dict[str, List[int]]) -> None:
+        """ Запоминает индекс полного архива для следующих разностных """
+        tmp = dst + '/.index.tmp'
+        with open(tmp, 'w', encoding='UTF-8') as fd:
+            json.dump({'version': 1, 'full': full, 'files': files}, fd)
+        os.replace(tmp, dst + '/.index')
+
+    def last_modified(self, path: str, entry: os.DirEntry = None) -> None:
+        """ Устанавливает self.last_modified_time последнее время модификации файла.
+        Если передан entry, берёт тип и время модификации из него без лишних вызовов stat """
+        if entry is not None:
+            if not entry.is_file():
+                return
+            modified = entry.stat().st_mtime
+        elif not os.path.isfile(path):
             return
-        modified = os.path.getmtime(path)
+        else:
+            modified = os.path.getmtime(path)
+        self.modified(path, modified)
+
+    def modified(self, path: str, modified: float) -> None:
+        """ Запоминает время модификации файла или каталога, если оно позже self.last_modified_time """
         if modified > self.last_modified_time:
             log.debug('last modified %s %s', modified, path)
             self.last_modified_time = modified
@@ -804,13 +2390,17 @@ class Backup:
         log.debug('for (name, entry) in in %s', file_dict)
         sw = StopWatch('md5sum -b %s%s/*' % (self.dest_dirs[0], key))
         remove = []
+        checksums = self.checksums([dst + key + '/' + name
+                                    for name in file_dict
+                                    for dst in self.dest_dirs
+                                    if dst + key + '/' + name not in self.new_checksum_by_path])
         for (name, entry) in file_dict.items():
             log.debug(' for (name=%s, entry=%s) in in %s', name, entry, file_dict)
             for dst in self.dest_dirs:
                 path = dst + key + '/' + name
                 md5 = self.new_checksum_by_path.get(path)
                 if md5 is None:
-                    md5, real = self.checksum(path)
+                    md5, real = checksums[path]
                     if real:
                         md5dirs.add(dst)
                 else:
@@ -836,8 +2426,11 @@ class Backup:
                 self.error("corrupt error: %s", k)
             else:
                 md5files.append(rec)
-                for dst in rec.list:
-                    self.lazy_copy(rec, dst, k)
+                if len(rec.list) > 1:
+                    self.lazy_fan_out_copy(rec, k)
+                else:
+                    for dst in rec.list:
+                        self.lazy_copy(rec, dst, k)
         for rec in remove:
             for dst in self.dest_dirs:
                 self.lazy_remove(dst, key + '/' + rec.name)
@@ -846,45 +2439,47 @@ class Backup:
     def recovery_for_each_dest(self, key: str) -> Tuple[Set[str],
                                                         Dict[str, RecoveryEntry],
                                                         List[RecoveryEntry],
-                                                        Tuple[List[RecoveryEntry], List[RecoveryEntry]]]:
+                                                        Tuple[List[RecoveryEntry], ...]]:
         """ Вызывает recovery_for_each для всех целевых каталогов """
         md5dirs = set()  # type: Set[str] # контрольные суммы этих каталогов будут перезаписаны
         file_dict = {}  # type: Dict[str, RecoveryEntry]
         recovery = []  # type: List[RecoveryEntry]
-        lists = ([], [])  # type: Tuple[List[RecoveryEntry], List[RecoveryEntry]]
+        lists = tuple([] for _ in self.separators)  # type: Tuple[List[RecoveryEntry], ...]
 
-        def recovery_key_search(dest: str, file: str) -> None:
-            self.recovery_key_search(dest, key + '/' + file, file, md5dirs, file_dict, recovery, lists)
-
-        for dst in self.dest_dirs:
+        listings = self.list_pool.map(lambda dst: self.recovery_for_each(dst, key), self.dest_dirs, lambda _: '')
+        for dst, listing in zip(self.dest_dirs, listings):
             log.debug('for dst=%s in %s', dst, self.dest_dirs)
-            self.recovery_for_each(dst, key, recovery_key_search)
+            for name, is_dir, is_file in listing:
+                self.recovery_key_search(dst, key + '/' + name, name, is_dir, is_file,
+                                         md5dirs, file_dict, recovery, lists)
 
         return md5dirs, file_dict, recovery, lists
 
     @staticmethod
-    def recovery_for_each(dst: str, key: str, recovery_key_search: Callable[[str, str], None]) -> None:
-        """ Вызывает recovery_key_search для всех дочерних файлов/каталогов """
+    def recovery_for_each(dst: str, key: str) -> List[Tuple[str, bool, bool]]:
+        """ Возвращает дочерние файлы/каталоги: (имя, это каталог, это файл) """
         path = dst + key
-        if not os.path.isdir(path):
+        try:
+            with os.scandir(path) as it:
+                listing = [(entry.name, entry.is_dir(), entry.is_file()) for entry in it]
+        except (FileNotFoundError, NotADirectoryError):
             log.debug('continue')
-            return
-        listdir = os.listdir(path)
-        log.debug('for name in %s', listdir)
-        for name in listdir:
-            log.debug('for name=%s in os.listdir.path(%s)', name, path)
-            recovery_key_search(dst, name)
+            return []
+        log.debug('for name in %s', listing)
+        return listing
 
     def recovery_key_search(self,
                             dst: str,
                             key: str,
                             name: str,
+                            is_dir: bool,
+                            is_file: bool,
                             md5dirs: Set[str],
                             file_dict: Dict[str, RecoveryEntry],
                             recovery: List[RecoveryEntry],
-                            lists: Tuple[List[RecoveryEntry], List[RecoveryEntry]]) -> None:
+                            lists: Tuple[List[RecoveryEntry], ...]) -> None:
         """
-        Исследует файл/каталог dst + key:
+        Исследует файл/каталог dst + key, тип которого уже известен из листинга:
           * вызывает рекурсивно для дочерних каталогов recovery_dirs;
           * файлы с контрольными суммами, *.md5;
           * запоминает в md5dirs каталоги, для которых должны сохраниться контрольные суммы.
@@ -892,17 +2487,17 @@ class Backup:
           * Накапливает в recovery RecoveryEntry файлов, которые безусловно должны остаться в бэкапе.
           * Накапливает в lists RecoveryEntry файлов, которые могут удаляться из бэкапа по условию.
         """
-        path = dst + key
-        if os.path.isdir(path):
+        if is_dir:
             log.debug('enter into self.recovery_dirs(%s)', key)
             self.recovery_dirs(key)
             log.debug('leave from self.recovery_dirs(%s)', key)
-        elif os.path.isfile(path):
+        elif is_file:
             if name.endswith(".md5"):
                 if name != ".md5":
                     md5dirs.add(dst)
-            elif name not in file_dict and name != '.checksum' and key != '/.lock':
-                entry, index = self.recovery_entry(name)
+            elif name not in file_dict and name not in ('.checksum', '.checksum.bin', '.manifest', '.index') \
+                    and key != '/.lock':
+                entry, index = self.recovery_entry(name, key)
                 file_dict[name] = entry
                 if index < 0:
                     log.debug('recovery.append(%s)', name)
@@ -928,6 +2523,9 @@ class Backup:
                                files: Set[str]) -> Dict[str, Tuple[str, float]]:
         """ Возвращает контрольные суммы из лога и файлов *.md5 в директории """
         log_md5_with_time = load_md5_with_times(checksum_path)
+        for key, value in load_checksum_log(checksum_path + '.bin').items():
+            if key not in log_md5_with_time or value[1] >= log_md5_with_time[key][1]:
+                log_md5_with_time[key] = value
         dir_md5_with_time = {key: log_md5_with_time[key]
                              for key in filter(lambda f: f in files, log_md5_with_time)}
         for name in filter(lambda f: f.endswith('.md5'), files):
@@ -948,8 +2546,93 @@ class Backup:
 
     def slow_check_dirs(self) -> None:
         """ Медленно вычисляет контрольные суммы директорий, чтоб не создавать нагрузку на систему """
+        self.scrub()
+        self.check_recipes()
+
+    def scrub(self) -> None:
+        """ Проверяет файлы всех директорий, начиная с давно проверенных, пока не исчерпан бюджет времени или объёма.
+        Курсором служит время проверки в '.checksum': следующий запуск продолжит с давно проверенных файлов """
+        planner = ScrubPlanner()
         for directory in self.sorted_dirs():
-            self.slow_check_dir(directory)
+            try:
+                device = os.stat(directory).st_dev
+                checksums = self.rewrite_dir_checksums(directory)
+            except OSError as e:
+                self.error('scrub error: %s', e)
+                continue
+            for name, (checksum, sum_time) in checksums.items():
+                try:
+                    size = os.path.getsize(directory + '/' + name)
+                except OSError as e:
+                    self.error('scrub error: %s', e)
+                    continue
+                planner.push(sum_time, size, directory, name, checksum, device)
+        planner.select(int(self.check_size_limit * 1024 * 1024))
+        deadline = time.time() + self.check_time_limit
+
+        def check(device: int) -> None:
+            while self.check_time_limit <= 0 or time.time() <= deadline:
+                item = planner.pop(device)
+                if item is None:
+                    break
+                self.check_file(item[2], item[3], item[4])
+                planner.done(item)
+
+        workers = [device for device, heap in planner.heaps.items()
+                   for _ in range(max(1, self.checksum_pool.count(heap[0][2])))]
+        if len(workers) == 1:
+            check(workers[0])
+        elif len(workers) > 1:
+            with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+                for future in [executor.submit(check, device) for device in workers]:
+                    future.result()
+        self.scrub_report(planner.rest(), planner.count, planner.size)
+
+    def scrub_report(self, rest: List[Tuple[float, int, str, str, str, int]], count: int, size: int) -> None:
+        """ Сообщает, сколько проверено и насколько проверка отстаёт от периода check_period """
+        overdue = [item for item in rest if item[0] < self.checked]
+        log.info('scrub: checked %d files %d MB, %d files left', count, size // (1024 * 1024), len(rest))
+        if len(overdue) > 0:
+            log.warning('scrub: %d files %d MB not checked for %d days, %.1f days behind schedule',
+                        len(overdue), sum(item[1] for item in overdue) // (1024 * 1024), self.check_period,
+                        (self.checked - min(item[0] for item in overdue)) / (24 * 3600))
+
+    def recipes(self, dst: str) -> Optional[Dict[str, List[str]]]:
+        """ Возвращает блоки всех рецептов целевой директории: {путь рецепта: [путь блока]}.
+        None, если рецепт не удалось прочитать """
+        result = {}
+        for root, dirs, files in os.walk(dst):
+            dirs[:] = [d for d in dirs if d != ChunkStore.DIR]
+            for name in files:
+                if name.endswith('.recipe'):
+                    path = root + '/' + name
+                    try:
+                        with open(path, encoding='UTF-8') as fd:
+                            result[path] = [line.strip() for line in fd if line.strip() != '']
+                    except IOError as e:
+                        self.error("recipe %s error: %s", path, e)
+                        return None
+        return result
+
+    def referenced_chunks(self) -> Optional[Set[str]]:
+        """ Возвращает имена блоков, на которые ссылаются рецепты всех целевых директорий.
+        None, если какой-то рецепт не удалось прочитать: тогда блоки не удаляются """
+        referenced = set()
+        for dst in self.dest_dirs:
+            recipes = self.recipes(dst)
+            if recipes is None:
+                return None
+            for chunks in recipes.values():
+                referenced.update(os.path.basename(chunk) for chunk in chunks)
+        return referenced
+
+    def check_recipes(self) -> None:
+        """ Проверяет, что все блоки рецептов есть в хранилище своей целевой директории """
+        for dst in self.dest_dirs:
+            for path, chunks in (self.recipes(dst) or {}).items():
+                missing = [chunk for chunk in chunks if not os.path.isfile(dst + '/' + chunk)]
+                if len(missing) > 0:
+                    self.error("recipe %s error: missing chunks %s", path, ' '.join(missing))
 
     def sorted_dirs(self) -> List[str]:
         """ Возвращает каталоги отсортированные по времени модификации дочерних файлов """
@@ -959,14 +2642,13 @@ class Backup:
         return sorted([d for d in time_by_dir],
                       key=lambda d: time_by_dir[d])
 
-    def slow_check_dir(self, directory: str) -> None:
-        """ Медленно вычисляет контрольные суммы директории, чтоб не создавать нагрузку на систему """
-        for name, checksum in self.sorted_name_with_checksum(self.rewrite_dir_checksums(directory)):
-            sum_time = time.time()
-            real = md5sum(directory + '/' + name, multiplier=self.with_sleep_multiplier)
-            if real != checksum:
-                checksum = 'corrupted'
-            self.safe_append_checksum(directory, name, checksum, sum_time)
+    def check_file(self, directory: str, name: str, checksum: str) -> None:
+        """ Медленно вычисляет контрольную сумму файла и записывает её со временем проверки """
+        sum_time = time.time()
+        real = md5sum(directory + '/' + name, multiplier=self.rate_limiter, algorithm=hash_algorithm(checksum))
+        if real != checksum:
+            checksum = 'corrupted'
+        self.safe_append_checksum(directory, name, checksum, sum_time)
 
     @classmethod
     def time_by_directory(cls, directory: str) -> Dict[str, float]:
@@ -977,24 +2659,41 @@ class Backup:
                 result[root] = cls.max_time(root, files)
         return result
 
-    @staticmethod
-    def sorted_name_with_checksum(checksum_with_time_by_name: Dict[str, Tuple[str, float]]) \
-            -> List[Tuple[str, str]]:
-        return sorted(map(lambda name: (name, checksum_with_time_by_name[name][0]), checksum_with_time_by_name),
-                      key=lambda k: checksum_with_time_by_name[k[0]][1])
-
     def rewrite_dir_checksums(self, directory: str) -> Dict[str, Tuple[str, float]]:
-        """ Перезаписывает контрольные суммы файлов директории в файл '.checksum' """
+        """ Перезаписывает контрольные суммы файлов директории в файл '.checksum' или в каталог """
+        if self.catalog is not None:
+            return self.catalog_checksums(directory)
         checksum_with_time_by_name = self.read_directory_md5_with_time(directory)
         checksum_path = self.checksum_path(directory)
+        if self.checksum_format == 'binary':
+            checksum_path, old_path = checksum_path + '.bin', checksum_path
+            write = self.write_checksum_log_dict
+        else:
+            old_path = checksum_path + '.bin'
+            write = self.write_md5_with_time_dict
         if len(checksum_with_time_by_name) == 0:
             remove_file(checksum_path)
-        else:
-            self.safe_write(checksum_path,
-                            lambda fd: self.write_md5_with_time_dict(fd, checksum_with_time_by_name),
-                            lambda: 'update ' + checksum_path)
+        elif self.safe_write(checksum_path,
+                             lambda fd: write(fd, checksum_with_time_by_name),
+                             lambda: 'update ' + checksum_path):
+            remove_file(old_path)
         return checksum_with_time_by_name
 
+    def compact_checksums(self, directory: str) -> None:
+        """ Перезаписывает журнал контрольных сумм директории, когда он больше checksum_compact_size
+        и вырос вдвое с прошлой перезаписи """
+        path = self.checksum_path(directory)
+        if self.checksum_format == 'binary':
+            path += '.bin'
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        if size > max(self.checksum_compact_size * 1024 * 1024, 2 * self.compacted.get(directory, 0)):
+            log.debug('compact %s: %s bytes', path, size)
+            self.rewrite_dir_checksums(directory)
+            self.compacted[directory] = os.path.getsize(path) if os.path.isfile(path) else 0
+
     @staticmethod
     def max_time(directory: str, files: List[str]) -> float:
         """ Возвращает максимальное время модификации дочерних файлов директорий """
@@ -1003,14 +2702,32 @@ class Backup:
     def safe_append_checksum(self, directory: str, name: str, checksum: str, sum_time: float) -> None:
         """ Записывает контрольную сумму файла с подавлением исключения """
         try:
-            self.append_checksum(directory, name, checksum, sum_time)
+            if self.catalog is not None:
+                st = os.stat(directory + '/' + name)
+                self.catalog.update(directory, [(name, checksum, sum_time, st.st_size, st.st_mtime)])
+                return
+            with self.directory_lock(directory):
+                self.append_checksum(directory, name, checksum, sum_time)
+                self.compact_checksums(directory)
         except BaseException as e:
             self.error('append checksum error: %s', e)
 
+    def directory_lock(self, directory: str) -> threading.Lock:
+        """ Возвращает блокировку журнала контрольных сумм директории """
+        with self.lock:
+            lock = self.directory_locks.get(directory)
+            if lock is None:
+                lock = self.directory_locks[directory] = threading.Lock()
+            return lock
+
     @classmethod
     def append_checksum(cls, directory: str, name: str, checksum: str, sum_time: float) -> None:
-        """ Дописывает в файл '.checksum' одну запись в режиме append """
-        with_open(cls.checksum_path(directory), 'ab', lambda fd: cls.write_md5_with_time(fd, name, checksum, sum_time))
+        """ Дописывает в файл '.checksum', или в '.checksum.bin', если он есть, одну запись в режиме append """
+        checksum_path = cls.checksum_path(directory)
+        if os.path.isfile(checksum_path + '.bin'):
+            with_open(checksum_path + '.bin', 'ab', lambda fd: write_checksum_record(fd, name, checksum, sum_time))
+        else:
+            with_open(checksum_path, 'ab', lambda fd: cls.write_md5_with_time(fd, name, checksum, sum_time))
 
     @classmethod
     def write_md5_with_time_dict(cls, fd: IO, md5_with_time: Dict[str, Tuple[str, float]]) -> None:
@@ -1019,28 +2736,35 @@ class Backup:
             md5_sum, sum_time = md5_with_time[k]
             cls.write_md5_with_time(fd, k, md5_sum, sum_time)
 
+    @classmethod
+    def write_checksum_log_dict(cls, fd: IO, md5_with_time: Dict[str, Tuple[str, float]]) -> None:
+        """ Перезаписывает двоичный журнал контрольных сумм """
+        for k in cls.sorted_md5_with_time_by_time(md5_with_time):
+            write_checksum_record(fd, k, md5_with_time[k][0], md5_with_time[k][1])
+
+    @staticmethod
+    def write_md5_dict(fd: IO, md5_with_time: Dict[str, Tuple[str, float]]) -> None:
+        """ Пишет контрольные суммы в формате '.md5' """
+        for name in sorted(md5_with_time):
+            write_md5(fd, md5_with_time[name][0], name)
+
     @staticmethod
     def write_md5_with_time(fd: IO, key: str, checksum: str, sum_time: float) -> None:
         """ Записывает в файл '.checksum' одну запись"""
         fd.write(bytes('%s %s %s\n' % (checksum, time_to_string(sum_time), key), 'UTF-8'))
 
-    @staticmethod
-    def with_sleep_multiplier():
-        """ Спит 10 ms каждые 4 кБайт. 1 ГБайт обработает не менее чем за 43 минуты """
-        time.sleep(0.01)
-        return 4
-
     @staticmethod
     def sorted_md5_with_time_by_time(md5_with_time: Dict[str, Tuple[str, float]]) -> List[str]:
         """ Сортирует контрольные суммы по времени """
         return sorted(md5_with_time, key=lambda k: md5_with_time[k][1])
 
-    def recovery_entry(self, name: str) -> Tuple[RecoveryEntry, int]:
-        """ Возвращает созданный RecoveryEntry и индекс классификатора имён файлов """
+    def recovery_entry(self, name: str, key: str = '') -> Tuple[RecoveryEntry, int]:
+        """ Возвращает созданный RecoveryEntry и индекс классификатора имён файлов.
+        key - путь файла от целевой директории """
         entry = RecoveryEntry(name)
         for i in range(len(self.separators)):
             separator = self.separators[i]
-            matcher = separator.pattern.match(name)
+            matcher = separator.match(key, name)
             if matcher is not None:
                 separator.init(entry, matcher)
                 return entry, i
@@ -1051,6 +2775,14 @@ class Backup:
         log.debug("lazy cp %s%s %s%s", rec.dir, key, dst, key)
         self.commands[dst].append(lambda: self.copy(rec, dst, key))
 
+    def lazy_fan_out_copy(self, rec: RecoveryEntry, key: str) -> None:
+        """ Выполняет отложенное копирование файла сразу во все директории rec.list """
+        log.debug("lazy cp %s%s %s", rec.dir, key, ' '.join(dst + key for dst in rec.list))
+        dst_dirs = list(rec.list)
+        command = SharedCommand(lambda: self.fan_out_copy(rec, dst_dirs, key))
+        for dst in dst_dirs:
+            self.commands[dst].append(command)
+
     def lazy_remove(self, dst: str, key: str) -> None:
         """ Выполняет отложенное удаление файла """
         path = dst + key
@@ -1097,6 +2829,46 @@ class Backup:
         finally:
             self.safe_remove(tmp)
 
+    def safe_write_all(self, files: List[str], write: Callable[[IO], None], name: Callable[[], str]) -> List[str]:
+        """ Безопасно пишет одни и те же данные в несколько файлов. Ошибка записи одного файла не мешает остальным.
+        Возвращает записанные файлы """
+        tmps = {file: file + ".tmp" for file in files}
+        outs = {}  # type: Dict[str, IO]
+        written = []  # type: List[str]
+        try:
+            for file, tmp in tmps.items():
+                try:
+                    remove_file(tmp)
+                    mkdirs(os.path.dirname(file))
+                    outs[file] = open(tmp, "wb")
+                except Exception as e:
+                    self.error("%s error: %s: %s\n%s", name(), file, e, traceback.format_exc())
+            fan_out = FanOut(outs)
+            try:
+                write(fan_out)
+            finally:
+                fan_out.close()
+                for file, fd in outs.items():
+                    try:
+                        fd.close()
+                    except Exception as e:
+                        fan_out.errors.setdefault(file, e)
+            for file, e in fan_out.errors.items():
+                self.error("%s error: %s: %s", name(), file, e)
+            for file in filter(lambda f: f in outs and f not in fan_out.errors, files):
+                try:
+                    remove_file(file)
+                    os.rename(tmps[file], file)
+                    written.append(file)
+                except Exception as e:
+                    self.error("%s error: %s: %s\n%s", name(), file, e, traceback.format_exc())
+        except Exception as e:
+            self.error("%s error: %s\n%s", name(), e, traceback.format_exc())
+        finally:
+            for tmp in tmps.values():
+                self.safe_remove(tmp)
+        return written
+
     def safe_remove(self, path: str) -> None:
         """ Удаляет файл с подавлением исключений """
         try:
@@ -1120,25 +2892,105 @@ class Backup:
         dst = dst_dir + key
         name = 'cp %s %s' % (src, dst)
         sw = StopWatch(name)
-        if self.safe_write(dst, lambda out: self.do_copy(out, src, rec.md5[src_dir]), lambda: name):
+        if self.safe_write(dst, lambda out: self.do_copy(out, src, rec.md5[src_dir], self.copy_buffers), lambda: name):
             rec.md5[dst_dir] = rec.md5[src_dir]
         sw.stop()
 
-    @staticmethod
-    def do_copy(out: IO, src: str, expected: str) -> None:
+    def fan_out_copy(self, rec: RecoveryEntry, dst_dirs: List[str], key: str) -> None:
+        """ Копирует файл сразу в несколько директорий, читая и проверяя источник один раз """
+        src_dir = rec.dir if self.dest_dirs[0] in rec.list else self.dest_dirs[0]
+        src = src_dir + key
+        name = 'cp %s %s' % (src, ' '.join(dst + key for dst in dst_dirs))
+        sw = StopWatch(name)
+        written = self.safe_write_all([dst + key for dst in dst_dirs],
+                                      lambda out: self.do_copy(out, src, rec.md5[src_dir], self.copy_buffers),
+                                      lambda: name)
+        for dst_dir in dst_dirs:
+            if dst_dir + key in written:
+                rec.md5[dst_dir] = rec.md5[src_dir]
+        sw.stop()
+
+    @classmethod
+    def do_copy(cls, out: IO, src: str, expected: str, buffers: int = 0) -> None:
+        """ Копирует файл, проверяя контрольную сумму. При buffers > 1 читает, считает сумму и пишет параллельно """
+        algorithm = hash_algorithm(expected)
+
         def copy(fd: IO):
-            checksum = hashlib.md5()
+            checksum = new_hash(algorithm)
             while True:
                 buf = fd.read(1024 * 1024)
                 if len(buf) == 0:
-                    return checksum.hexdigest().lower()
+                    return format_checksum(checksum)
                 checksum.update(buf)
                 out.write(buf)
 
-        actual = with_open(src, 'rb', copy)
+        if buffers > 1:
+            actual = with_open(src, 'rb', lambda fd: cls.pipelined_copy(fd, out, algorithm, buffers))
+        else:
+            actual = with_open(src, 'rb', copy)
         if actual != expected:
             raise IOError('Corrupted [%s]. Checksum is %s but expected %s' % (src, actual, expected))
 
+    @staticmethod
+    def pipelined_copy(fd: IO, out: IO, algorithm: str, buffers: int, buffer_size: int = 1024 * 1024) -> str:
+        """ Копирует поток конвейером через кольцо переиспользуемых буферов:
+        чтение, подсчёт контрольной суммы и запись идут в разных потоках. Возвращает контрольную сумму """
+        free = queue.Queue()  # type: queue.Queue # свободные буферы, None - остановка чтения
+        hashing = queue.Queue()  # type: queue.Queue # прочитанные (буфер, длина), None - конец
+        writing = queue.Queue()  # type: queue.Queue # посчитанные (буфер, длина), None - конец
+        for _ in range(buffers):
+            free.put(memoryview(bytearray(buffer_size)))
+        checksum = new_hash(algorithm)
+        errors = []  # type: List[BaseException]
+
+        def read() -> None:
+            try:
+                while True:
+                    buf = free.get()
+                    if buf is None:
+                        return
+                    n = fd.readinto(buf)
+                    if not n:
+                        return
+                    hashing.put((buf, n))
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                hashing.put(None)
+
+        def update() -> None:
+            while True:
+                item = hashing.get()
+                if item is None:
+                    writing.put(None)
+                    return
+                buf, n = item
+                checksum.update(buf[:n])
+                writing.put(item)
+
+        threads = [threading.Thread(target=read), threading.Thread(target=update)]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = writing.get()
+                if item is None:
+                    break
+                buf, n = item
+                out.write(buf[:n])
+                free.put(buf)
+        finally:
+            free.put(None)
+            for thread in threads:
+                thread.join()
+        if len(errors) > 0:
+            raise errors[0]
+        return format_checksum(checksum)
+
+    def checksums(self, paths: List[str]) -> Dict[str, Tuple[Optional[str], bool]]:
+        """ Параллельно проверяет контрольные суммы файлов, см. checksum """
+        return dict(zip(paths, self.checksum_pool.map(self.checksum, paths)))
+
     def checksum(self, path: str) -> Tuple[Optional[str], bool]:
         """ Проверяет контрольную сумму файла. Возвращает её, или None, если сумма не верна
             и флаг, что сумма была вычислена, а не взята из файла. Вычисленная будет перезаписана """
@@ -1152,7 +3004,7 @@ class Backup:
         if sum_time is None or self.checked < sum_time:  # sum_time is None когда и stored is None, суммы нет
             return stored, False
         sum_time = time.time()
-        real = self.safe_md5sum(path)
+        real = self.safe_md5sum(path, hash_algorithm(stored))
         if stored != real:
             self.safe_append_checksum(directory, name, 'corrupted', sum_time)
             checksum_by_name[name] = (None, None)
@@ -1161,23 +3013,90 @@ class Backup:
         checksum_by_name[name] = (stored, None)
         return stored, True
 
-    def safe_md5sum(self, path: str) -> Optional[str]:
+    def safe_md5sum(self, path: str, algorithm: str = 'md5') -> Optional[str]:
         """ Вычисляет контрольную сумму файла с подавлением исключения """
         try:
-            return md5sum(path, is_stop_watch=False)
+            return md5sum(path, is_stop_watch=False, algorithm=algorithm)
         except BaseException as e:
             self.error('md5sum error: %s\n%s', e, traceback.format_exc())
             return None
 
     def checksum_by_name(self, directory: str) -> Dict[str, Tuple[Optional[str], Optional[float]]]:
         """ Возвращает контрольные суммы файлов в директории из *.checksum и файлов *.md5. Кэширует результат """
-        result = self.checksums_by_dir.get(directory)
-        if result is not None:
+        with self.lock:
+            result = self.checksums_by_dir.get(directory)
+            if result is not None:
+                return result
+            if self.catalog is not None:
+                result = self.catalog_checksums(directory)
+            else:
+                result = self.read_directory_md5_with_time(directory)
+            self.checksums_by_dir[directory] = result
             return result
-        result = self.read_directory_md5_with_time(directory)
-        self.checksums_by_dir[directory] = result
+
+    def catalog_checksums(self, directory: str) -> Dict[str, Tuple[str, float]]:
+        """ Возвращает контрольные суммы файлов директории из каталога.
+        Суммы файлов, которых нет в каталоге или которые изменились, читает из *.md5 и '.checksum',
+        и записывает в каталог. Удаляет из каталога исчезнувшие файлы """
+        stats = {}  # type: Dict[str, os.stat_result]
+        if os.path.isdir(directory):
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_file():
+                        stats[entry.name] = entry.stat()
+        stored = self.catalog.load(directory)
+        result = {}  # type: Dict[str, Tuple[str, float]]
+        for name, (checksum, verified, size, mtime) in stored.items():
+            st = stats.get(name)
+            if st is not None and (st.st_size, st.st_mtime) == (size, mtime) and is_checksum(checksum):
+                result[name] = (checksum, verified)
+        lost = set(filter(lambda n: n not in result and not n.startswith('.') and not n.endswith('.md5'), stats))
+        rows = []
+        if len(lost) > 0:
+            read = self.read_dir_md5_with_time(directory, self.checksum_path(directory), set(stats))
+            for name in filter(lambda n: n in read, lost):
+                result[name] = read[name]
+                rows.append((name,) + read[name] + (stats[name].st_size, stats[name].st_mtime))
+        removed = [name for name in stored if name not in stats]
+        if len(rows) > 0 or len(removed) > 0:
+            self.catalog.update(directory, rows, removed)
         return result
 
+    def catalog_import(self) -> None:
+        """ Импортирует контрольные суммы из файлов *.md5 и '.checksum' в каталог """
+        self.require_catalog()
+        for dst in self.dest_dirs:
+            for root, dirs, files in os.walk(dst):
+                checksums = self.read_directory_md5_with_time(root)
+                rows = []
+                for name, (checksum, verified) in checksums.items():
+                    st = os.stat(root + '/' + name)
+                    rows.append((name, checksum, verified, st.st_size, st.st_mtime))
+                removed = [name for name in self.catalog.load(root) if name not in checksums]
+                self.catalog.update(root, rows, removed)
+                log.info('[%s]: imported %s checksums', root, len(rows))
+
+    def catalog_export(self) -> None:
+        """ Экспортирует каталог в файлы '.md5' и '.checksum' """
+        self.require_catalog()
+        for dst in self.dest_dirs:
+            for directory in self.catalog.directories(dst):
+                checksums = self.catalog_checksums(directory)
+                if len(checksums) == 0:
+                    continue
+                self.safe_write(directory + '/.md5',
+                                lambda fd: self.write_md5_dict(fd, checksums),
+                                lambda: 'export %s/.md5' % directory)
+                self.safe_write(self.checksum_path(directory),
+                                lambda fd: self.write_md5_with_time_dict(fd, checksums),
+                                lambda: 'export ' + self.checksum_path(directory))
+                log.info('[%s]: exported %s checksums', directory, len(checksums))
+
+    def require_catalog(self) -> None:
+        """ Проверяет, что каталог настроен """
+        if self.catalog is None:
+            raise ValueError('"catalog" is not configured in ~/.config/backup/backup.cfg')
+
     @staticmethod
     def checksum_path(directory: str) -> str:
         return directory + '/.checksum'
@@ -1185,8 +3104,10 @@ class Backup:
     def error(self, msg, *args):
         """ Пишет сообщение в лог. Добавляет сообщение для отправки email """
         log.error(msg, *args)
-        if self.smtp_host is not None:
-            self.errors.append(msg % args)
+        with self.lock:
+            self.error_count += 1
+            if self.smtp_host is not None:
+                self.errors.append(msg % args)
 
     def arg(self):
         """ Возвращает sys.arg[self.arg_index], или выводит справку и завершает работу """
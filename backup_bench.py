@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Замеры производительности горячих путей backup.py на синтетическом дереве во временной директории.
+Результаты пишутся в JSON и сравниваются с базовым прогоном:
+
+    backup_bench.py --files 10000 --archive-mb 1024 --output bench.json
+    backup_bench.py --files 10000 --archive-mb 1024 --baseline bench.json
+
+Проверка дерева замеряется через scrub, который заменил slow_check_dir.
+Заглушки svnadmin и git ни одним замером не вызываются: они лишь гарантируют, что случайный вызов
+не запустит настоящие программы. Замеров svn и git нет
+"""
+import argparse
+import hashlib
+import json
+import logging as log
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+import backup
+from backup import Backup
+
+# заглушки внешних программ: при замерах ни один путь не должен запускать настоящие tar, gzip, svnadmin и git
+STAND_INS = {
+    'tar': '#!/bin/sh\nexit 0\n',
+    'gzip': '#!/bin/sh\nexec cat\n',
+    'svnadmin': '#!/bin/sh\nexit 0\n',
+    'git': '#!/bin/sh\nexit 0\n',
+}
+FILES_PER_DIR = 100  # файлов в каталоге синтетического дерева
+DATED_ARCHIVES = 1000  # архивов с датой в имени для up_to_date
+
+
+class BenchTree:
+    """ Синтетическое дерево: два зеркала мелких файлов с '.md5' и '.checksum', большой архив и архивы с датами """
+
+    def __init__(self, root: str, files: int, archive_mb: int):
+        self.root = root  # type: str
+        self.files = files  # type: int # число мелких файлов
+        self.archive_mb = archive_mb  # type: int # размер большого архива в МБайт
+        self.mirrors = [root + '/m1', root + '/m2']  # type: List[str]
+        self.dirs = []  # type: List[str] # каталоги мелких файлов первого зеркала
+        self.archive = root + '/scrub/archive-2024-01-01.tar.gz'  # type: str
+        self.archive_checksum = ''  # type: str
+        self.dated = root + '/dated'  # type: str
+
+    def build(self) -> None:
+        """ Создаёт дерево, заглушки внешних программ и добавляет их в PATH """
+        bin_dir = self.root + '/bin'
+        os.makedirs(bin_dir)
+        for name, script in STAND_INS.items():
+            with open(bin_dir + '/' + name, 'w', encoding='UTF-8') as fd:
+                fd.write(script)
+            os.chmod(bin_dir + '/' + name, 0o755)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+        self.build_files()
+        self.build_archive()
+        self.build_dated()
+
+    def build_files(self) -> None:
+        """ Создаёт мелкие файлы с контрольными суммами в первом зеркале и жёсткие ссылки во втором """
+        now = time.time()
+        for start in range(0, self.files, FILES_PER_DIR):
+            directory = '%s/d%06d' % (self.mirrors[0], start // FILES_PER_DIR)
+            os.makedirs(directory)
+            self.dirs.append(directory)
+            checksums = {}
+            for i in range(start, min(start + FILES_PER_DIR, self.files)):
+                name = 'file-%07d.dat' % i
+                data = bytes('%s\n' % i, 'UTF-8') * 64
+                with open(directory + '/' + name, 'wb') as fd:
+                    fd.write(data)
+                checksums[name] = (hashlib.md5(data).hexdigest(), now)
+            with open(directory + '/.md5', 'wb') as fd:
+                Backup.write_md5_dict(fd, checksums)
+            with open(directory + '/.checksum', 'wb') as fd:
+                Backup.write_md5_with_time_dict(fd, checksums)
+        for root, dirs, files in os.walk(self.mirrors[0]):
+            target = self.mirrors[1] + root[len(self.mirrors[0]):]
+            os.makedirs(target)
+            for name in files:
+                os.link(root + '/' + name, target + '/' + name)
+
+    def build_archive(self) -> None:
+        """ Создаёт большой архив для md5sum, do_copy и scrub """
+        os.makedirs(os.path.dirname(self.archive))
+        block = os.urandom(1024 * 1024)
+        checksum = hashlib.md5()
+        with open(self.archive, 'wb') as fd:
+            for _ in range(self.archive_mb):
+                fd.write(block)
+                checksum.update(block)
+        self.archive_checksum = checksum.hexdigest()
+        with open(os.path.dirname(self.archive) + '/.md5', 'wb') as fd:
+            backup.write_md5(fd, self.archive_checksum, os.path.basename(self.archive))
+
+    def build_dated(self) -> None:
+        """ Создаёт архивы с датами в именах, как их пишет generic_backup """
+        os.makedirs(self.dated)
+        checksums = {}
+        day = time.mktime((2020, 1, 1, 12, 0, 0, 0, 0, -1))
+        for i in range(DATED_ARCHIVES):
+            name = 'src-%s.tar.gz' % time.strftime('%Y-%m-%d', time.localtime(day + i * 24 * 3600))
+            with open(self.dated + '/' + name, 'wb') as fd:
+                fd.write(bytes(name, 'UTF-8'))
+            checksums[name] = (hashlib.md5(bytes(name, 'UTF-8')).hexdigest(), time.time())
+        with open(self.dated + '/.md5', 'wb') as fd:
+            Backup.write_md5_dict(fd, checksums)
+
+
+def clone_backup(dest_dirs: List[str]) -> Backup:
+    """ Возвращает Backup, настроенный как для команды clone, без чтения конфигурации """
+    subj = Backup()
+    subj.config = {}
+    argv = sys.argv
+    try:
+        sys.argv = ['backup.py', 'clone', ','.join(dest_dirs), '3']
+        subj.command()
+    finally:
+        sys.argv = argv
+    return subj
+
+
+def check_errors(subj: Backup) -> None:
+    """ Прерывает замеры, если Backup сообщил об ошибках: замер ошибочного пути ничего не значит.
+    Ошибки считаются и без SMTP, их тексты уже выведены в журнал """
+    if subj.error_count > 0:
+        raise RuntimeError('%d errors reported' % subj.error_count)
+
+
+def measure(func: Callable[[], None], repeat: int) -> float:
+    """ Возвращает лучшее время из repeat запусков """
+    best = None  # type: Optional[float]
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(tree: BenchTree, repeat: int) -> Dict[str, Dict[str, float]]:
+    """ Замеряет горячие пути. Возвращает {замер: {"seconds": с, "items": объём, "rate": объём/с}} """
+    archive_mb = os.path.getsize(tree.archive) / (1024 * 1024)
+    checksum_log = tree.root + '/all.checksum'
+    all_checksums = {}
+    for directory in tree.dirs:
+        for name, value in Backup.read_directory_md5_with_time(directory).items():
+            all_checksums[directory + '/' + name] = value
+    with open(checksum_log, 'wb') as fd:
+        Backup.write_md5_with_time_dict(fd, all_checksums)
+    with open(checksum_log + '.bin', 'wb') as fd:
+        Backup.write_checksum_log_dict(fd, all_checksums)
+
+    def do_copy(buffers: int) -> Callable[[], None]:
+        def copy() -> None:
+            with open(os.devnull, 'wb') as out:
+                Backup.do_copy(out, tree.archive, tree.archive_checksum, buffers)
+        return copy
+
+    def read_directories() -> None:
+        for directory in tree.dirs:
+            Backup.read_directory_md5_with_time(directory)
+
+    def recovery_dirs() -> None:
+        subj = clone_backup(tree.mirrors)
+        subj.recovery_dirs('')
+        subj.checksum_pool.shutdown()
+        subj.list_pool.shutdown()
+        check_errors(subj)
+
+    def up_to_date() -> None:
+        subj = clone_backup([tree.dated])
+        subj.last_modified_time = 0
+        subj.up_to_date(tree.root + '/src', tree.dated)
+
+    def scrub() -> None:
+        subj = clone_backup([os.path.dirname(tree.archive)])
+        subj.rate_limiter = backup.RateLimiter(0)
+        subj.scrub()
+        subj.checksum_pool.shutdown()
+        check_errors(subj)
+
+    benchmarks = [
+        ('md5sum', lambda: backup.md5sum(tree.archive, is_stop_watch=False), archive_mb, 'MB'),
+        ('do_copy', do_copy(0), archive_mb, 'MB'),
+        ('do_copy_pipelined', do_copy(4), archive_mb, 'MB'),
+        ('load_md5_with_times', lambda: backup.load_md5_with_times(checksum_log), len(all_checksums), 'files'),
+        ('load_checksum_log', lambda: backup.load_checksum_log(checksum_log + '.bin'), len(all_checksums), 'files'),
+        ('read_directory_md5_with_time', read_directories, tree.files, 'files'),
+        ('recovery_dirs', recovery_dirs, 2 * tree.files, 'files'),
+        ('up_to_date', up_to_date, DATED_ARCHIVES, 'files'),
+        ('scrub', scrub, archive_mb, 'MB'),
+    ]
+    results = {}
+    for name, func, items, unit in benchmarks:
+        seconds = measure(func, repeat)
+        results[name] = {'seconds': seconds, 'items': items, 'unit': unit, 'rate': items / max(seconds, 1e-9)}
+        print('%-30s %10.3f s %14.1f %s/s' % (name, seconds, results[name]['rate'], unit))
+    return results
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            threshold: float) -> List[str]:
+    """ Сравнивает скорость с базовым прогоном. Возвращает замеры, которые медленнее больше чем на threshold """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        change = results[name]['rate'] / baseline[name]['rate'] - 1
+        print('%-30s %+8.1f%%' % (name, change * 100))
+        if change < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main() -> None:
+    """ Строит дерево, замеряет, пишет результаты и сравнивает с базовым прогоном """
+    parser = argparse.ArgumentParser(description='backup.py hot path benchmarks')
+    parser.add_argument('--files', type=int, default=10000, help='number of small files per mirror')
+    parser.add_argument('--archive-mb', type=int, default=1024, help='size of the large archive in MB')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the best one is kept')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare with results from this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed slowdown against the baseline')
+    parser.add_argument('--dir', help='build the tree in this directory instead of a temporary one')
+    args = parser.parse_args()
+    log.basicConfig(level=log.WARNING, stream=sys.stdout, format='%(message)s')
+    root = tempfile.mkdtemp(prefix='backup_bench-', dir=args.dir)
+    path = os.environ.get('PATH', '')
+    try:
+        tree = BenchTree(root, args.files, args.archive_mb)
+        start = time.perf_counter()
+        tree.build()
+        print('tree: %d files, %d MB archive, built in %.1f s' % (args.files, args.archive_mb,
+                                                                    time.perf_counter() - start))
+        results = run(tree, args.repeat)
+    finally:
+        os.environ['PATH'] = path
+        shutil.rmtree(root, ignore_errors=True)
+    report = {'python': platform.python_version(), 'files': args.files, 'archive_mb': args.archive_mb,
+              'results': results}
+    if args.output is not None:
+        with open(args.output, 'w', encoding='UTF-8') as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+    if args.baseline is not None:
+        with open(args.baseline, encoding='UTF-8') as fd:
+            regressions = compare(results, json.load(fd)['results'], args.threshold)
+        if len(regressions) > 0:
+            print('regressions: %s' % ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
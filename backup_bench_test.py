@@ -0,0 +1,45 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import backup
+import backup_bench
+
+
+class BackupBenchTest(TestCase):
+    def test_run(self):
+        path = os.environ.get('PATH', '')
+        try:
+            with tempfile.TemporaryDirectory() as root:
+                tree = backup_bench.BenchTree(root, 150, 1)
+                tree.build()
+
+                results = backup_bench.run(tree, 1)
+        finally:
+            os.environ['PATH'] = path
+
+        self.assertEqual(set(results), {'md5sum', 'do_copy', 'do_copy_pipelined', 'load_md5_with_times',
+                                        'load_checksum_log', 'read_directory_md5_with_time', 'recovery_dirs',
+                                        'up_to_date', 'scrub'})
+        self.assertEqual(results['read_directory_md5_with_time']['items'], 150)
+        self.assertEqual(results['recovery_dirs']['items'], 300)
+        for result in results.values():
+            self.assertGreater(result['rate'], 0)
+
+    def test_check_errors(self):
+        subj = backup.Backup()
+        subj.smtp_host = None
+        backup_bench.check_errors(subj)
+
+        with patch('backup.log', autospec=True):
+            subj.error('scrub error')
+
+        with self.assertRaises(RuntimeError):
+            backup_bench.check_errors(subj)
+
+    def test_compare(self):
+        baseline = {'a': {'rate': 100.0}, 'b': {'rate': 100.0}, 'c': {'rate': 100.0}}
+        results = {'a': {'rate': 95.0}, 'b': {'rate': 80.0}, 'c': {'rate': 150.0}, 'd': {'rate': 1.0}}
+
+        self.assertEqual(backup_bench.compare(results, baseline, 0.1), ['b'])
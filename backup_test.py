@@ -1,9 +1,18 @@
+import gzip
 import hashlib
+import io
 import json
 import logging
 import os.path
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
 import time
+from concurrent.futures import wait
 from unittest import TestCase
+from unittest import skipUnless
 from unittest import mock
 from unittest.mock import MagicMock
 from unittest.mock import Mock
@@ -19,6 +28,46 @@ from backup import TimeSeparator
 
 class BackupUnitTest(TestCase):
 
+    def test_through_dirs(self):
+        with tempfile.TemporaryDirectory() as directory:
+            src = directory + '/src'
+            for d in ('a/b/c', 'a/skip/x', 'd'):
+                os.makedirs(src + '/' + d)
+            for f in ('f1', 'a/f2', 'a/b/c/f3', 'a/skip/x/f4', 'd/f5'):
+                with open(src + '/' + f, 'wb') as fd:
+                    fd.write(bytes(f, 'UTF-8'))
+            os.symlink(src + '/a', src + '/a/b/loop')  # цикл
+            os.symlink(src + '/d', src + '/a/link')  # ссылка на директорию
+            os.symlink(src + '/none', src + '/broken')  # битая ссылка
+            dirs = []
+            files = {}
+
+            def dir_filter(path):
+                dirs.append(path)
+                return path.endswith('/skip')
+
+            def func(path, entry):
+                files[path] = entry.stat().st_size if entry.is_file() else None
+
+            with patch('backup.log', autospec=True) as mock_log:
+                backup.through_dirs(src, dir_filter, func)
+
+            mock_log.warning.assert_called_once_with('%s: directory loop ignored', src + '/a/b/loop')
+            self.assertEqual(sorted(dirs), sorted([src + '/' + d if d else src
+                                                   for d in ('', 'a', 'a/b', 'a/b/c', 'a/b/loop', 'a/skip', 'd',
+                                                             'a/link')]))
+            expected = {src + '/' + f: len(f) for f in ('f1', 'a/f2', 'a/b/c/f3', 'd/f5')}
+            expected.update({src + '/a/link/f5': len('d/f5'), src + '/broken': None})
+            self.assertEqual(files, expected)
+
+    def test_through_dirs_filtered_root(self):
+        dir_filter = Mock(return_value=True)
+        func = Mock()
+
+        backup.through_dirs('dir-%s' % uid(), dir_filter, func)
+
+        func.assert_not_called()
+
     @patch('backup.time', autospec=True)
     @patch('backup.log', autospec=True)
     def test_stop_watch(self, mock_log, mock_time):
@@ -37,23 +86,23 @@ class BackupUnitTest(TestCase):
         mock_log.info.assert_called_once_with("[%s]: %1.3f sec", msg, stop - start)
 
     @patch('backup.os.path', autospec=True)
+    @patch.object(backup, 'md5sum_stream', spec=backup.md5sum_stream)
+    @patch.object(backup, 'md5sum_mmap', spec=backup.md5sum_mmap)
     @patch.object(backup, 'stop_watch', spec=backup.stop_watch)
     @patch.object(backup, 'with_open', spec=backup.with_open)
-    def test_md5sum(self, mock_with_open, mock_stop_watch, mock_path):
-        import hashlib
-        args = [(is_input_stream, out, is_stop_watch, multiplier, is_file)
+    def test_md5sum(self, mock_with_open, mock_stop_watch, mock_md5sum_mmap, mock_md5sum_stream, mock_path):
+        args = [(is_input_stream, is_stop_watch, is_file)
                 for is_input_stream in (False, True)
-                for out in (None, Mock(name='out'))
                 for is_stop_watch in (False, True)
-                for multiplier in (None, Mock(name='multiplier'))
                 for is_file in (False, True)]
-        for is_input_stream, out, is_stop_watch, multiplier, is_file in args:
-            with self.subTest(is_input_stream=is_input_stream, out=out, is_stop_watch=is_stop_watch,
-                              multiplier=multiplier, is_file=is_file):
-                for m in (mock_with_open, mock_stop_watch, mock_path, out, multiplier):
-                    if m is not None:
-                        m.reset_mock()
+        for is_input_stream, is_stop_watch, is_file in args:
+            with self.subTest(is_input_stream=is_input_stream, is_stop_watch=is_stop_watch, is_file=is_file):
+                for m in (mock_with_open, mock_stop_watch, mock_md5sum_mmap, mock_md5sum_stream, mock_path):
+                    m.reset_mock()
                 input_stream = Mock(name='input_stream')
+                fd = Mock(name='fd')
+                out = Mock(name='out')
+                multiplier = Mock(name='multiplier')
                 path = 'path-%s' % uid()
                 mock_path.isfile.return_value = is_file
 
@@ -61,47 +110,338 @@ class BackupUnitTest(TestCase):
                     self.assertEqual(msg, 'md5sum -b %s' % path)
                     return func()
 
-                mock_stop_watch.side_effect = stop_watch
-                if multiplier is None:
-                    multiplier_value = 1024
-                else:
-                    multiplier_value = uid()
-                    multiplier.return_value = multiplier_value
-                data = [bytes('data-%s' % uid(), 'UTF-8')] * (3 + uid(5)) + [b'']
-                input_stream.read.side_effect = data
-                md5 = hashlib.md5()
-                for i in data:
-                    md5.update(i)
-                expected = md5.hexdigest().lower() if is_input_stream or is_file else None
-
                 def with_open(name, mode, handler):
                     self.assertEqual((name, mode), (path, 'rb'))
-                    return handler(input_stream)
+                    return handler(fd)
 
+                mock_stop_watch.side_effect = stop_watch
                 mock_with_open.side_effect = with_open
+                mock_md5sum_mmap.return_value = 'mmap-%s' % uid()
+                mock_md5sum_stream.return_value = 'stream-%s' % uid()
+                if is_input_stream:
+                    expected = mock_md5sum_stream.return_value
+                else:
+                    expected = mock_md5sum_mmap.return_value if is_file else None
 
                 self.assertEqual(backup.md5sum(path, input_stream if is_input_stream else None,
                                                out, is_stop_watch, multiplier), expected)
 
-                if not is_input_stream and not is_file:
+                if is_input_stream:
+                    mock_path.isfile.assert_not_called()
+                    mock_with_open.assert_not_called()
+                    mock_md5sum_stream.assert_called_once_with(input_stream, out, multiplier, 'md5')
+                    mock_md5sum_mmap.assert_not_called()
+                elif not is_file:
                     mock_with_open.assert_not_called()
                     mock_stop_watch.assert_not_called()
-                    if out is not None:
-                        out.write.assert_not_called()
+                    mock_md5sum_mmap.assert_not_called()
                 else:
-                    if is_input_stream:
-                        mock_path.isfile.assert_not_called()
-                        mock_with_open.assert_not_called()
-                        input_stream.read.assert_has_calls([call(1024 * multiplier_value)] * len(data))
+                    mock_path.isfile.assert_called_once_with(path)
+                    mock_md5sum_mmap.assert_called_once_with(fd, out, multiplier, 'md5')
+                    mock_md5sum_stream.assert_not_called()
+                    if is_stop_watch:
+                        mock_stop_watch.assert_called_once()
+                    else:
+                        mock_stop_watch.assert_not_called()
+
+    def test_md5sum_algorithm(self):
+        data = os.urandom(10000)
+        for algorithm in backup.CHECKSUM_ALGORITHMS:
+            with self.subTest(algorithm=algorithm):
+                expected = hashlib.new(algorithm, data).hexdigest()
+                if algorithm != 'md5':
+                    expected = algorithm + ':' + expected
+                with tempfile.NamedTemporaryFile() as fd:
+                    fd.write(data)
+                    fd.flush()
+
+                    self.assertEqual(backup.md5sum(fd.name, is_stop_watch=False, algorithm=algorithm), expected)
+                self.assertEqual(backup.md5sum_stream(io.BytesIO(data), algorithm=algorithm), expected)
+                self.assertTrue(backup.is_checksum(expected))
+                self.assertEqual(backup.hash_algorithm(expected), algorithm)
+
+    def test_is_checksum(self):
+        for checksum, expected in (('0' * 32, True),
+                                   ('0' * 31, False),
+                                   ('0' * 33, False),
+                                   ('md5:' + '0' * 32, True),
+                                   ('blake2b:' + '0' * 128, True),
+                                   ('blake2b:' + '0' * 32, False),
+                                   ('sha256:' + '0' * 64, True),
+                                   ('unknown:' + '0' * 32, False),
+                                   ('corrupted', False)):
+            with self.subTest(checksum=checksum):
+                self.assertEqual(backup.is_checksum(checksum), expected)
+
+    def test_md5sum_mmap(self):
+        for size in (0, 1, 4096, 4097, 3 * 1024 * 1024 + 5):
+            for multiplier in (None, Mock(name='multiplier')):
+                with self.subTest(size=size, multiplier=multiplier):
+                    data = os.urandom(size)
+                    if multiplier is not None:
+                        multiplier.return_value = 4
+                    out = io.BytesIO()
+                    with tempfile.TemporaryFile() as fd:
+                        fd.write(data)
+                        fd.seek(0)
+
+                        actual = backup.md5sum_mmap(fd, out, multiplier)
+
+                    self.assertEqual(actual, hashlib.md5(data).hexdigest())
+                    self.assertEqual(out.getvalue(), data)
+                    if multiplier is not None and size > 0:
+                        self.assertEqual(multiplier.call_count, (size + 4095) // 4096)
+
+    def test_md5sum_stream(self):
+        for readable in (io.BytesIO, lambda d: io.BufferedReader(io.BytesIO(d)), ReadOnly):
+            for multiplier in (None, Mock(name='multiplier')):
+                with self.subTest(readable=readable, multiplier=multiplier):
+                    data = os.urandom(2 * 1024 * 1024 + uid(1000))
+                    if multiplier is not None:
+                        multiplier.side_effect = lambda: 1 + uid(8)
+                    out = io.BytesIO()
+
+                    actual = backup.md5sum_stream(readable(data), out, multiplier)
+
+                    self.assertEqual(actual, hashlib.md5(data).hexdigest())
+                    self.assertEqual(out.getvalue(), data)
+
+    def test_parallel_gzip(self):
+        for size in (0, 1, 1000, 4096, 4096 * 7 + 13):
+            for workers in (1, 3):
+                with self.subTest(size=size, workers=workers):
+                    data = (os.urandom(100) + b'text' * 50) * (size // 300 + 1)
+                    data = data[:size]
+                    out = io.BytesIO()
+                    subj = backup.ParallelGzip(out, workers, 'blake2b', block_size=4096)
+                    for pos in range(0, size, 777):
+                        self.assertEqual(subj.write(memoryview(data)[pos:pos + 777]), len(data[pos:pos + 777]))
+
+                    actual = subj.close()
+
+                    compressed = out.getvalue()
+                    self.assertEqual(gzip.decompress(compressed), data)
+                    self.assertEqual(actual, 'blake2b:' + hashlib.blake2b(compressed).hexdigest())
+                    self.assertEqual(subj.members, max(1, (size + 4095) // 4096))
+
+    @patch.object(backup, 'system_hidden', spec=backup.system_hidden)
+    def test_gzip_md5sum(self, mock_system_hidden):
+        for workers in (0, 2):
+            with self.subTest(workers=workers):
+                mock_system_hidden.reset_mock()
+                data = b'data' * 100000
+                checksum = 'checksum-%s' % uid()
+                mock_system_hidden.return_value = checksum
+                with tempfile.TemporaryDirectory() as directory:
+                    path = directory + '/file.gz'
+                    subj = backup.GzipMd5sum(path, 'md5', workers)
+
+                    actual = subj(io.BytesIO(data))
+
+                    if workers == 0:
+                        self.assertEqual(actual, checksum)
+                        mock_system_hidden.assert_called_once_with(["gzip"], mock.ANY, mock.ANY)
                     else:
-                        mock_path.isfile.assert_called_once_with(path)
-                        mock_with_open.assert_called_once()
-                        if is_stop_watch:
-                            mock_stop_watch.assert_called_once()
-                        else:
-                            mock_stop_watch.assert_not_called()
-                    if out is not None:
-                        out.write.assert_has_calls([call(i) for i in data[0:len(data) - 1]])
+                        mock_system_hidden.assert_not_called()
+                        with open(path, 'rb') as fd:
+                            compressed = fd.read()
+                        self.assertEqual(gzip.decompress(compressed), data)
+                        self.assertEqual(actual, hashlib.md5(compressed).hexdigest())
+
+    def test_tar_gzip_md5sum(self):
+        with tempfile.TemporaryDirectory() as directory:
+            src = directory + '/src'
+            os.makedirs(src + '/sub/empty')
+            files = {'src/a': os.urandom(100000), 'src/sub/b': b'b' * 10000, 'src/sub/c': b''}
+            for name, data in files.items():
+                with open(directory + '/' + name, 'wb') as fd:
+                    fd.write(data)
+            os.symlink('a', src + '/link')
+            path = directory + '/archive.tar.gz'
+
+            with patch('backup.log', autospec=True) as mock_log:
+                actual = backup.TarGzipMd5sum(path, 'sha256', 2)(src)
+
+            mock_log.info.assert_called_once()
+            with open(path, 'rb') as fd:
+                self.assertEqual(actual, 'sha256:' + hashlib.sha256(fd.read()).hexdigest())
+            with tarfile.open(path) as tar:
+                self.assertEqual(tar.getnames(), ['src', 'src/a', 'src/link', 'src/sub', 'src/sub/b', 'src/sub/c',
+                                                  'src/sub/empty'])
+                self.assertEqual({name: tar.extractfile(name).read() for name in files}, files)
+                self.assertEqual(tar.getmember('src/link').linkname, 'a')
+
+    def test_tar_gzip_md5sum_read_error(self):
+        with tempfile.TemporaryDirectory() as directory:
+            src = directory + '/src'
+            os.makedirs(src)
+            with open(src + '/a', 'wb') as fd:
+                fd.write(b'a' * 1000)
+            path = directory + '/archive.tar.gz'
+
+            with patch('backup.TimedReader.read', autospec=True, side_effect=OSError('read error')):
+                with self.assertRaises(OSError):
+                    backup.TarGzipMd5sum(path)(src)
+
+            self.assertFalse(os.path.exists(path))
+
+    def test_tar_gzip_md5sum_skipped(self):
+        with tempfile.TemporaryDirectory() as directory:
+            src = directory + '/src'
+            os.makedirs(src)
+            for name in ('a', 'b'):
+                with open(src + '/' + name, 'w') as fd:
+                    fd.write(name)
+            real_open = open
+
+            def fake_open(path, *args, **kwargs):
+                if path == src + '/b':
+                    raise PermissionError(path)
+                return real_open(path, *args, **kwargs)
+
+            subj = backup.TarGzipMd5sum(directory + '/full.tar.gz')
+            with patch('backup.open', side_effect=fake_open), patch('backup.log', autospec=True) as mock_log:
+                subj(src)
+
+            mock_log.warning.assert_called_once()
+            self.assertEqual(set(subj.index), {'src/a'})
+            with tarfile.open(directory + '/full.tar.gz') as tar:
+                self.assertEqual(tar.getnames(), ['src', 'src/a'])
+
+    def test_tar_gzip_md5sum_incremental(self):
+        with tempfile.TemporaryDirectory() as directory:
+            src = directory + '/src'
+            os.makedirs(src + '/sub')
+            for name in ('a', 'sub/b', 'sub/c'):
+                with open(src + '/' + name, 'w') as fd:
+                    fd.write(name)
+            full = backup.TarGzipMd5sum(directory + '/full.tar.gz')
+            full(src)
+            self.assertEqual(set(full.index), {'src/a', 'src/sub/b', 'src/sub/c'})
+            os.remove(src + '/sub/c')
+            with open(src + '/sub/b', 'w') as fd:
+                fd.write('changed b')
+            with open(src + '/d', 'w') as fd:
+                fd.write('d')
+            path = directory + '/full.inc.tar.gz'
+
+            with patch('backup.log', autospec=True):
+                backup.TarGzipMd5sum(path, base=full.index, full='full.tar.gz')(src)
+
+            with tarfile.open(path) as tar:
+                self.assertEqual(tar.getnames(), ['src', 'src/d', 'src/sub', 'src/sub/b', '.backup-manifest.json'])
+                self.assertEqual(tar.extractfile('src/sub/b').read(), b'changed b')
+                self.assertEqual(json.load(tar.extractfile('.backup-manifest.json')),
+                                 {'version': 1, 'full': 'full.tar.gz', 'deleted': ['src/sub/c']})
+
+    def test_tar_gzip_md5sum_chunks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            src, store = directory + '/src', directory + '/store'
+            os.makedirs(src + '/sub')
+
+            def data(seed, size):  # детерминированные несжимаемые данные
+                return b''.join(hashlib.sha256(b'%s-%d' % (seed, i)).digest() for i in range(size // 32))
+
+            files = {'src/large': data(b'large', 5 * 1024 * 1024)}
+            files.update({'src/sub/f%03d' % i: data(b'f%d' % i, 1024) for i in range(200)})
+            for name, data in files.items():
+                with open(directory + '/' + name, 'wb') as fd:
+                    fd.write(data)
+
+            def archive(name):
+                subj = backup.TarGzipMd5sum(directory + '/' + name, 'sha256', 2, chunks=store)
+                with patch('backup.log', autospec=True):
+                    checksum = subj(src)
+                with open(directory + '/' + name, 'rb') as fd:
+                    recipe = fd.read()
+                self.assertEqual(checksum, 'sha256:' + hashlib.sha256(recipe).hexdigest())
+                chunks = recipe.decode().split()
+                for path, chunk_checksum in subj.checksums.items():
+                    with open(path, 'rb') as fd:
+                        self.assertEqual(chunk_checksum, 'sha256:' + hashlib.sha256(fd.read()).hexdigest())
+                data = b''
+                for chunk in chunks:
+                    with open(store + '/' + chunk, 'rb') as fd:
+                        data += fd.read()
+                with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+                    self.assertEqual({n: tar.extractfile(n).read() for n in files}, files)
+                return chunks, subj.checksums
+
+            chunks1, new1 = archive('a.tar.recipe')
+            self.assertEqual(set(new1), {store + '/' + chunk for chunk in chunks1})
+            self.assertGreater(len(chunks1), 3)
+            files['src/sub/f100'] = b'changed'
+            with open(directory + '/src/sub/f100', 'wb') as fd:
+                fd.write(files['src/sub/f100'])
+
+            chunks2, new2 = archive('b.tar.recipe')
+
+            # блок с изменённым файлом может разделиться на два, и всегда меняется последний блок с концом tar
+            self.assertLessEqual(len(new2), 3)
+            self.assertEqual(len(set(chunks2) - set(chunks1)), len(new2))
+
+    def test_chunk_separator(self):
+        subj = backup.ChunkSeparator()
+        names = ['%064x.gz' % i for i in range(3)] + ['%064x.gz.tmp123' % 0]
+        entries = []
+        for name in names:
+            entry = backup.RecoveryEntry(name)
+            subj.init(entry, subj.match('/.chunks/00/' + name, name))
+            entries.append(entry)
+        self.assertEqual(subj.separate(entries), (entries, []))
+        name = '%064x.gz' % 1
+        for key in ('/' + name, '/host/.chunks/00/' + name, '/.chunks/01/' + name):
+            with self.subTest(key=key):
+                self.assertIsNone(subj.match(key, name))
+
+        subj.referenced = {names[0], names[2]}
+
+        self.assertEqual(subj.separate(entries), ([entries[0], entries[2]], [entries[1], entries[3]]))
+        self.assertEqual(subj.pattern.match('name2020-01-01.tar.gz'), None)
+
+    def test_time_separator(self):
+        subj = TimeSeparator(3)
+        names = ['p2020-01-01.tar.gz', 'p2020-01-01.inc2020-01-02.tar.gz', 'p2020-01-01.inc2020-01-03.tar.gz',
+                 'p2020-01-04.tar.gz', 'p2020-01-04.inc2020-01-05.tar.gz', 'p2020-01-04.inc2020-01-06.tar.gz']
+        for keep, expected in ((3, names[3:]), (1, [names[3], names[5]]), (4, names[:1] + names[2:])):
+            with self.subTest(keep=keep):
+                subj.num = keep
+                entries = []
+                for name in names:
+                    entry = backup.RecoveryEntry(name)
+                    entry.dir = 'dir'
+                    subj.init(entry, subj.pattern.match(name))
+                    entries.append(entry)
+
+                recovery, remove = subj.separate(entries)
+
+                self.assertEqual(sorted(e.name for e in recovery), sorted(expected))
+                self.assertEqual(sorted(e.name for e in remove), sorted(set(names) - set(expected)))
+        entry = next(e for e in entries if e.name == names[2])
+        self.assertEqual((entry.full, entry.date), (names[0], '2020-01-03'))
+
+    def test_timed_reader(self):
+        stats = backup.PipelineStats()
+        data = b'data' * 100
+        for size in (len(data), len(data) + 10):
+            with self.subTest(size=size):
+                subj = backup.TimedReader(io.BytesIO(data), size, stats, 'name')
+
+                actual = subj.read(300) + subj.read(-1) + subj.read(100)
+
+                self.assertEqual(actual, data + bytes(size - len(data)))
+        self.assertEqual(stats.stages['read'][0], 2 * len(data))
+
+    def test_pipeline_stats(self):
+        subj = backup.PipelineStats()
+        subj.add('read', 1024 * 1024, 0.5)
+        subj.add('read', 1024 * 1024, 0.5)
+        subj.add('write', 0, 0.0)
+        with patch('backup.log', autospec=True) as mock_log:
+            subj.log('msg')
+
+        mock_log.info.assert_called_once_with('[%s]: %1.3f sec; %s', 'msg', mock.ANY,
+                                              'read 2.0 MB 1.000 sec 2.0 MB/s; write 0.000 sec')
 
     @patch('backup.os.path', autospec=True)
     def test_load_md5(self, mock_path):
@@ -124,6 +464,20 @@ class BackupUnitTest(TestCase):
                     self.assertEqual(result, {name1: sum1, name2: sum2, name3: sum3} if is_file else {})
                     mock_file.assert_has_calls([call(path, encoding='UTF-8')] if is_file else [])
 
+    def test_load_md5_unknown_algorithm(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = directory + '/.md5'
+            sha256 = 'sha256:' + hashlib.sha256(b'b').hexdigest()
+            with open(path, 'w', encoding='UTF-8') as fd:
+                fd.write('%s\t*a\n%s\t*b\nmd4:%s\t*c\n' % (hashlib.md5(b'a').hexdigest(), sha256,
+                                                            hashlib.md5(b'c').hexdigest()))
+
+            with self.assertLogs(level='WARNING') as logs:
+                result = backup.load_md5(path)
+
+            self.assertEqual(result, {'a': hashlib.md5(b'a').hexdigest(), 'b': sha256})
+            self.assertEqual(logs.output, ['WARNING:root:%s: unknown checksum algorithm of c' % path])
+
     @patch('backup.os.path', autospec=True)
     @patch.object(backup, 'with_open', spec=backup.with_open)
     def test_load_md5_with_times(self, mock_with_open, mock_path):
@@ -141,6 +495,8 @@ class BackupUnitTest(TestCase):
 
                 expected = {'name-%s' % uid(): (uid_sum(0), int(uid_time()))
                             for _ in uid_range()}
+                expected.update({'name-%s' % uid(): ('blake2b:' + uid_sum(96), int(uid_time()))
+                                 for _ in uid_range()})
                 keys = list(expected.keys())
                 data = [expected[key][0] + uid_spaces() + time_to_iso(expected[key][1]) + uid_spaces() + key
                         for key in expected]
@@ -168,6 +524,50 @@ class BackupUnitTest(TestCase):
                 self.assertEqual(actual, {} if not is_file else expected)
                 mock_path.isfile.assert_called_once_with(path)
 
+    def test_checksum_log(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = directory + '/.checksum.bin'
+            md5 = hashlib.md5(b'a').hexdigest()
+            sha = 'sha256:' + hashlib.sha256(b'b').hexdigest()
+            with open(path, 'ab') as fd:
+                backup.write_checksum_record(fd, 'a', md5, 1.5)
+                backup.write_checksum_record(fd, 'b', sha, 2.5)
+                backup.write_checksum_record(fd, 'a', 'corrupted', 3.5)  # запись без суммы игнорируется
+                backup.write_checksum_record(fd, 'имя', md5, 4.5)
+            with open(path, 'ab') as fd:
+                backup.write_checksum_record(fd, 'c', md5, 5.5)
+                size = fd.tell()
+                backup.write_checksum_record(fd, 'd', md5, 6.5)
+            with open(path, 'r+b') as fd:
+                fd.truncate(size + 20)  # оборванная последняя запись
+
+            actual = backup.load_checksum_log(path)
+
+            self.assertEqual(actual, {'a': (md5, 1.5), 'b': (sha, 2.5), 'имя': (md5, 4.5), 'c': (md5, 5.5)})
+            with open(path, 'rb') as fd:
+                self.assertEqual(fd.read(len(backup.CHECKSUM_LOG_MAGIC)), backup.CHECKSUM_LOG_MAGIC)
+            self.assertEqual(backup.load_checksum_log(directory + '/missing'), {})
+            with open(path, 'wb') as fd:
+                fd.write(b'text')
+            self.assertEqual(backup.load_checksum_log(path), {})
+
+    def test_checksum_log_torn_append(self):
+        with tempfile.TemporaryDirectory() as directory:
+            md5 = hashlib.md5(b'a').hexdigest()
+            Backup.append_checksum(directory, 'a', md5, 1.0)
+            open(directory + '/.checksum.bin', 'wb').close()  # журнал уже двоичный
+            for i in range(3):
+                Backup.append_checksum(directory, 'name-%s' % i, md5, float(i))
+            size = os.path.getsize(directory + '/.checksum.bin')
+            with open(directory + '/.checksum.bin', 'r+b') as fd:
+                fd.truncate(size - 5)  # оборванная запись
+            for i in range(3, 8):
+                Backup.append_checksum(directory, 'name-%s' % i, md5, float(i))
+
+            actual = backup.load_checksum_log(directory + '/.checksum.bin')
+
+            self.assertEqual(actual, {'name-%s' % i: (md5, float(i)) for i in range(8) if i != 2})
+
     def test_with_open(self):
         for binary in (False, True):
             with self.subTest(binary=binary):
@@ -183,6 +583,234 @@ class BackupUnitTest(TestCase):
                     mock_file.assert_called_once_with(path, mode, encoding=None if binary else 'UTF-8')
 
 
+class WorkerPoolTest(TestCase):
+
+    def test_configure(self):
+        for workers, expected_default, expected_workers in ((None, 1, {}),
+                                                            (4, 4, {}),
+                                                            ({'dir1/': 3, 'dir2': '2'}, 1, {'dir1': 3, 'dir2': 2})):
+            with self.subTest(workers=workers):
+                subj = backup.WorkerPool()
+
+                subj.configure(workers)
+
+                self.assertEqual((subj.default, subj.workers), (expected_default, expected_workers))
+
+    def test_root(self):
+        subj = backup.WorkerPool()
+        subj.workers = {'/dst': 2, '/dst/sub': 3, '/other': 4}
+        for path, expected in (('/dst', '/dst'),
+                               ('/dst/file', '/dst'),
+                               ('/dst/sub/file', '/dst/sub'),
+                               ('/dst2/file', None),
+                               ('/other/a/b', '/other')):
+            with self.subTest(path=path):
+                self.assertEqual(subj.root(path), expected)
+
+    def test_map(self):
+        for default in (1, 3):
+            with self.subTest(default=default):
+                subj = backup.WorkerPool(default)
+                subj.workers = {'/parallel': 4, '/serial': 1}
+                items = ['%s/item-%s' % (d, uid()) for d in ('/parallel', '/serial', '/any') for _ in uid_range()]
+                threads = {}
+
+                def func(item):
+                    threads[item] = threading.current_thread()
+                    return 'result-' + item
+
+                actual = subj.map(func, items)
+                subj.shutdown()
+
+                self.assertEqual(actual, ['result-' + i for i in items])
+                main = threading.current_thread()
+                for item in items:
+                    parallel = item.startswith('/parallel') or (item.startswith('/any') and default > 1)
+                    self.assertEqual(threads[item] != main, parallel, item)
+                self.assertEqual(subj.executors, {})
+
+    def test_map_error(self):
+        subj = backup.WorkerPool(3)
+        finished = []
+        release = threading.Event()
+
+        def func(item):
+            if item == 0:
+                raise IOError('item 0')
+            release.wait(5)
+            time.sleep(0.05)
+            finished.append(item)
+
+        try:
+            with self.assertRaisesRegex(IOError, 'item 0'):
+                release.set()
+                subj.map(func, [0, 1, 2])
+        finally:
+            subj.shutdown()
+
+        self.assertEqual(sorted(finished), [1, 2])  # исключение пробрасывается после завершения остальных
+
+
+class ChecksumCatalogTest(TestCase):
+
+    def test_catalog(self):
+        with tempfile.TemporaryDirectory() as directory:
+            subj = backup.ChecksumCatalog(directory + '/state/catalog.sqlite')
+            rows = {'dir': [('name-%s' % uid(), 'sum-%s' % uid(), uid_time(), uid(), uid_time()) for _ in uid_range()],
+                    'dir/sub': [('name-%s' % uid(), 'sum-%s' % uid(), uid_time(), uid(), uid_time())],
+                    'dir2': [('name-%s' % uid(), 'sum-%s' % uid(), uid_time(), uid(), uid_time())]}
+            for d, r in rows.items():
+                subj.update(d, r)
+            subj.update('dir', [], [rows['dir'][0][0]])
+            subj.close()
+
+            subj = backup.ChecksumCatalog(directory + '/state/catalog.sqlite')
+
+            self.assertEqual(subj.load('dir'), {row[0]: row[1:] for row in rows['dir'][1:]})
+            self.assertEqual(subj.directories('dir'), ['dir', 'dir/sub'])
+            self.assertEqual(subj.load('unknown'), {})
+            subj.close()
+
+
+class HashCacheTest(TestCase):
+
+    @patch.object(backup, 'md5sum', wraps=backup.md5sum)
+    def test_md5sum(self, mock_md5sum):
+        with tempfile.TemporaryDirectory() as directory:
+            path = directory + '/file'
+            cache_path = directory + '/cache/hashes.json'
+            with open(path, 'wb') as fd:
+                fd.write(b'data')
+            subj = backup.HashCache()
+            subj.load(cache_path)
+
+            self.assertEqual(subj.md5sum(path), hashlib.md5(b'data').hexdigest())
+            self.assertEqual(subj.md5sum(directory + '/unknown'), None)
+            subj.save()
+            subj = backup.HashCache()
+            subj.load(cache_path)
+            mock_md5sum.reset_mock()
+
+            self.assertEqual(subj.md5sum(path), hashlib.md5(b'data').hexdigest())
+            mock_md5sum.assert_not_called()
+            self.assertEqual(subj.md5sum(path, 'sha256'), 'sha256:' + hashlib.sha256(b'data').hexdigest())
+            mock_md5sum.assert_called_once_with(path, algorithm='sha256')
+
+            with open(path, 'wb') as fd:
+                fd.write(b'changed')
+            mock_md5sum.reset_mock()
+            self.assertEqual(subj.md5sum(path), hashlib.md5(b'changed').hexdigest())
+            mock_md5sum.assert_called_once_with(path, algorithm='md5')
+
+    def test_put(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = directory + '/file'
+            with open(path, 'wb') as fd:
+                fd.write(b'data')
+            subj = backup.HashCache()
+            checksum = 'checksum-%s' % uid()
+
+            subj.put(path, checksum)
+            subj.put(directory + '/unknown', checksum)
+
+            self.assertEqual(subj.entries, {subj.fingerprint(path): checksum})
+            self.assertEqual(subj.md5sum(path), checksum)
+
+
+    def test_save(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache_path = directory + '/hashes.json'
+            now = time.time()
+            with open(cache_path, 'w', encoding='UTF-8') as fd:
+                json.dump({'version': 2, 'entries': {'old': 'sum-old', 'recent': 'sum-recent', 'v1': 'sum-v1'},
+                           'times': {'old': now - 31 * 24 * 3600, 'recent': now - 29 * 24 * 3600}}, fd)
+            subj = backup.HashCache()
+            subj.load(cache_path)
+
+            subj.save()
+
+            subj = backup.HashCache()
+            subj.load(cache_path)
+            self.assertEqual(subj.entries, {'recent': 'sum-recent', 'v1': 'sum-v1'})
+            self.assertAlmostEqual(subj.times['recent'], now - 29 * 24 * 3600)
+
+
+class SourceManifestTest(TestCase):
+
+    @staticmethod
+    def write(path, data, mtime):
+        with open(path, 'w') as fd:
+            fd.write(data)
+        os.utime(path, (mtime, mtime))
+
+    def walk(self, src, manifest_path):
+        subj = backup.SourceManifest()
+        subj.load(manifest_path)
+        find_strategy = Mock(side_effect=lambda d: 'Repo' if d.endswith('/repo') else None)
+        found = subj.walk(src, find_strategy)
+        subj.save()
+        return subj, found, sorted(c.args[0] for c in find_strategy.call_args_list)
+
+    def test_walk(self):
+        with tempfile.TemporaryDirectory() as directory:
+            src = directory + '/src'
+            manifest_path = directory + '/dst/.manifest'
+            os.makedirs(src + '/a/b')
+            os.makedirs(src + '/repo/sub')
+            self.write(src + '/f1', 'f1', 1000)
+            self.write(src + '/a/b/f2', 'f2', 3000)
+            self.write(src + '/repo/f3', 'f3', 5000)
+            os.symlink(src + '/a', src + '/a/b/loop')
+
+            subj, found, probed = self.walk(src, manifest_path)
+
+            self.assertEqual(found, [(src + '/repo', 'Repo')])
+            self.assertEqual(probed, [src, src + '/a', src + '/a/b', src + '/repo'])
+            self.assertEqual(subj.last_modified, 3000)
+            self.assertFalse(subj.changed())
+            self.assertEqual(set(subj.snapshot), {'', 'a', 'a/b', 'repo'})
+
+            subj, found, probed = self.walk(src, manifest_path)
+
+            self.assertEqual(found, [(src + '/repo', 'Repo')])
+            self.assertEqual(probed, [])
+            self.assertEqual(subj.last_modified, 3000)
+            self.assertFalse(subj.changed())
+
+            with self.subTest(edited=True):
+                mtime = os.stat(src + '/a/b').st_mtime_ns
+                self.write(src + '/a/b/f2', 'f2 edited', 2000)
+                os.utime(src + '/a/b', ns=(mtime, mtime))
+
+                subj, found, probed = self.walk(src, manifest_path)
+
+                self.assertEqual(probed, [])
+                self.assertEqual(subj.last_modified, 2000)
+                self.assertTrue(subj.changed())
+
+            with self.subTest(removed=True):
+                os.remove(src + '/a/b/f2')
+
+                subj, found, probed = self.walk(src, manifest_path)
+
+                self.assertEqual(probed, [src + '/a/b'])
+                self.assertEqual(subj.last_modified, 1000)
+                self.assertTrue(subj.changed())
+                self.assertEqual(subj.snapshot['a/b']['files'], {})
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for content in ('', '[]', '{"version": 2, "dirs": {"": {}}}'):
+                with self.subTest(content=content):
+                    with open(directory + '/.manifest', 'w') as fd:
+                        fd.write(content)
+                    subj = backup.SourceManifest()
+
+                    subj.load(directory + '/.manifest')
+
+                    self.assertEqual((subj.dirs, subj.loaded), ({}, False))
+
+
 class SvnBackupTest(TestCase):
 
     @patch('backup.system', autospec=True)
@@ -201,8 +829,479 @@ class SvnBackupTest(TestCase):
                 self.assertTrue(".." in "../%s" % uid())
                 self.assertFalse(".." in url)
 
+    def test_found(self):
+        with tempfile.TemporaryDirectory() as src:
+            self.assertFalse(SvnBackup.found(src + '/unknown'))
+            for name in ('conf', 'db', 'hooks', 'locks'):
+                os.mkdir(src + '/' + name)
+            with open(src + '/format', 'w') as fd:
+                fd.write('5\n')
+            self.assertFalse(SvnBackup.found(src))
+            for readme, expected in (('This is not a repository\n', False),
+                                     ('This is a Subversion repository; use the svnadmin tool\n', True)):
+                with self.subTest(readme=readme):
+                    with open(src + '/README.txt', 'w') as fd:
+                        fd.write(readme)
+
+                    self.assertEqual(SvnBackup.found(src), expected)
+
+    def test_fsfs_revision(self):
+        for fs_type, repo_format, db_format, current, expected in (
+                ('fsfs', '5', '8\nlayout sharded 1000\naddressing logical\n', '1234\n', 1234),
+                ('fsfs', '5', '1\n', '12 ab 3\n', 12),
+                ('fsfs', '5', '99\n', '12\n', None),
+                ('fsfs', 'x', '8\n', '12\n', None),
+                ('bdb', '5', '8\n', '12\n', None),
+                ('fsfs', '5', '8\n', '', None),
+                ('fsfs', '5', '8\n', None, None)):
+            with self.subTest(fs_type=fs_type, repo_format=repo_format, db_format=db_format, current=current):
+                with tempfile.TemporaryDirectory() as src:
+                    os.mkdir(src + '/db')
+                    for name, content in (('db/fs-type', fs_type), ('format', repo_format),
+                                          ('db/format', db_format), ('db/current', current)):
+                        if content is not None:
+                            with open(src + '/' + name, 'w') as fd:
+                                fd.write(content)
+
+                    self.assertEqual(SvnBackup.fsfs_revision(src), expected)
+
+    @patch.object(SvnBackup, 'fsfs_revision', autospec=True)
+    @patch('backup.system', autospec=True)
+    def test_svn_revision_fsfs(self, mock_system, mock_fsfs_revision):
+        subj = SvnBackup(Backup())
+        src = 'src-%s' % uid()
+        mock_fsfs_revision.return_value = expected = uid()
+
+        self.assertEqual(subj.svn_revision(src), expected)
+
+        mock_fsfs_revision.assert_called_once_with(src)
+        mock_system.assert_not_called()
+
+    def test_revision_ranges(self):
+        for new_rev, expected in ((0, [(-1, 0)]),
+                                  (98, [(-1, 98)]),
+                                  (99, [(-1, 99), (99, 99)]),
+                                  (250, [(-1, 99), (99, 199), (199, 250)]),
+                                  (12345, [(-1, 9999), (9999, 10999), (10999, 11999), (11999, 12099),
+                                           (12099, 12199), (12199, 12299), (12299, 12345)])):
+            with self.subTest(new_rev=new_rev):
+                self.assertEqual(SvnBackup.revision_ranges(new_rev), expected)
+
+    @patch.object(SvnBackup, 'dump', autospec=True)
+    @patch.object(SvnBackup, 'svn_revision', autospec=True)
+    @patch('backup.load_md5', autospec=True)
+    @patch('backup.mkdirs', autospec=True)
+    def test_backup(self, mock_mkdirs, mock_load_md5, mock_svn_revision, mock_dump):
+        for workers in (1, 3):
+            with self.subTest(workers=workers):
+                mock_dump.reset_mock()
+                b = Backup()
+                b.svn_dump_pool.configure(workers)
+                subj = SvnBackup(b)
+                src, dst, prefix = 'src-%s' % uid(), 'dst-%s' % uid(), 'prefix-%s' % uid()
+                mock_svn_revision.return_value = 12345
+                mock_load_md5.return_value = md5 = {'name-%s' % uid(): 'checksum-%s' % uid()}
+                threads = set()
+                mock_dump.side_effect = lambda *args: threads.add(threading.get_ident())
+
+                try:
+                    self.assertTrue(subj.backup(src, dst, prefix))
+                finally:
+                    b.svn_dump_pool.shutdown()
+
+                mock_mkdirs.assert_called_with(dst)
+                mock_load_md5.assert_called_with(dst + '/.md5')
+                mock_dump.assert_has_calls([call(subj, src, dst, prefix, old_rev, rev, md5)
+                                            for old_rev, rev in SvnBackup.revision_ranges(12345)], any_order=True)
+                self.assertEqual(mock_dump.call_count, 7)
+                self.assertEqual(threading.get_ident() in threads, workers == 1)
+
+    @patch('backup.system', autospec=True)
+    def test_dump(self, mock_system):
+        for stored, cached in ((False, False), (True, False), (True, True)):
+            with self.subTest(stored=stored, cached=cached):
+                mock_system.reset_mock()
+                b = Backup()
+                b.gzip_workers = 8
+                b.svn_dump_pool.configure(3)
+                subj = SvnBackup(b)
+                subj.hash_cache = Mock(name='hash_cache')
+                src, dst, prefix = 'src-%s' % uid(), 'dst-%s' % uid(), 'prefix-%s' % uid()
+                name = '%s.%06d-%06d.svndmp.gz' % (prefix, 100, 199)
+                path = dst + '/' + name
+                checksum = 'checksum-%s' % uid()
+                new_checksum = 'new-checksum-%s' % uid()
+                subj.hash_cache.md5sum.return_value = checksum if cached else 'other-%s' % uid()
+                mock_system.return_value = new_checksum
+
+                subj.dump(src, dst, prefix, 99, 199, {name: checksum} if stored else {})
+
+                self.assertEqual(b.new_checksum_by_path, {path: checksum if cached else new_checksum})
+                subj.hash_cache.md5sum.assert_has_calls([call(path, 'md5')] if stored else [])
+                if cached:
+                    mock_system.assert_not_called()
+                    subj.hash_cache.put.assert_not_called()
+                else:
+                    mock_system.assert_called_once_with(["svnadmin", "dump", "-r", "100:199", "--incremental", src],
+                                                        mock.ANY)
+                    self.assertEqual(mock_system.call_args[0][1].workers, 2)  # 8 потоков сжатия на 3 дампа
+                    subj.hash_cache.put.assert_called_once_with(path, new_checksum)
+
+
+class GitBackupTest(TestCase):
+
+    @patch.object(backup.GitBackup, 'git_fsck', autospec=True)
+    @patch('backup.system', autospec=True)
+    @patch('backup.system_hidden', autospec=True)
+    def test_fetch(self, mock_system_hidden, mock_system, mock_git_fsck):
+        for remote_workers in (1, 3):
+            with self.subTest(remote_workers=remote_workers):
+                mock_system.reset_mock()
+                mock_system.return_value = 0
+                subj = backup.GitBackup(Backup())
+                subj.error = Mock()
+                subj.remote_workers = remote_workers
+                src = 'src-%s' % uid()
+                mock_system_hidden.return_value = {'svn-remote': {'svn': {}},
+                                                   'remote': {'a': {}, 'm1': {'mirror': 'true'}, 'b': {},
+                                                              'm2': {'mirror': 'true'}}}
+                fetches = 1 if remote_workers > 1 else 2
+                mock_git_fsck.side_effect = lambda _src: self.assertEqual(mock_system.call_count, 1 + fetches)
+
+                self.assertEqual(subj.fetch(src), ['m1', 'm2'])
+
+                mock_system_hidden.assert_called_with(['git', 'config', '--list'], cwd=src, reader=subj.read_remotes)
+                self.assertEqual(mock_system.call_args_list[0], call(['git', 'svn', 'fetch', 'svn'], cwd=src))
+                if remote_workers > 1:
+                    self.assertEqual(mock_system.call_args_list[1],
+                                     call(['git', 'fetch', '--multiple', '--prune', '--jobs=3', 'a', 'b'], cwd=src))
+                else:
+                    self.assertEqual(mock_system.call_args_list[1:3],
+                                     [call(['git', 'fetch', '--prune', name], cwd=src) for name in ('a', 'b')])
+                self.assertEqual(sorted(map(str, mock_system.call_args_list[1 + fetches:])),
+                                 [str(call(['git', 'push', name], cwd=src)) for name in ('m1', 'm2')])
+                mock_git_fsck.assert_called_once_with(src)
+                mock_git_fsck.reset_mock()
+                subj.error.assert_not_called()
+
+    @patch.object(backup.GitBackup, 'git_fsck', autospec=True)
+    @patch('backup.system', autospec=True)
+    @patch('backup.system_hidden', autospec=True)
+    def test_fetch_error(self, mock_system_hidden, mock_system, mock_git_fsck):
+        subj = backup.GitBackup(Backup())
+        subj.error = Mock()
+        subj.remote_workers = 2
+        src = 'src-%s' % uid()
+        mock_system_hidden.return_value = {'svn-remote': {}, 'remote': {'a': {}, 'm1': {'mirror': 'true'},
+                                                                       'm2': {'mirror': 'true'}}}
+        mock_system.side_effect = lambda command, cwd: 128 if command[-1] in ('a', 'm2') else 0
+
+        self.assertEqual(subj.fetch(src), ['m1', 'm2'])
+
+        self.assertEqual(subj.error.call_count, 2)
+        subj.error.assert_has_calls([call('%s error: %s exit code %s', 'git fetch --prune a', src, 128),
+                                     call('%s error: %s exit code %s', 'git push m2', src, 128)])
+
+    @skipUnless(shutil.which('git'), 'git is not installed')
+    def test_bundle_backup(self):
+        with tempfile.TemporaryDirectory() as directory:
+            src, dst = directory + '/src', directory + '/dst'
+
+            def git(*args):
+                subprocess.run(['git', '-c', 'user.name=n', '-c', 'user.email=e'] + list(args), cwd=src, check=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+            os.makedirs(src)
+            git('init', '-q')
+            git('commit', '-q', '--allow-empty', '-m', '1')
+            subj = backup.GitBackup(Backup())
+            subj.new_checksum = Mock()
+            subj.full_bundles = 2
+            bundles = []
+            with patch('backup.log', autospec=True), patch('backup.print', create=True):
+                for commit in ('', '2', '', '3', '4', 'branch'):
+                    if commit == 'branch':
+                        git('branch', 'other', 'HEAD~1')
+                    elif commit != '':
+                        git('commit', '-q', '--allow-empty', '-m', commit)
+
+                    subj.bundle_backup(src, dst, 'p', False)
+
+                    bundles.append(sorted(os.listdir(dst)))
+
+            full = ['p.000000-000000.bundle', 'p.000001-000001.bundle']
+            self.assertEqual(bundles, [full[:1], full, full, full + ['p.000002-000002.bundle'],
+                                       sorted(full + ['p.000002-000002.bundle', 'p.000000-000003.bundle']),
+                                       sorted(full + ['p.000002-000002.bundle', 'p.000000-000003.bundle',
+                                                      'p.000000-000004.bundle'])])
+            self.assertEqual(subj.new_checksum.call_args_list,
+                             [call(dst + '/' + name) for name in ('p.000000-000000.bundle', 'p.000001-000001.bundle',
+                                                                  'p.000002-000002.bundle', 'p.000000-000003.bundle',
+                                                                  'p.000000-000004.bundle')])
+            heads = subj.read_bundle_heads(dst + '/p.000000-000004.bundle')
+            self.assertEqual(len(heads), 2)
+            self.assertIn('refs/heads/other', heads)
+            self.assertEqual(set(subj.read_bundle_heads(dst + '/p.000002-000002.bundle')),
+                             set(heads) - {'refs/heads/other'})
+            self.assertEqual(subj.bundle_chain(dst, 'p'), (['p.000000-000004.bundle'], 4))
+
+    def test_bundle_separator(self):
+        subj = backup.GitBundleSeparator()
+        names = ['p.000000-000000.bundle', 'p.000001-000001.bundle', 'p.000000-000002.bundle',
+                 'p.000003-000003.bundle']
+        entries = []
+        for name in names:
+            entry = backup.RecoveryEntry(name)
+            entry.dir = 'dir'
+            subj.init(entry, subj.pattern.match(name))
+            entries.append(entry)
+
+        recovery, remove = subj.separate(entries)
+
+        self.assertEqual([e.name for e in recovery], names[2:])
+        self.assertEqual([e.name for e in remove], names[:2])
+
+    def test_objects_modified(self):
+        with tempfile.TemporaryDirectory() as directory:
+            objects = directory + '/objects'
+            b = Backup()
+            subj = backup.GitBackup(b)
+            self.assertFalse(subj.objects_modified(objects))
+            os.makedirs(objects + '/ab')
+            self.assertFalse(subj.objects_modified(objects))
+            for path, mtime in (('/pack/pack-1.pack', 100), ('/info/packs', 200), ('/ab/cdef', 5000)):
+                os.makedirs(os.path.dirname(objects + path), exist_ok=True)
+                with open(objects + path, 'w'):
+                    pass
+                os.utime(objects + path, (mtime, mtime))
+            for path, mtime in (('/pack', 150), ('/info', 150), ('/ab', 300)):
+                os.utime(objects + path, (mtime, mtime))
+            b.last_modified_time = -1
+
+            self.assertTrue(subj.objects_modified(objects))
+
+            self.assertEqual(b.last_modified_time, 300)
+
+    @patch('backup.system', autospec=True)
+    @patch.object(backup.GitBackup, 'objects_modified', autospec=True)
+    @patch('backup.through_dirs', autospec=True)
+    @patch('backup.dir_contains', autospec=True)
+    def test_backup_excludes(self, mock_dir_contains, mock_through_dirs, mock_objects_modified, mock_system):
+        for fast_check, fast in ((False, False), (True, False), (True, True)):
+            with self.subTest(fast_check=fast_check, fast=fast):
+                mock_objects_modified.reset_mock()
+                subj = backup.GitBackup(Backup())
+                subj.fast_check = fast_check
+                subj.up_to_date = Mock(return_value=True)
+                src = 'src-%s' % uid()
+                subj.fetched[src] = Mock(result=Mock(return_value=[]))
+                mock_dir_contains.return_value = True
+                mock_objects_modified.return_value = fast
+                excludes = {src + '/.git/' + name for name in ('svn', 'FETCH_HEAD', 'subgit', 'refs/svn/map')}
+
+                subj.backup(src, 'dst', 'prefix')
+
+                if fast_check:
+                    mock_objects_modified.assert_called_once_with(subj, src + '/.git/objects')
+                else:
+                    mock_objects_modified.assert_not_called()
+                self.assertEqual(subj.excludes, excludes | ({src + '/.git/objects'} if fast else set()))
+                mock_through_dirs.assert_called_with(src, subj.last_modified_with_excludes,
+                                                     subj.last_modified_with_excludes)
+
+    @patch('backup.through_dirs', autospec=True)
+    @patch('backup.dir_contains', autospec=True)
+    @patch.object(backup.GitBackup, 'fetch', autospec=True)
+    def test_prefetch(self, mock_fetch, mock_dir_contains, mock_through_dirs):
+        subj = backup.GitBackup(Backup())
+        subj.up_to_date = Mock(return_value=True)
+        mock_dir_contains.return_value = False
+        repositories = ['src%s-%s' % (i, uid()) for i in range(4)]
+        error = IOError('error-%s' % uid())
+        threads = set()
+
+        def fetch(_self, src):
+            threads.add(threading.get_ident())
+            if src == repositories[1]:
+                raise error
+            return ['mirror-' + src]
+
+        mock_fetch.side_effect = fetch
+
+        subj.prefetch(repositories[:2], 2)
+        executor = subj.executor
+        subj.prefetch(repositories[2:], 2)
+
+        self.assertIs(subj.executor, executor)  # один пул на все источники
+        self.assertEqual(set(subj.fetched), set(repositories))
+        wait(subj.fetched.values())
+        self.assertNotIn(threading.get_ident(), threads)
+        self.assertLessEqual(len(threads), 2)
+        mock_fetch.reset_mock()
+        for src in repositories:
+            if src == repositories[1]:
+                with self.assertRaises(IOError) as raised:
+                    subj.backup(src, 'dst', 'prefix')
+                self.assertIs(raised.exception, error)
+            else:
+                subj.backup(src, 'dst', 'prefix')
+        mock_fetch.assert_not_called()
+        self.assertEqual(subj.fetched, {})
+        subj.backup(repositories[0], 'dst', 'prefix')
+        mock_fetch.assert_called_once_with(subj, repositories[0])
+        subj.shutdown()
+        self.assertIsNone(subj.executor)
+
 
 # noinspection PyTypeChecker
+class RateLimiterTest(TestCase):
+    def test_scheduled_rate(self):
+        subj = backup.RateLimiter({"7-23": 10, "23-7": 0})
+        for hour, rate in [(0, 0), (6, 0), (7, 10), (22, 10), (23, 0)]:
+            with self.subTest(hour=hour), patch("backup.time.localtime") as mock_localtime:
+                mock_localtime.return_value.tm_hour = hour
+                self.assertEqual(subj.scheduled_rate(), rate)
+
+    def test_scheduled_rate_uncovered(self):
+        for config, default in (({"0-7": 0, "7-20": 50}, 0.4), ({"0-7": 0, "7-20": 50, "default": 2}, 2)):
+            subj = backup.RateLimiter()
+            subj.configure(config)
+            for hour, rate in [(6, 0), (7, 50), (20, default), (23, default)]:
+                with self.subTest(config=config, hour=hour), patch("backup.time.localtime") as mock_localtime:
+                    mock_localtime.return_value.tm_hour = hour
+                    self.assertEqual(subj.scheduled_rate(), rate)
+
+    def test_default_rate(self):
+        with patch('sys.argv', ['backup.py', 'checks', 'dst-%s' % uid()]), \
+                patch.object(backup.HashCache, 'load', autospec=True):
+            subj = Backup()
+            subj.config = {}
+            subj.command()
+
+        for hour in range(24):
+            with self.subTest(hour=hour), patch("backup.time.localtime") as mock_localtime:
+                mock_localtime.return_value.tm_hour = hour
+                self.assertEqual(subj.rate_limiter.scheduled_rate(), 0.4)  # 4 кБайт за 10 ms, как было
+
+    @patch("backup.time", autospec=True)
+    def test_call(self, mock_time):
+        mock_time.localtime.return_value.tm_hour = 12
+        mock_time.monotonic.return_value = 100.0
+        subj = backup.RateLimiter(2)
+        subj.load_factor = Mock(return_value=1.0)
+
+        self.assertEqual([subj(), subj()], [204, 204])
+
+        mock_time.sleep.assert_has_calls([call(0.099609375), call(0.19921875)])
+        self.assertEqual(subj.used, 2 * 204 * 1024)
+
+    @patch("backup.time", autospec=True)
+    def test_call_unlimited(self, mock_time):
+        mock_time.localtime.return_value.tm_hour = 12
+        subj = backup.RateLimiter(0)
+
+        self.assertEqual(subj(), 1024)
+
+        mock_time.sleep.assert_not_called()
+
+    def test_used(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = directory + '/file'
+            with open(path, 'wb') as fd:
+                fd.write(b'x' * 100000)
+            for name, read in [('mmap', lambda subj: backup.md5sum(path, is_stop_watch=False, multiplier=subj)),
+                               ('stream', lambda subj: backup.md5sum(None, io.BytesIO(b'x' * 100000),
+                                                                    multiplier=subj))]:
+                with self.subTest(name=name):
+                    subj = backup.RateLimiter(0)
+
+                    read(subj)
+
+                    self.assertEqual(subj.used, 100000)
+
+    @patch("backup.time", autospec=True)
+    def test_load_factor(self, mock_time):
+        subj = backup.RateLimiter(10)
+        subj.read_pressure = Mock(side_effect=[None, 40.0, 10.0])
+        subj.read_disk_bytes = Mock(side_effect=[0, 30 * 1024 * 1024, 200 * 1024 * 1024])
+        mock_time.monotonic.side_effect = [10.0, 10.5, 11.0, 12.0]
+
+        self.assertEqual(subj.load_factor(), 1.0)
+        self.assertEqual(subj.load_factor(), 1.0)
+        self.assertEqual(subj.load_factor(), 0.5)
+        subj.used = 10 * 1024 * 1024
+        self.assertEqual(subj.load_factor(), 0.125)
+
+    @patch("backup.time", autospec=True)
+    def test_load_factor_own_pressure(self, mock_time):
+        subj = backup.RateLimiter(10)
+        subj.read_pressure = Mock(return_value=80.0)
+        disk = [0]
+        subj.read_disk_bytes = Mock(side_effect=lambda: disk[0])
+        mock_time.monotonic.side_effect = [10.0 + i for i in range(6)]
+
+        self.assertEqual(subj.load_factor(), 1.0)
+        for _ in range(5):
+            subj.used += 10 * 1024 * 1024
+            disk[0] += 10 * 1024 * 1024  # весь ввод-вывод дисков - собственное чтение
+            self.assertEqual(subj.load_factor(), 1.0)
+
+    @patch("backup.time", autospec=True)
+    def test_load_factor_hysteresis(self, mock_time):
+        subj = backup.RateLimiter(10)
+        subj.read_pressure = Mock(side_effect=[40.0, 15.0, 15.0, 5.0, 5.0, 5.0, 5.0])
+        subj.read_disk_bytes = Mock(return_value=None)
+        mock_time.monotonic.side_effect = [10.0 + i for i in range(7)]
+
+        self.assertEqual([subj.load_factor() for _ in range(7)], [0.5, 0.5, 0.5, 0.625, 0.78125, 0.9765625, 1.0])
+
+    def test_read_disk_bytes(self):
+        subj = backup.RateLimiter()
+        self.assertIsNone(subj.read_disk_bytes())
+        subj.devices = {(8, 1)}
+        diskstats = '   8       0 sda 1 0 100 0 1 0 100 0 0 0 0\n   8       1 sda1 1 0 10 0 1 0 20 0 0 0 0\n'
+        with patch("backup.open", mock.mock_open(read_data=diskstats)):
+            self.assertEqual(subj.read_disk_bytes(), 30 * 512)
+
+    def test_read_pressure(self):
+        pressure = 'some avg10=12.50 avg60=1.00 avg300=0.00 total=1\nfull avg10=1.00 avg60=0.00 avg300=0.00 total=1\n'
+        with patch("backup.open", mock.mock_open(read_data=pressure)):
+            self.assertEqual(backup.RateLimiter.read_pressure(), 12.5)
+        with patch("backup.open", side_effect=IOError):
+            self.assertIsNone(backup.RateLimiter.read_pressure())
+
+
+class ScrubPlannerTest(TestCase):
+    def test_select(self):
+        subj = backup.ScrubPlanner()
+        for sum_time, size, device in [(5, 10, 1), (1, 30, 2), (3, 20, 1), (2, 40, 1), (4, 50, 2)]:
+            subj.push(sum_time, size, 'dir-%s' % device, 'name-%s' % sum_time, 'checksum', device)
+
+        subj.select(60)
+
+        self.assertEqual(subj.pop(1)[0], 2)
+        self.assertEqual(subj.pop(2)[0], 1)
+        self.assertIsNone(subj.pop(1))
+        self.assertIsNone(subj.pop(2))
+        self.assertEqual(sorted(item[0] for item in subj.rest()), [3, 4, 5])
+
+    def test_select_all(self):
+        subj = backup.ScrubPlanner()
+        for sum_time in [3, 1, 2]:
+            subj.push(sum_time, 1, 'dir', 'name-%s' % sum_time, 'checksum', 0)
+
+        subj.select(0)
+
+        self.assertEqual([subj.pop(0)[0] for _ in range(3)], [1, 2, 3])
+        self.assertEqual(subj.rest(), [])
+
+    def test_done(self):
+        subj = backup.ScrubPlanner()
+        subj.done((1, 10, 'dir', 'name', 'checksum', 0))
+        subj.done((2, 20, 'dir', 'name', 'checksum', 0))
+        self.assertEqual((subj.count, subj.size), (2, 30))
+
+
 class BackupTest(TestCase):
 
     @patch("backup.time", autospec=True)
@@ -240,7 +1339,7 @@ class BackupTest(TestCase):
                         level=mock_log.INFO if log_level is None else log_level,
                         stream=mock_sys.stdout,
                         format="%(message)s" if log_format is None else log_format)
-                    mock_sys.setrecursionlimit.assert_called_once_with(100)
+                    mock_sys.setrecursionlimit.assert_not_called()
 
     @patch('backup.os.path', autospec=True)
     def test_read_config(self, mock_path):
@@ -266,6 +1365,8 @@ class BackupTest(TestCase):
                 ('clone', subj.clone, False, True),
                 ('git', subj.git, True, False),
                 ('checks', subj.checks, False, True),
+                ('catalog-import', subj.catalog_import, False, True),
+                ('catalog-export', subj.catalog_export, False, True),
                 ('any', subj.help, False, False),
                 (str(uid()), subj.help, False, False)):
             for empty in (False, True):
@@ -305,10 +1406,15 @@ class BackupTest(TestCase):
                     mock_svn_separator.assert_called_once_with()
                     self.assertEqual(subj.separators[0], subj.time_separator)
                     self.assertTrue(isinstance(subj.separators[1], SvnSeparator))
-                    self.assertEqual(len(subj.separators), 2)
+                    self.assertEqual(subj.separators[2], subj.chunk_separator)
+                    self.assertTrue(isinstance(subj.chunk_separator, backup.ChunkSeparator))
+                    self.assertEqual(subj.separators[3], subj.bundle_separator)
+                    self.assertTrue(isinstance(subj.bundle_separator, backup.GitBundleSeparator))
+                    self.assertEqual(len(subj.separators), 4)
                     self.assertEqual(subj.src_dirs, src_dirs if has_src_dirs else [''])
                     self.assertEqual(subj.dest_dirs, dest_dirs if has_dst_dirs else [])
                     self.assertEqual(subj.commands, commands)
+                    self.assertEqual(subj.list_pool.default, len(dest_dirs))
 
     @patch('backup.stop_watch', autospec=True)
     def test_main(self, mock_stop_watch):
@@ -409,54 +1515,301 @@ class BackupTest(TestCase):
                         server.login.assert_not_called()
                         server.quit.assert_not_called()
 
-    def test_recovery_for_each_dest(self):
-        subj = Backup()
-        key = 'key-%s'
-        # TODO возвращать результат. Перенести конструирование recovery_key_search внутрь recovery_for_each_dest
+    @patch.object(Backup, 'error', autospec=True)
+    def test_recipes(self, mock_error):
+        with tempfile.TemporaryDirectory() as directory:
+            subj = Backup()
+            subj.dest_dirs = [directory + '/d1', directory + '/d2']
+            chunks = [backup.ChunkStore.name('%064x' % i) for i in range(3)]
+            for dst, recipe in zip(subj.dest_dirs, (chunks[:2], chunks[1:])):
+                os.makedirs(dst + '/host/p')
+                os.makedirs(dst + '/' + os.path.dirname(chunks[0]))
+                with open(dst + '/host/p/p2020-01-01.tar.recipe', 'w') as fd:
+                    fd.write(''.join(chunk + '\n' for chunk in recipe))
+                with open(dst + '/' + chunks[1], 'w'):
+                    pass
+                with open(dst + '/' + backup.ChunkStore.DIR + '/ignored.recipe', 'w') as fd:
+                    fd.write(chunks[0])
+
+            self.assertEqual(subj.referenced_chunks(), {os.path.basename(chunk) for chunk in chunks})
+
+            subj.check_recipes()
+
+            self.assertEqual(mock_error.call_args_list,
+                             [call(subj, 'recipe %s error: missing chunks %s', dst + '/host/p/p2020-01-01.tar.recipe',
+                                   chunk) for dst, chunk in zip(subj.dest_dirs, (chunks[0], chunks[2]))])
+
+    @patch.object(Backup, 'safe_backup', autospec=True)
+    def test_backup_manifest_on_error(self, mock_safe_backup):
+        for failed in (False, True):
+            with self.subTest(failed=failed), tempfile.TemporaryDirectory() as directory:
+                src = directory + '/src'
+                os.makedirs(src)
+                subj = Backup()
+                subj.hostname = 'host'
+                subj.smtp_host = None
+                subj.dest_dirs = [directory + '/dst']
+                mock_safe_backup.side_effect = lambda *_: subj.error('backup error') if failed else None
 
-        subj.recovery_for_each_dest(key)
+                with patch('backup.log', autospec=True):
+                    subj.backup(src)
 
-        self.fail("TODO")
+                self.assertEqual(subj.error_count, 1 if failed else 0)
+                self.assertEqual(os.path.isfile(directory + '/dst/host/host-src/.manifest'), not failed)
 
-    @patch('backup.os', autospec=True)
-    def test_recovery_for_each(self, mock_os):
-        for isdir in (False, True):
-            with self.subTest(isdir=isdir):
-                mock_os.reset_mock()
+    def test_command_chunk_store(self):
+        for config, valid in (({}, True), ({'archiver': 'tar'}, False), ({'gzip_workers': 0}, False)):
+            with self.subTest(config=config), patch('sys.argv', ['backup.py', 'clone', 'dst-%s' % uid(), '3']), \
+                    patch.object(backup.HashCache, 'load', autospec=True):
                 subj = Backup()
-                dst = 'dst-%s' % uid()
-                key = 'key-%s'
-                recovery_key_search = Mock()
-                mock_os.path.isdir.return_value = isdir
-                mock_os.listdir.return_value = listdir = ['name-%s' % uid() for _ in uid_range()]
-
-                subj.recovery_for_each(dst, key, recovery_key_search)
-
-                mock_os.path.isdir.assert_called_once_with(dst + key)
-                if isdir:
-                    mock_os.listdir.assert_called_once_with(dst + key)
-                    recovery_key_search.assert_has_calls([call(dst, name) for name in listdir])
+                subj.config = dict(config, chunk_store=True)
+                if valid:
+                    self.assertEqual(subj.command(), subj.clone)
                 else:
-                    mock_os.listdir.assert_not_called()
-                    recovery_key_search.assert_not_called()
+                    self.assertRaises(ValueError, subj.command)
+
+    def test_command_gzip_level(self):
+        for config, expected in (({}, 6), ({'gzip_level': '9'}, 9), ({'gzip_level': 10}, None),
+                                 ({'gzip_level': 'fast'}, None)):
+            with self.subTest(config=config), patch('sys.argv', ['backup.py', 'clone', 'dst-%s' % uid(), '3']), \
+                    patch.object(backup.HashCache, 'load', autospec=True):
+                subj = Backup()
+                subj.config = config
+                if expected is not None:
+                    subj.command()
+                    self.assertEqual(subj.gzip_level, expected)
+                else:
+                    self.assertRaises(ValueError, subj.command)
+
+    def test_generic_backup_incremental(self):
+        with tempfile.TemporaryDirectory() as directory:
+            src, dst = directory + '/src', directory + '/dst/host/p'
+            os.makedirs(src)
+            subj = Backup()
+            subj.dest_dirs = [directory + '/dst']
+            subj.time_separator = TimeSeparator(3)
+            subj.gzip_workers = 1
+            subj.full_backup_days = 3
+            archives = []
+            for day in range(1, 6):
+                with open(src + '/f%s' % day, 'w') as fd:
+                    fd.write('day %s' % day)
+                with patch('time.strftime', return_value='2020-01-0%s' % day), patch('backup.log', autospec=True):
+                    subj.generic_backup(src, dst, 'p')
+                archives.append(sorted(n for n in os.listdir(dst) if not n.startswith('.')))
+
+            self.assertEqual(archives[-1], ['p2020-01-01.inc2020-01-02.tar.gz', 'p2020-01-01.inc2020-01-03.tar.gz',
+                                            'p2020-01-01.tar.gz', 'p2020-01-04.inc2020-01-05.tar.gz',
+                                            'p2020-01-04.tar.gz'])
+            with tarfile.open(dst + '/p2020-01-01.inc2020-01-03.tar.gz') as tar:
+                self.assertEqual(tar.getnames(), ['src', 'src/f2', 'src/f3', '.backup-manifest.json'])
+            self.assertEqual(set(subj.new_checksum_by_path), {dst + '/' + name for name in archives[-1]})
+            with open(dst + '/.index') as fd:
+                self.assertEqual(json.load(fd)['full'], 'p2020-01-04.tar.gz')
+
+    def test_generic_backup_no_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            src, dst = directory + '/src', directory + '/dst/host/p'
+            os.makedirs(src)
+            with open(src + '/f', 'w') as fd:
+                fd.write('f')
+            subj = Backup()
+            subj.dest_dirs = [directory + '/dst']
+            subj.gzip_workers = 1
+            os.makedirs(dst)
+            with open(dst + '/.index', 'w') as fd:
+                fd.write('{}')  # индекс времён разностных архивов
+
+            with patch('time.strftime', return_value='2020-01-01'), patch('backup.log', autospec=True):
+                subj.generic_backup(src, dst, 'p')
+
+            self.assertEqual(sorted(os.listdir(dst)), ['p2020-01-01.tar.gz'])
+
+    @patch.object(Backup, 'recovery_key_search', autospec=True)
+    @patch.object(Backup, 'recovery_for_each', spec=Backup.recovery_for_each)
+    def test_recovery_for_each_dest(self, mock_recovery_for_each, mock_recovery_key_search):
+        subj = Backup()
+        subj.list_pool.configure(2)
+        subj.separators = [TimeSeparator(3), SvnSeparator(), backup.ChunkSeparator()]
+        subj.dest_dirs = ['dst%s-%s' % (i, uid()) for i in range(3)]
+        key = 'key-%s' % uid()
+        listings = {dst: [('name-%s' % uid(), i % 2 == 0, i % 2 == 1) for i in uid_range()]
+                    for dst in subj.dest_dirs}
+        mock_recovery_for_each.side_effect = lambda dst, k: listings[dst]
+
+        try:
+            md5dirs, file_dict, recovery, lists = subj.recovery_for_each_dest(key)
+        finally:
+            subj.list_pool.shutdown()
+
+        self.assertEqual((md5dirs, file_dict, recovery, lists), (set(), {}, [], ([], [], [])))
+        mock_recovery_for_each.assert_has_calls([call(dst, key) for dst in subj.dest_dirs], any_order=True)
+        self.assertEqual(mock_recovery_key_search.call_args_list,
+                         [call(subj, dst, key + '/' + name, name, is_dir, is_file, md5dirs, file_dict, recovery, lists)
+                          for dst in subj.dest_dirs
+                          for name, is_dir, is_file in listings[dst]])
+
+    @patch.object(Backup, 'referenced_chunks', autospec=True)
+    @patch.object(Backup, 'run_commands', autospec=True)
+    @patch.object(Backup, 'recovery_dirs', autospec=True)
+    def test_clone(self, mock_recovery_dirs, mock_run_commands, mock_referenced_chunks):
+        subj = Backup()
+        referenced = {'chunk-%s' % uid()}
+        mock_referenced_chunks.return_value = referenced
+        mock_recovery_dirs.side_effect = lambda _self, key: self.assertEqual(subj.chunk_separator.referenced,
+                                                                             referenced)
+        mock_run_commands.side_effect = lambda _self: mock_recovery_dirs.assert_called_once_with(subj, '')
+
+        subj.clone()
+
+        mock_run_commands.assert_called_once_with(subj)
+
+    @patch.object(Backup, 'write_md5', autospec=True)
+    @patch.object(Backup, 'fan_out_copy', autospec=True)
+    def test_lazy_fan_out_copy(self, mock_fan_out_copy, mock_write_md5):
+        subj = Backup()
+        subj.clone_workers = 2
+        subj.dest_dirs = ['dst-%s' % uid() for _ in range(3)]
+        subj.commands = {dst: [] for dst in subj.dest_dirs}
+        rec = backup.RecoveryEntry('name-%s' % uid())
+        rec.list = subj.dest_dirs[1:]
+        key = '/dir/' + rec.name
+        copied = []
+        written = []
+        mock_fan_out_copy.side_effect = lambda *args: (time.sleep(0.1), copied.append(True))
+        mock_write_md5.side_effect = lambda _self, dst, *args: written.append((dst, len(copied)))
+
+        subj.lazy_fan_out_copy(rec, key)
+        subj.lazy_write_md5_to_md5dirs(rec.list, '/dir', [rec])
+        subj.run_commands()
+
+        mock_fan_out_copy.assert_called_once_with(subj, rec, subj.dest_dirs[1:], key)
+        self.assertEqual(sorted(written), sorted((dst, 1) for dst in subj.dest_dirs[1:]))
+        self.assertEqual(subj.commands[subj.dest_dirs[0]], [])
+
+    def test_fan_out_mkdirs(self):
+        real_mkdir = os.mkdir
+
+        def slow_mkdir(path, *args, **kwargs):
+            time.sleep(0.01)  # расширяет окно между проверкой существования и созданием
+            real_mkdir(path, *args, **kwargs)
+
+        for attempt in range(5):
+            with tempfile.TemporaryDirectory() as directory, self.subTest(attempt=attempt), \
+                    patch('os.mkdir', side_effect=slow_mkdir):
+                subj = Backup()
+                subj.clone_workers = 2
+                subj.dest_dirs = [directory + '/dst1', directory + '/dst2']
+                barrier = threading.Barrier(2, timeout=5)
+
+                def write(out):
+                    out.write(b'data')
+
+                def fan_out():
+                    barrier.wait()
+                    subj.safe_write_all([dst + '/new/a/b/file' for dst in reversed(subj.dest_dirs)], write,
+                                        lambda: 'fan-out')
+
+                def copy():
+                    barrier.wait()
+                    subj.safe_write(subj.dest_dirs[1] + '/new/a/c/file', write, lambda: 'copy')
+
+                # общая команда пишет во вторую директорию из очереди первой, пока вторая создаёт тот же родитель
+                subj.commands = {subj.dest_dirs[0]: [backup.SharedCommand(fan_out)], subj.dest_dirs[1]: [copy]}
+                subj.run_commands()
+
+                self.assertEqual(subj.error_count, 0)
+                for path in ('dst1/new/a/b/file', 'dst2/new/a/b/file', 'dst2/new/a/c/file'):
+                    self.assertTrue(os.path.isfile(directory + '/' + path), path)
+
+    @patch.object(Backup, 'error', autospec=True)
+    def test_run_commands(self, mock_error):
+        for clone_workers in (0, 1, 2):
+            with self.subTest(clone_workers=clone_workers):
+                mock_error.reset_mock()
+                subj = Backup()
+                subj.clone_workers = clone_workers
+                subj.dest_dirs = ['dst-%s' % uid() for _ in range(3)]
+                failed = subj.dest_dirs[1]
+                done = []
+                lock = threading.Lock()
+                error = IOError('error-%s' % uid())
+
+                def command(dst, i):
+                    def run():
+                        if dst == failed and i == 1:
+                            raise error
+                        with lock:
+                            done.append((dst, i))
+
+                    return run
+
+                subj.commands = {dst: [command(dst, i) for i in range(3)] for dst in subj.dest_dirs}
+
+                subj.run_commands()
+
+                for dst in subj.dest_dirs:
+                    expected = [(dst, 0)] if dst == failed else [(dst, i) for i in range(3)]
+                    self.assertEqual([d for d in done if d[0] == dst], expected)
+                mock_error.assert_called_once_with(subj, 'clone %s error: %s\n%s', failed, error, mock.ANY)
+
+    def test_recovery_for_each(self):
+        with tempfile.TemporaryDirectory() as dst:
+            key = '/key-%s' % uid()
+            with self.subTest(exists=False):
+                self.assertEqual(Backup.recovery_for_each(dst, key), [])
+            os.makedirs(dst + key + '/dir')
+            with open(dst + key + '/file', 'w'):
+                pass
+            os.symlink(dst + key + '/dir', dst + key + '/link')
+            with self.subTest(exists=True):
+                self.assertEqual(sorted(Backup.recovery_for_each(dst, key)),
+                                 [('dir', True, False), ('file', False, True), ('link', True, False)])
+            with self.subTest(file=True):
+                self.assertEqual(Backup.recovery_for_each(dst, key + '/file'), [])
 
-    @patch('backup.os', autospec=True)
     @patch.object(Backup, 'recovery_dirs', autospec=True)
     @patch.object(Backup, 'recovery_entry', autospec=True)
     def test_recovery_key_search(self, mock_recovery_entry, mock_recovery_dirs):
-        subj = Backup()
         dst = 'dst-%s' % uid()
-        key = 'key-%s' % uid()
-        name = 'name-%s' % uid()
-        md5dirs = ['md5dirs-%s' % uid() for _ in uid_range()]
-        file_dict = {'file-%s' % uid(): uid() for _ in uid_range()}
-        recovery = ['recovery-%s' % uid() for _ in uid_range()]
-        indexes = [uid() for _ in uid_range()]
-        lists = {i: ['list-%s' % uid() for _ in uid_range()] for i in indexes}
+        entry = backup.RecoveryEntry('name-%s' % uid())
+        known = 'known-%s' % uid()
+        for name, is_dir, is_file, index, expected in [
+                ('dir', True, False, None, 'dir'),
+                ('socket', False, False, None, None),
+                ('f.md5', False, True, None, 'md5'),
+                ('.md5', False, True, None, None),
+                ('.checksum', False, True, None, None),
+                ('.checksum.bin', False, True, None, None),
+                ('.manifest', False, True, None, None),
+                ('.index', False, True, None, None),
+                ('.lock', False, True, None, None),
+                (known, False, True, None, None),
+                ('file', False, True, -1, 'recovery'),
+                ('file', False, True, 1, 'lists')]:
+            with self.subTest(name=name, index=index):
+                mock_recovery_entry.reset_mock()
+                mock_recovery_dirs.reset_mock()
+                mock_recovery_entry.return_value = (entry, index)
+                subj = Backup()
+                key = '/' + name
+                md5dirs, file_dict, recovery, lists = set(), {known: backup.RecoveryEntry(known)}, [], ([], [])
 
-        subj.recovery_key_search(dst, key, name, md5dirs, file_dict, recovery, lists)
+                subj.recovery_key_search(dst, key, name, is_dir, is_file, md5dirs, file_dict, recovery, lists)
 
-        self.fail("TODO")
+                if expected == 'dir':
+                    mock_recovery_dirs.assert_called_once_with(subj, key)
+                else:
+                    mock_recovery_dirs.assert_not_called()
+                self.assertEqual(md5dirs, {dst} if expected == 'md5' else set())
+                if expected in ('recovery', 'lists'):
+                    mock_recovery_entry.assert_called_once_with(subj, name, key)
+                    self.assertIs(file_dict[name], entry)
+                else:
+                    mock_recovery_entry.assert_not_called()
+                    self.assertEqual(set(file_dict), {known})
+                self.assertEqual(recovery, [entry] if expected == 'recovery' else [])
+                self.assertEqual(lists, ([], [entry]) if expected == 'lists' else ([], []))
 
     @patch.object(Backup, 'slow_check_dirs', autospec=True)
     @patch.object(backup, 'with_lock_file', spec=backup.with_lock_file)
@@ -568,16 +1921,100 @@ class BackupTest(TestCase):
         self.assertEqual(diff, {})
         self.assertEqual(dir_md5_with_time, expected)
 
-    @patch.object(Backup, 'slow_check_dir', autospec=True)
-    @patch.object(Backup, 'sorted_dirs', autospec=True)
-    def test_slow_check_dirs(self, mock_sorted_dirs, mock_slow_check_dir):
+    @patch.object(Backup, 'check_recipes', autospec=True)
+    @patch.object(Backup, 'scrub', autospec=True)
+    def test_slow_check_dirs(self, mock_scrub, mock_check_recipes):
         subj = Backup()
-        dirs = ['dir-%s' % uid() for _ in uid_range()]
-        mock_sorted_dirs.return_value = dirs
 
         subj.slow_check_dirs()
 
-        mock_slow_check_dir.assert_has_calls([call(subj, d) for d in dirs])
+        mock_scrub.assert_called_once_with(subj)
+        mock_check_recipes.assert_called_once_with(subj)
+
+    def test_scrub(self):
+        with tempfile.TemporaryDirectory() as directory:
+            subj = Backup()
+            subj.dest_dirs = [directory]
+            subj.rate_limiter = backup.RateLimiter(0)
+            subj.check_size_limit = 2 / (1024 * 1024)
+            now = time.time()
+            for i, name in enumerate(['c', 'a', 'b']):
+                with open(directory + '/' + name, 'wb') as fd:
+                    fd.write(bytes(name, 'UTF-8'))
+                checksum = hashlib.md5(bytes(name if name != 'b' else 'x', 'UTF-8')).hexdigest()
+                Backup.append_checksum(directory, name, checksum, now - (60 - i) * 24 * 3600)
+
+            with self.assertLogs(level='WARNING') as logs:
+                subj.scrub()
+
+            self.assertEqual(logs.output, ['WARNING:root:scrub: 1 files 0 MB not checked for 30 days, '
+                                           '28.0 days behind schedule'])
+            checked = Backup.read_directory_md5_with_time(directory)
+            self.assertEqual(checked['c'][0], hashlib.md5(b'c').hexdigest())
+            self.assertEqual(checked['a'][0], hashlib.md5(b'a').hexdigest())
+            self.assertGreaterEqual(checked['c'][1], now)
+            self.assertGreaterEqual(checked['a'][1], now)
+            self.assertLess(checked['b'][1], now)
+
+            subj.scrub()
+
+            with open(directory + '/.checksum', encoding='UTF-8') as fd:
+                self.assertRegex(fd.read(), '(?m)^corrupted .* b$')
+
+    @patch.object(Backup, 'check_file', autospec=True)
+    @patch.object(Backup, 'rewrite_dir_checksums', autospec=True)
+    @patch.object(Backup, 'sorted_dirs', autospec=True)
+    @patch('backup.os', autospec=True)
+    def test_scrub_devices(self, mock_os, mock_sorted_dirs, mock_rewrite_dir_checksums, mock_check_file):
+        subj = Backup()
+        subj.checksum_pool.configure(2)
+        mock_sorted_dirs.return_value = ['a/1', 'a/2', 'b/1']
+        mock_os.stat.side_effect = lambda d: Mock(st_dev=d[0])
+        mock_os.path.getsize.return_value = 1
+        mock_rewrite_dir_checksums.side_effect = lambda _, d: {'f%s' % i: ('%s-%s' % (d, i), 10 * i + len(d))
+                                                               for i in range(3)}
+        barrier = threading.Barrier(2, timeout=5)
+        started = set()
+        lock = threading.Lock()
+
+        def check_file(_, directory, *args):
+            with lock:
+                first = directory[0] not in started
+                started.add(directory[0])
+            if first:
+                barrier.wait()  # первые файлы двух дисков проверяются одновременно
+
+        mock_check_file.side_effect = check_file
+
+        subj.scrub()
+
+        self.assertEqual(sorted(mock_check_file.call_args_list),
+                         sorted(call(subj, d, 'f%s' % i, '%s-%s' % (d, i)) for d in ['a/1', 'a/2', 'b/1']
+                                for i in range(3)))
+
+    @patch.object(Backup, 'check_file', autospec=True)
+    @patch.object(Backup, 'rewrite_dir_checksums', autospec=True)
+    @patch.object(Backup, 'sorted_dirs', autospec=True)
+    @patch('backup.os', autospec=True)
+    def test_scrub_missing_file(self, mock_os, mock_sorted_dirs, mock_rewrite_dir_checksums, mock_check_file):
+        subj = Backup()
+        mock_sorted_dirs.return_value = ['a/1']
+        mock_os.stat.return_value = Mock(st_dev=1)
+        mock_rewrite_dir_checksums.return_value = {'f%s' % i: ('sum-%s' % i, i) for i in range(3)}
+
+        def getsize(path):
+            if path == 'a/1/f1':
+                raise FileNotFoundError(path)
+            return 1
+
+        mock_os.path.getsize.side_effect = getsize
+
+        with patch('backup.log', autospec=True):
+            subj.scrub()
+
+        self.assertEqual(mock_check_file.call_args_list, [call(subj, 'a/1', 'f0', 'sum-0'),
+                                                          call(subj, 'a/1', 'f2', 'sum-2')])
+        self.assertEqual(subj.error_count, 1)
 
     @patch.object(Backup, 'time_by_directory', spec=Backup.time_by_directory)
     def test_sorted_dirs(self, mock_time_by_directory):
@@ -599,15 +2036,9 @@ class BackupTest(TestCase):
     @patch.object(Backup, 'safe_append_checksum', autospec=True)
     @patch.object(backup, 'md5sum', spec=backup.md5sum)
     @patch('backup.time', autospec=True)
-    @patch.object(Backup, 'sorted_name_with_checksum', spec=Backup.sorted_name_with_checksum)
-    @patch.object(Backup, 'rewrite_dir_checksums', autospec=True)
-    def test_slow_check_dir(self, mock_rewrite_dir_checksums, mock_sorted_name_with_checksum_by_time,
-                            mock_time, mock_md5sum, mock_safe_append_checksum):
+    def test_check_file(self, mock_time, mock_md5sum, mock_safe_append_checksum):
         subj = Backup()
-        dir_checksums = 'dir_checksums-%s' % uid()
-        mock_rewrite_dir_checksums.return_value = dir_checksums
         name_with_checksums = [('name-%s' % uid(), 'checksum-%s' % uid()) for _ in uid_range()]
-        mock_sorted_name_with_checksum_by_time.return_value = name_with_checksums
         times = [uid_time() for _ in name_with_checksums]
         mock_time.time.side_effect = times
         corrupted_index = uid(len(name_with_checksums))
@@ -615,11 +2046,11 @@ class BackupTest(TestCase):
                                    for i in range(0, len(name_with_checksums))]
         directory = 'dir-%s' % uid()
 
-        subj.slow_check_dir(directory)
+        for name, checksum in name_with_checksums:
+            subj.check_file(directory, name, checksum)
 
-        mock_rewrite_dir_checksums.assert_called_once_with(subj, directory)
-        mock_sorted_name_with_checksum_by_time.assert_called_once_with(dir_checksums)
-        mock_md5sum.assert_has_calls([call(directory + '/' + name, multiplier=subj.with_sleep_multiplier)
+        mock_md5sum.assert_has_calls([call(directory + '/' + name, multiplier=subj.rate_limiter,
+                                           algorithm='md5')
                                       for name, _ in name_with_checksums])
         mock_safe_append_checksum.assert_has_calls([call(subj, directory, name_with_checksums[i][0],
                                                          'corrupted' if i == corrupted_index
@@ -646,20 +2077,6 @@ class BackupTest(TestCase):
         mock_max_time.assert_has_calls([call(root, files_by_root[root])
                                         for root in filter(lambda root: root != empty_root, roots)])
 
-    def test_sorted_name_with_checksum(self):
-        subj = Backup()
-        n = 3 + uid(5)
-        name = ['name-%s' % uid() for _ in range(0, n)]
-        checksum = ['checksum-%s' % uid() for _ in name]
-        times = [uid_time() for _ in name]
-        checksum_with_time_by_name = {name[i]: (checksum[i], times[i]) for i in range(0, n)}
-        expected = [(name[i], checksum[i]) for i in range(0, n)]
-        expected.reverse()
-
-        actual = subj.sorted_name_with_checksum(checksum_with_time_by_name)
-
-        self.assertEqual(actual, expected)
-
     @patch.object(Backup, 'write_md5_with_time_dict', spec=Backup.write_md5_with_time_dict)
     @patch.object(Backup, 'safe_write', autospec=True)
     @patch.object(backup, 'remove_file', spec=backup.remove_file)
@@ -714,6 +2131,50 @@ class BackupTest(TestCase):
         self.assertEqual(actual, expected)
         mock_os_path.getmtime.assert_has_calls([call(directory + '/' + f) for f in files])
 
+    def test_checksum_format_binary(self):
+        with tempfile.TemporaryDirectory() as directory:
+            subj = Backup()
+            for name in ('a', 'b'):
+                with open(directory + '/' + name, 'wb') as fd:
+                    fd.write(bytes(name, 'UTF-8'))
+            md5 = {name: hashlib.md5(bytes(name, 'UTF-8')).hexdigest() for name in ('a', 'b')}
+            Backup.append_checksum(directory, 'a', md5['a'], 1.0)
+            Backup.append_checksum(directory, 'b', md5['b'], 2.0)
+            subj.checksum_format = 'binary'
+
+            self.assertEqual(subj.rewrite_dir_checksums(directory), {'a': (md5['a'], 1.0), 'b': (md5['b'], 2.0)})
+
+            self.assertFalse(os.path.exists(directory + '/.checksum'))
+            self.assertTrue(os.path.isfile(directory + '/.checksum.bin'))
+            subj.safe_append_checksum(directory, 'a', md5['a'], 3.0)
+            self.assertFalse(os.path.exists(directory + '/.checksum'))
+            self.assertEqual(Backup.read_directory_md5_with_time(directory),
+                             {'a': (md5['a'], 3.0), 'b': (md5['b'], 2.0)})
+
+            subj.checksum_format = 'text'
+            subj.rewrite_dir_checksums(directory)
+
+            self.assertFalse(os.path.exists(directory + '/.checksum.bin'))
+            self.assertEqual(backup.load_md5_with_times(directory + '/.checksum'),
+                             {'a': (md5['a'], 3.0), 'b': (md5['b'], 2.0)})
+
+    def test_compact_checksums(self):
+        with tempfile.TemporaryDirectory() as directory:
+            subj = Backup()
+            subj.checksum_compact_size = 200 / (1024 * 1024)
+            with open(directory + '/a', 'wb') as fd:
+                fd.write(b'a')
+            md5 = hashlib.md5(b'a').hexdigest()
+            sizes = []
+            for i in range(10):
+                subj.safe_append_checksum(directory, 'a', md5, float(i + 1))
+                sizes.append(os.path.getsize(directory + '/.checksum'))
+
+            line = sizes[0]
+            self.assertEqual(sizes, [line, 2 * line] * 5)  # третья запись превышает 200 байт и журнал сжимается
+            self.assertEqual(subj.compacted, {directory: line})
+            self.assertEqual(subj.errors, [])
+
     @patch.object(Backup, 'error', autospec=True)
     @patch.object(Backup, 'append_checksum', spec=Backup.append_checksum)
     def test_safe_append_checksum(self, mock_append_checksum, mock_error):
@@ -792,12 +2253,6 @@ class BackupTest(TestCase):
 
         fd.write.assert_called_once_with(bytes(checksum + ' ' + str_time + ' ' + key + '\n', 'UTF-8'))
 
-    @patch("backup.time", autospec=True)
-    def test_with_sleep_multiplier(self, mock_time):
-        subj = Backup()
-        self.assertEqual(subj.with_sleep_multiplier(), 4)
-        mock_time.sleep.assert_called_once_with(0.01)
-
     def test_sorted_md5_with_time_by_time(self):
         subj = Backup()
         key1 = 'key1-%s' % uid()
@@ -834,7 +2289,7 @@ class BackupTest(TestCase):
                 with self.subTest(contains=contains, is_safe_write=is_safe_write):
                     mock_sw = Mock(name='mock_sw')
                     mock_stop_watch.return_value = mock_sw
-                    mock_do_copy.side_effect = lambda x, y, z: None
+                    mock_do_copy.side_effect = lambda *args: None
                     src_dir = 'src_dir-%s' % uid()
                     dest_dir = 'dest_dir-%s' % uid()
                     rec = Mock(name='rec')
@@ -861,7 +2316,7 @@ class BackupTest(TestCase):
 
                         do_copy(mock_out)
 
-                        mock_do_copy.assert_called_once_with(mock_out, src_dir + key, checksum)
+                        mock_do_copy.assert_called_once_with(mock_out, src_dir + key, checksum, subj.copy_buffers)
                         mock_sw.assert_not_called()
                         return is_safe_write
 
@@ -873,18 +2328,70 @@ class BackupTest(TestCase):
                     mock_safe_write.assert_called_once_with(subj, dest_dir + key, mock.ANY, mock.ANY)
                     mock_sw.stop.assert_called_once_with()
 
+    @patch.object(Backup, 'error', autospec=True)
+    def test_fan_out_copy(self, mock_error):
+        for is_equals in (False, True):
+            with self.subTest(is_equals=is_equals), tempfile.TemporaryDirectory() as directory:
+                mock_error.reset_mock()
+                subj = Backup()
+                subj.dest_dirs = [directory + '/dst%s' % i for i in range(4)]
+                key = '/sub/file-%s' % uid()
+                data = os.urandom(100000)
+                src_dir = subj.dest_dirs[1]
+                os.makedirs(src_dir + '/sub')
+                with open(src_dir + key, 'wb') as fd:
+                    fd.write(data)
+                os.makedirs(subj.dest_dirs[3] + key)  # файл нельзя записать: на его месте директория
+                checksum = hashlib.md5(data).hexdigest() if is_equals else 'checksum-%s' % uid()
+                rec = backup.RecoveryEntry(key[1:])
+                rec.dir = src_dir
+                rec.md5 = {src_dir: checksum}
+                rec.list = [subj.dest_dirs[0], subj.dest_dirs[2], subj.dest_dirs[3]]
+
+                subj.fan_out_copy(rec, rec.list, key)
+
+                for dst in rec.list:
+                    if is_equals and dst != subj.dest_dirs[3]:
+                        with open(dst + key, 'rb') as fd:
+                            self.assertEqual(fd.read(), data)
+                    else:
+                        self.assertFalse(os.path.isfile(dst + key))
+                    self.assertFalse(os.path.exists(dst + key + '.tmp'))
+                expected_md5 = {src_dir: checksum}
+                if is_equals:
+                    expected_md5.update({subj.dest_dirs[0]: checksum, subj.dest_dirs[2]: checksum})
+                self.assertEqual(rec.md5, expected_md5)
+                mock_error.assert_called_once()
+
+    def test_fan_out(self):
+        outs = {'out-%s' % i: io.BytesIO() for i in range(3)}
+        failed = Mock(name='failed')
+        error = IOError('error-%s' % uid())
+        failed.write.side_effect = [None, error]
+        subj = backup.FanOut(dict(outs, failed=failed))
+
+        self.assertEqual(subj.write(b'data1'), 5)
+        self.assertEqual(subj.write(b'data2'), 5)
+        self.assertEqual(subj.write(b'data3'), 5)
+        subj.close()
+
+        self.assertEqual({name: out.getvalue() for name, out in outs.items()},
+                         {name: b'data1data2data3' for name in outs})
+        self.assertEqual(subj.errors, {'failed': error})
+        self.assertEqual(failed.write.call_count, 2)
+
     @patch.object(backup, 'with_open', spec=backup.with_open)
     def test_do_copy(self, mock_with_open):
-        for is_equals in (False, True):
-            with self.subTest(is_equals=is_equals):
+        for is_equals, algorithm in [(e, a) for e in (False, True) for a in ('md5', 'blake2b')]:
+            with self.subTest(is_equals=is_equals, algorithm=algorithm):
                 subj = Backup()
                 src = 'src-%s' % uid()
                 data = [bytes('data-%s' % uid(), 'UTF-8') for _ in uid_range()] + [b'']
-                md5 = hashlib.md5()
+                md5 = hashlib.new(algorithm)
                 for i in data:
                     md5.update(i)
-                expected_checksum = md5.hexdigest().lower()
-                illegal_checksum = 'checksum-%s' % uid()
+                expected_checksum = backup.format_checksum(md5)
+                illegal_checksum = expected_checksum[:-10] + '%010d' % uid()
                 mock_in = Mock(name='mock_in')
                 mock_in.read.side_effect = data
 
@@ -905,6 +2412,53 @@ class BackupTest(TestCase):
                                      (src, expected_checksum, illegal_checksum))
                 mock_out.write.assert_has_calls(expected_calls)
 
+    @patch.object(backup, 'with_open', spec=backup.with_open)
+    def test_do_copy_pipelined(self, mock_with_open):
+        for is_equals in (False, True):
+            with self.subTest(is_equals=is_equals):
+                src = 'src-%s' % uid()
+                data = os.urandom(3 * 1024 * 1024 + uid(1000))
+                expected_checksum = hashlib.md5(data).hexdigest()
+                checksum = expected_checksum if is_equals else 'checksum-%s' % uid()
+                mock_with_open.side_effect = lambda name, mode, handler: handler(io.BytesIO(data))
+                out = io.BytesIO()
+
+                if is_equals:
+                    Backup.do_copy(out, src, checksum, 3)
+                else:
+                    with self.assertRaises(IOError) as cm:
+                        Backup.do_copy(out, src, checksum, 3)
+                    self.assertEqual(cm.exception.args[0], 'Corrupted [%s]. Checksum is %s but expected %s' %
+                                     (src, expected_checksum, checksum))
+                mock_with_open.assert_called_with(src, 'rb', mock.ANY)
+                self.assertEqual(out.getvalue(), data)
+
+    def test_pipelined_copy(self):
+        class Failure(Exception):
+            pass
+
+        for fail in (None, 'read', 'write'):
+            for buffers in (2, 4):
+                with self.subTest(fail=fail, buffers=buffers):
+                    data = os.urandom(10000 + uid(1000))
+                    src = io.BytesIO(data)
+                    out = io.BytesIO()
+                    if fail == 'read':
+                        src.readinto = Mock(side_effect=[1000, Failure()])
+                    elif fail == 'write':
+                        out.write = Mock(side_effect=Failure())
+                    threads = threading.active_count()
+
+                    if fail is None:
+                        actual = Backup.pipelined_copy(src, out, 'blake2b', buffers, 1000)
+
+                        self.assertEqual(actual, 'blake2b:' + hashlib.blake2b(data).hexdigest())
+                        self.assertEqual(out.getvalue(), data)
+                    else:
+                        with self.assertRaises(Failure):
+                            Backup.pipelined_copy(src, out, 'blake2b', buffers, 1000)
+                    self.assertEqual(threading.active_count(), threads)
+
     @patch.object(Backup, 'safe_append_checksum', autospec=True)
     @patch.object(Backup, 'safe_md5sum', autospec=True)
     @patch.object(Backup, 'checksum_by_name', autospec=True)
@@ -944,9 +2498,23 @@ class BackupTest(TestCase):
                         self.assertEqual(checksum_by_name, expected_checksum_by_name)
                         mock_os_path.dirname.assert_called_once_with(path)
                         mock_os_path.basename.assert_called_once_with(path)
-                        mock_safe_md5sum.assert_has_calls([call(subj, path)]
+                        mock_safe_md5sum.assert_has_calls([call(subj, path, 'md5')]
                                                           if contains and offset is not None and offset < 0 else [])
 
+    @patch.object(Backup, 'checksum', autospec=True)
+    def test_checksums(self, mock_checksum):
+        subj = Backup()
+        subj.checksum_pool.workers = {'/dst1': 3}
+        paths = ['/dst%s/name-%s' % (i, uid()) for i in (1, 2) for _ in uid_range()]
+        expected = {path: ('checksum-%s' % uid(), uid(2) == 0) for path in paths}
+        mock_checksum.side_effect = lambda _self, path: expected[path]
+
+        actual = subj.checksums(paths)
+        subj.checksum_pool.shutdown()
+
+        self.assertEqual(actual, expected)
+        mock_checksum.assert_has_calls([call(subj, path) for path in paths], any_order=True)
+
     @patch.object(Backup, 'error', autospec=True)
     @patch('backup.md5sum', autospec=True)
     def test_safe_md5sum(self, mock_md5sum, mock_error):
@@ -959,7 +2527,7 @@ class BackupTest(TestCase):
                 checksum = 'checksum-%s' % uid()
 
                 # noinspection PyUnusedLocal
-                def md5sum(_path, is_stop_watch):
+                def md5sum(_path, is_stop_watch, algorithm):
                     if raised is None:
                         return checksum
                     raise raised
@@ -994,6 +2562,72 @@ class BackupTest(TestCase):
                 self.assertEqual(subj.checksums_by_dir, expected_checksums_by_dir)
                 mock_read_directory_md5_with_time.assert_has_calls([] if contains else [call(directory)])
 
+    @patch.object(Backup, 'read_dir_md5_with_time', spec=Backup.read_dir_md5_with_time)
+    def test_catalog_checksums(self, mock_read_dir_md5_with_time):
+        with tempfile.TemporaryDirectory() as directory:
+            subj = Backup()
+            subj.catalog = backup.ChecksumCatalog(directory + '/catalog.sqlite')
+            dst = directory + '/dst'
+            os.mkdir(dst)
+            names = ['file-%s' % i for i in range(4)]
+            for name in names + ['.md5']:
+                with open(dst + '/' + name, 'wb') as fd:
+                    fd.write(bytes(name, 'UTF-8'))
+            st = {name: os.stat(dst + '/' + name) for name in names}
+            checksum = {name: hashlib.md5(bytes(name, 'UTF-8')).hexdigest() for name in names}
+            verified = {name: uid_time() for name in names}
+            subj.catalog.update(dst, [(names[0], checksum[names[0]], verified[names[0]],
+                                       st[names[0]].st_size, st[names[0]].st_mtime),
+                                      (names[1], checksum[names[1]], verified[names[1]],
+                                       st[names[1]].st_size + 1, st[names[1]].st_mtime),  # файл изменился
+                                      ('removed', checksum[names[2]], uid_time(), 1, uid_time())])
+            read = {name: (checksum[name], verified[name]) for name in names[1:3]}
+            mock_read_dir_md5_with_time.return_value = read
+            expected = {name: (checksum[name], verified[name]) for name in names[0:3]}
+
+            actual = subj.catalog_checksums(dst)
+
+            self.assertEqual(actual, expected)
+            mock_read_dir_md5_with_time.assert_called_once_with(dst, dst + '/.checksum', set(names + ['.md5']))
+            self.assertEqual(subj.catalog.load(dst),
+                             {name: expected[name] + (st[name].st_size, st[name].st_mtime) for name in expected})
+
+            mock_read_dir_md5_with_time.reset_mock()
+            self.assertEqual(subj.checksum_by_name(dst), expected)
+            mock_read_dir_md5_with_time.assert_called_once()  # file-3 без суммы читается из файлов заново
+            subj.catalog.close()
+
+    def test_catalog_import_export(self):
+        with tempfile.TemporaryDirectory() as directory:
+            subj = Backup()
+            subj.catalog = backup.ChecksumCatalog(directory + '/catalog.sqlite')
+            dst = directory + '/dst'
+            subj.dest_dirs = [dst]
+            os.makedirs(dst + '/sub')
+            checksums = {}
+            for name in ('a', 'sub/b', 'sub/c'):
+                data = bytes(name, 'UTF-8')
+                with open(dst + '/' + name, 'wb') as fd:
+                    fd.write(data)
+                checksums[name] = hashlib.md5(data).hexdigest()
+            with open(dst + '/.md5', 'wb') as fd:
+                backup.write_md5(fd, checksums['a'], 'a')
+            with open(dst + '/sub/.md5', 'wb') as fd:
+                backup.write_md5(fd, checksums['sub/b'], 'b')
+                backup.write_md5(fd, checksums['sub/c'], 'c')
+
+            with patch('backup.log', autospec=True):
+                subj.catalog_import()
+            os.remove(dst + '/sub/.md5')
+            with patch('backup.log', autospec=True):
+                subj.catalog_export()
+
+            self.assertEqual({name: checksum for name, (checksum, _, _, _) in subj.catalog.load(dst + '/sub').items()},
+                             {'b': checksums['sub/b'], 'c': checksums['sub/c']})
+            self.assertEqual(backup.load_md5(dst + '/sub/.md5'), {'b': checksums['sub/b'], 'c': checksums['sub/c']})
+            self.assertEqual(set(backup.load_md5_with_times(dst + '/sub/.checksum')), {'b', 'c'})
+            subj.catalog.close()
+
     def test_checksum_path(self):
         directory = 'directory-%s' % uid()
 
@@ -1023,6 +2657,16 @@ class BackupTest(TestCase):
         self.assertEqual(backup.time_from_string(t), 1660464293.984743)
 
 
+class ReadOnly:
+    """ Поток только с методом read """
+
+    def __init__(self, data: bytes):
+        self.stream = io.BytesIO(data)
+
+    def read(self, size: int) -> bytes:
+        return self.stream.read(size)
+
+
 def uid_sequence():
     value = 0
     while True: